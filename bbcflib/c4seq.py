@@ -14,6 +14,7 @@ from bein.util import touch
 from bbcflib.createlib import get_libForGrp
 from bbcflib.track import track, convert
 from bbcflib.mapseq import parallel_density_sql
+from bbcflib.gfminer import parallel_run
 from bbcflib.common import unique_filename_in, gzipfile, merge_sql, cat, gfminer_run, set_file_descr
 
 # *** Create a dictionary with infos for each primer (from file primers.fa)
@@ -79,37 +80,43 @@ def runDomainogram( infile, name, prefix=None, regCoord="",
 def density_to_countsPerFrag( ex, file_dict, groups, assembly, regToExclude, script_path, via='lsf' ):
     '''
     Main function to compute normalised counts per fragments from a density file.
+    With *via* = 'local', chromosomes are processed by a pool of local processes
+    (see `bbcflib.gfminer.parallel_run`) instead of one ``gfminer_run`` job each.
     '''
     futures = {}
     results = {}
     for gid, group in groups.iteritems():
         density_file = file_dict['density'][gid]
         reffile = file_dict['lib'][gid]
-#   scores = track(density_file)
-        gm_futures = []
+        gm_jobs = []
         for ch in assembly.chrnames:
             chref = os.path.join(reffile,ch+".bed.gz")
             if not(os.path.exists(chref)): chref = reffile
-#            features = track(chref,'bed')
-#            outbed.write(gMiner.stream.mean_score_by_feature(
-#                    scores.read(selection=ch),
-#                    features.read(selection=ch)), mode='append')
             bedfile = unique_filename_in()+".bed"
-            gfminer_job = {"operation": "score_by_feature",
-                           "output": bedfile,
-                           "datatype": "qualitative",
-                           "args": "'"+json.dumps({"trackScores":density_file,
-                                                   "trackFeatures":chref,
-                                                   "chromosome":ch})+"'"}
-            gm_futures.append((gfminer_run.nonblocking(ex,gfminer_job,via=via),
-                               bedfile))
+            gm_jobs.append({"operation": "score_by_feature",
+                            "output": bedfile,
+                            "datatype": "qualitative",
+                            "trackScores": density_file,
+                            "trackFeatures": chref,
+                            "chromosome": ch})
+        if via == 'local':
+            sizes = [assembly.chrmeta.get(ch,{}).get('length',0) for ch in assembly.chrnames]
+            parallel_run(gm_jobs, sizes=sizes)
+            gm_futures = [(None,job["output"]) for job in gm_jobs]
+        else:
+            gm_futures = []
+            for job in gm_jobs:
+                args = dict((k,job.pop(k)) for k in ["trackScores","trackFeatures","chromosome"])
+                job["args"] = "'"+json.dumps(args)+"'"
+                gm_futures.append((gfminer_run.nonblocking(ex,job,via=via),
+                                   job["output"]))
         outsql = unique_filename_in()+".sql"
         sqlouttr = track( outsql, chrmeta=assembly.chrmeta,
                           info={'datatype':'quantitative'},
                           fields=['start', 'end', 'score'] )
         outbed_all = []
         for n,f in enumerate(gm_futures):
-            f[0].wait()
+            if f[0] is not None: f[0].wait()
             fout = f[1]
             if not(os.path.exists(fout)):
                 time.sleep(60)
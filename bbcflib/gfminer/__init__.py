@@ -20,7 +20,8 @@ Most functions in :mod:`gfminer <bbcflib.gfminer>` take one or more lists of :fu
 
 __all__ = ['gfminerGroup']
 
-import os, sys
+import os, sys, shutil, tempfile
+from multiprocessing import Pool
 from bbcflib.track import track
 from bbcflib.common import unique_filename_in
 
@@ -50,6 +51,16 @@ def run(**kwargs):
     :param output: (str) a filename or a directory to write the results into.
     :param assembly: (str) a genome assembly identifier if needed.
     :param chromosome: (str) a chromosome name if operation must be restricted to a single chromsome.
+    :param read_selection: (dict or list of dicts) filter applied to all input tracks
+        (see `bbcflib.track.compile_selection`), pushed down into the tracks' `read`.
+    :param read_fields: (list of str) fields to read from all input tracks.
+    :param explain: (bool) print the execution plan of each call (see `bbcflib.gfminer.plan`). [False]
+    :param processes: (int) number of worker processes among which chromosomes are
+        distributed, largest first (see `parallel_run`). Each one writes to temporary files
+        that are assembled in chromosome order at the end. Ignored for genome-wide operations. [1]
+    :param cache: (str or `bbcflib.gfminer.cache.ResultCache`) a cache directory: if the same
+        operation was already run with the same arguments on the same input files, its stored
+        output is linked into place instead of being recomputed. [None]
     :param ...: additional parameters passed to `operation`.
 
     Example::
@@ -59,12 +70,14 @@ def run(**kwargs):
             trackScores="density_file.sql", trackFeatures="genes.sql")
     """
     from bbcflib import genrep
+    from bbcflib.gfminer import plan
     def _map(fct):
         for module in _module_list:
             __import__(_here+module)
             smod = sys.modules[_here+module]
             if hasattr(getattr(smod, module)(),fct): return module
         return None
+    _kwargs = dict((k,v) for k,v in kwargs.iteritems() if k != 'cache')
     funct = kwargs.pop("operation",'None')
     module = _map(funct)
     if module is None:
@@ -81,6 +94,9 @@ def run(**kwargs):
     trackSet = {}
     for targ in getattr(smod, module)().loadable(funct):
         trackSet[targ] = [track(t) for t in kwargs[targ].split(",")]
+    def _close():
+        for tracks in trackSet.itervalues():
+            for t in tracks: t.close()
     assembly = None
     if 'assembly' in kwargs:
         assembly = kwargs.pop('assembly')
@@ -88,28 +104,103 @@ def run(**kwargs):
         chrmeta = genrep.Assembly(assembly).chrmeta
     else:
         chrmeta = trackSet[targ][0].chrmeta
-        if 'chromosome' in kwargs:
-            chrom = kwargs.pop('chromosome')
-            chrmeta = {chrom: chrmeta.get(chrom,{})}
+    if 'chromosome' in kwargs:
+        chrom = kwargs.pop('chromosome')
+        chrmeta = {chrom: chrmeta.get(chrom,{})}
     chr = chrmeta.keys()[0]
     info = None
     if 'datatype' in kwargs: info = {'datatype': kwargs.pop('datatype')}
+    read_selection = kwargs.pop('read_selection',None)
+    read_fields = kwargs.pop('read_fields',None)
+    explain = kwargs.pop('explain',False)
+    processes = int(kwargs.pop('processes',1) or 1)
+    cache = kwargs.pop('cache',None)
+    if cache:
+        from bbcflib.gfminer.cache import ResultCache
+        if not isinstance(cache,ResultCache): cache = ResultCache(cache)
+        params = dict((k,v) for k,v in kwargs.iteritems() if not(k in trackSet))
+        params.update(chrmeta=chrmeta, info=info, format=format,
+                      read_selection=read_selection, read_fields=read_fields)
+        key = cache.key(funct, params, dict((targ,kwargs[targ].split(",")) for targ in trackSet))
+        _close() # inputs were only needed for chrmeta: a miss reopens them below
+        files = cache.get(key, output, format)
+        if files is None:
+            n = 0
+            cache.detach(output)
+            while os.path.exists(_output_name(output,format,n)):
+                cache.detach(_output_name(output,format,n))
+                n += 1
+            files = run(**dict(_kwargs, output=output))
+            cache.put(key, files)
+        return files
+    if processes > 1 and len(chrmeta) > 1 \
+            and not(funct in getattr(smod,'_genomewide',[])):
+        tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output)))
+        try:
+            jobs = [dict(kwargs, operation=funct, chromosome=chrom,
+                         output=os.path.join(tmpdir,"%i.sql"%n),
+                         read_selection=read_selection, read_fields=read_fields, explain=explain)
+                    for n,chrom in enumerate(chrmeta)]
+            sizes = [chrmeta[chrom].get('length',0) for chrom in chrmeta]
+            _close()
+            results = parallel_run(jobs, processes=processes, sizes=sizes)
+            if isinstance(results[0],list):
+                files = [_output_name(output,format,n) for n in range(len(results[0]))]
+            else:
+                files = output
+                results = [[r] for r in results]
+            for n,outf in enumerate(files if isinstance(files,list) else [files]):
+                out = None
+                for chrom,res in zip(chrmeta,results):
+                    tmp = track(res[n])
+                    if out is None:
+                        out = track(outf,chrmeta=chrmeta,fields=['chr']+tmp.fields,info=info)
+                    if out.format == 'sql': # table copied within sqlite
+                        out.write(tmp,chrom=chrom)
+                    else:
+                        out.write(tmp.read(selection=chrom),chrom=chrom)
+                    tmp.close()
+                out.close()
+        finally:
+            shutil.rmtree(tmpdir)
+        return files
+    params = dict((k,v) for k,v in kwargs.iteritems() if not(k in trackSet))
+    def _execute(selection):
+        inputs = dict((targ,[plan.Select(plan.Read(t,selection),read_fields,read_selection)
+                             for t in tracks])
+                      for targ,tracks in trackSet.iteritems())
+        node = plan.optimize(plan.Apply(getattr(smod, funct),inputs,params))
+        if explain: print node.explain()
+        return node.execute()
     files = None
-    for targ in getattr(smod, module)().loadable(funct):
-        kwargs[targ] = [t.read(selection=chr) for t in trackSet[targ]]
-    funct_output = getattr(smod, funct)(**kwargs)
+    if funct in getattr(smod,'_genomewide',[]):
+        # single call on streams spanning all chromosomes, read in a fixed order
+        chrnames = sorted(chrmeta)
+        if funct == 'overlap_genome': params.setdefault('chrnames',chrnames)
+        funct_output = _execute(chrnames)
+        if isinstance(funct_output,list):
+            files = []
+            for n,stream in enumerate(funct_output):
+                outf = _output_name(output,format,n)
+                files.append(outf)
+                track(outf,chrmeta=chrmeta,fields=stream.fields,info=info).write(stream)
+        else:
+            files = output
+            track(files,chrmeta=chrmeta,fields=funct_output.fields,
+                  info=info).write(funct_output)
+        _close()
+        return files
+    funct_output = _execute(chr)
     if isinstance(funct_output,list):
         files = []
         for n,stream in enumerate(funct_output):
-            outf = "%s_%i.%s" %(output.strip(format),n,format)
+            outf = _output_name(output,format,n)
             files.append(outf)
             fields = stream.fields
             track(outf,chrmeta=chrmeta,fields=fields,
                   info=info).write(stream,chrom=chr)
         for chr in chrmeta.keys()[1:]:
-            for targ in getattr(smod, module)().loadable(funct):
-                kwargs[targ] = [t.read(selection=chr) for t in trackSet[targ]]
-            funct_output = getattr(smod, funct)(**kwargs)
+            funct_output = _execute(chr)
             for n,stream in enumerate(funct_output):
                 track(files[n],chrmeta=chrmeta).write(stream,chrom=chr,mode='append')
     else:
@@ -118,9 +209,44 @@ def run(**kwargs):
         track(files,chrmeta=chrmeta,fields=fields,
               info=info).write(funct_output,chrom=chr)
         for chr in chrmeta.keys()[1:]:
-            for targ in getattr(smod, module)().loadable(funct):
-                kwargs[targ] = [t.read(selection=chr) for t in trackSet[targ]]
-            funct_output = getattr(smod, funct)(**kwargs)
+            funct_output = _execute(chr)
             track(files,chrmeta=chrmeta).write(funct_output,chrom=chr,mode='append')
+    _close()
     return files
 
+def _output_name(output, format, n):
+    """Name of the *n*-th output file of `run` for operations returning several streams."""
+    return "%s_%i.%s" %(output.strip(format),n,format)
+
+def _run_job(job):
+    return run(**job)
+
+def parallel_run(jobs, processes=None, sizes=None):
+    """
+    Executes several calls to `run` in a pool of worker processes. Each worker opens
+    its own tracks, so that jobs must not write to the same output.
+
+    :param jobs: (list of dict) keyword arguments of each call to `run`,
+        typically the same operation restricted to different chromosomes.
+    :param processes: (int) number of worker processes, the number of CPUs if None.
+        With a single process, jobs are run in the current process. [None]
+    :param sizes: (list of int) estimated size of each job (e.g. the chromosome length);
+        jobs are dispatched largest first to balance the load. [None]
+    :rtype: list of the values returned by `run`, in the order of *jobs*.
+    """
+    order = range(len(jobs))
+    if sizes is not None:
+        order.sort(key=lambda n: sizes[n], reverse=True)
+    if processes == 1:
+        results = [_run_job(jobs[n]) for n in order]
+    else:
+        pool = Pool(processes)
+        try:
+            results = pool.map(_run_job, [jobs[n] for n in order], chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    output = [None]*len(jobs)
+    for n,res in zip(order,results):
+        output[n] = res
+    return output
@@ -17,13 +17,24 @@ Each individual tool has its own call, like::
 
 with obligatory arguments *bedfile* and *files* (see the BedTools `documentation <http://code.google.com/p/bedtools/wiki/Usage>`_), and any additional optional arguments via `**kw`.
 If *wait* is True, then the function will wait for completion and return the output filename, otherwise it runs a nonblocking job (with the parameter *via*) and returns a tuple (bein.Future, filename).
+
+To avoid writing the output to a file, :func:`bedtools_stream` runs a tool in a subprocess and
+parses its standard output on the fly into a :func:`FeatureStream <bbcflib.track.FeatureStream>`.
+Its inputs can themselves be streams, fed to the tool through its standard input or named pipes::
+
+    s = bedtools_stream("intersect", {"a": track("peaks.bed").read(), "b": "genes.bed", "u": True})
+    s = bedtools_stream("intersect", {"a": track("peaks.sql"), "b": "genes.bed", "u": True})
 """
 
+import os, sys, shutil, subprocess, tempfile, threading
 from bein import *
 from bbcflib.common import unique_filename_in
+from bbcflib.track import track, Track, FeatureStream, int_to_strand
+from bbcflib.track.text import _in_types
 
-@program
-def bedtools(tool, args=None):
+def _arguments(args):
+    """Command-line options from a string, a list or a dictionary (see `bedtools`).
+    In a dictionary, a value True stands for a flag without argument."""
     if args is None: args = []
     if isinstance(args,basestring):
         args = args.split()
@@ -32,10 +43,15 @@ def bedtools(tool, args=None):
         for k,v in args.iteritems():
             k = str(k)
             if not(k.startswith("-")): k = "-"+k
+            if v is True: v = []
             if not(isinstance(v,list)): v = [str(v)]
             args2.extend([k]+v)
         args = args2
-    return {"arguments": ["bedtools",tool]+args, "return_value": None}
+    return args
+
+@program
+def bedtools(tool, args=None):
+    return {"arguments": ["bedtools",tool]+_arguments(args), "return_value": None}
 
 def _outfile(kw):
     return kw.pop('outfile',unique_filename_in())
@@ -312,3 +328,181 @@ def windowMaker(ex,bedfile=None,genomefile=None,wait=True,via='local',**kw):
         raise ValueError("Need either a bed or a genome in windowMaker.")
     return _wait(wait,outfile,
                  bedtools.nonblocking(ex,"makewindows",kw,via=via,stdout=outfile))
+
+###############################################################################
+_bed_fields = ['chr','start','end','name','score','strand',
+               'thick_start','thick_end','item_rgb',
+               'block_count','block_sizes','block_starts']
+
+_out_int = ['count','covered','length','overlap','distance']
+
+def _output_fields(tool, opts, inputs):
+    """
+    Guess the fields of the output of bedtools *tool*, given its options *opts*
+    (a dict with keys such as '-a') and the fields of its inputs *inputs*
+    (a dict with the same keys). Returns None if unknown.
+    """
+    from bbcflib.gfminer.stream.bedtools import _b_fields
+    a = inputs.get('-a') or inputs.get('-i')
+    b = inputs.get('-b')
+    def _columns(fields, default):
+        c = opts.get('-c',default)
+        return [fields[int(n)-1] if n.isdigit() and fields and int(n) <= len(fields) else 'column%s'%n
+                for n in str(c).split(',')]
+    if a is None: return None
+    if tool in ['slop','flank','sort','shift']: return a
+    if tool == 'complement': return ['chr','start','end']
+    if tool == 'merge':
+        return ['chr','start','end']+(_columns(a,None) if '-c' in opts else [])
+    if b is None: return None
+    bfields = _b_fields(a,b)
+    if tool == 'intersect':
+        if '-c' in opts: return a+['count']
+        if '-u' in opts or '-v' in opts: return a
+        if '-wo' in opts or '-wao' in opts: return a+bfields+['overlap']
+        if '-wb' in opts: return a+bfields
+        return a
+    if tool == 'closest':
+        return a+bfields+(['distance'] if ('-d' in opts or '-D' in opts) else [])
+    if tool == 'coverage' and not('-hist' in opts or '-d' in opts):
+        return a+['count','covered','length','fraction']
+    if tool == 'map':
+        return a+_b_fields(a,_columns(b,5))
+    return None
+
+def _parser(fields):
+    """Function converting a line of text output into a tuple of typed values for *fields*."""
+    types = []
+    for f in fields:
+        f0 = f[:-2] if f.endswith('_b') else f
+        types.append(int if f0 in _out_int else (float if f0 == 'fraction' else _in_types.get(f0,str)))
+    def _convert(t,v):
+        try: return t(v)
+        except ValueError: return v
+    return lambda line: tuple(_convert(t,v) for t,v in zip(types,line.rstrip("\r\n").split("\t")))
+
+def _bed_layout(fields):
+    """Columns written by `_feed` for a stream with *fields*: 'chr', 'start', 'end', then if it
+    has any other field, 'name', 'score' and 'strand' (BED6), then its remaining fields."""
+    if all(f in _bed_fields[:3] for f in fields): return _bed_fields[:3]
+    return _bed_fields[:6]+[f for f in fields if not(f in _bed_fields[:6])]
+
+def _feed(source, handle, errors):
+    """Write *source* (a FeatureStream, or a Track read here) as bed lines in the layout of
+    `_bed_layout` to the file object returned by *handle()*, filling missing name, score and
+    strand columns with '.', 0 and '.'. A Track is reopened, so that its sqlite connection
+    belongs to this thread. Exceptions are appended to *errors* as ``sys.exc_info()``."""
+    from bbcflib.gfminer.common import _reopen
+    missing = {'name': '.', 'score': '0', 'strand': '.'}
+    opened = None
+    out = None
+    try:
+        out = handle()
+        if isinstance(source,Track):
+            opened = _reopen(source)
+            source = opened.read()
+        layout = _bed_layout(source.fields)
+        idxs = [source.fields.index(f) if f in source.fields else None for f in layout]
+        fmt = [int_to_strand if f == 'strand' else str for f in layout]
+        for x in source:
+            line = "\t".join(missing[f] if i is None else t(x[i]) for f,i,t in zip(layout,idxs,fmt))
+            try:
+                out.write(line+"\n")
+            except IOError: # the reader quit
+                return
+    except Exception:
+        errors.append(sys.exc_info())
+    finally:
+        if out is not None:
+            try: out.close()
+            except IOError: pass
+        if opened is not None: opened.close()
+
+def bedtools_stream(tool, args=None, fields=None):
+    """
+    Runs bedtools *tool* in a subprocess, and returns its output as a FeatureStream,
+    parsed while the tool writes it (no output file is created).
+
+    :param tool: (str) the bedtools command, e.g. 'intersect'.
+    :param args: (dict) command-line options, e.g. ``{'a': 'peaks.bed', 'b': stream, 'wb': True}``,
+        where True stands for a flag. Input file names can be replaced by FeatureStream or `Track`
+        objects: the first one is passed through the tool's standard input, the others through
+        named pipes, written by background threads as bed lines (BED6 columns 'name', 'score',
+        'strand' if the stream has any field besides 'chr', 'start', 'end', then its other fields).
+        A stream read from an sqlite `Track` cannot be iterated by another thread: give the
+        Track itself, it is then reopened and read by the writing thread.
+    :param fields: (list of str) the output fields. By default they are guessed from the tool,
+        the options and the input fields (file names are opened with `track`), or else
+        named after the bed format from the number of columns of the first line.
+    :rtype: FeatureStream
+    """
+    opts = {}
+    for k,v in (args or {}).iteritems():
+        k = str(k)
+        opts[k if k.startswith("-") else "-"+k] = v
+    inputs = {}
+    feeds = []
+    tmpdir = None
+    def _input(key, v):
+        if isinstance(v,(FeatureStream,Track)):
+            inputs.setdefault(key, _bed_layout(v.fields))
+            if not any(h is None for _,h in feeds):
+                feeds.append((v,None))
+                return "stdin"
+            fifo = os.path.join(tmpdir,"input%i"%len(feeds))
+            os.mkfifo(fifo)
+            feeds.append((v,fifo))
+            return fifo
+        if isinstance(v,basestring) and key in ['-a','-b','-i'] and os.path.exists(v) \
+                and not(v.endswith('.bam')):
+            inputs.setdefault(key, track(v).fields)
+        return v
+    try:
+        if any(isinstance(v,(FeatureStream,Track)) or
+               (isinstance(v,list) and any(isinstance(x,(FeatureStream,Track)) for x in v))
+               for v in opts.itervalues()):
+            tmpdir = tempfile.mkdtemp()
+        for k,v in opts.items():
+            opts[k] = [_input(k,x) for x in v] if isinstance(v,list) else _input(k,v)
+        if fields is None:
+            fields = _output_fields(tool, opts, inputs)
+        stderr = tempfile.TemporaryFile()
+        proc = subprocess.Popen(["bedtools",tool]+_arguments(opts), stdout=subprocess.PIPE,
+                                stdin=subprocess.PIPE if feeds else None, stderr=stderr)
+    except:
+        if tmpdir: shutil.rmtree(tmpdir)
+        raise
+    errors = []
+    feeders = []
+    for stream,fifo in feeds:
+        if fifo is None:
+            handle = lambda: proc.stdin
+        else:
+            handle = lambda fifo=fifo: open(fifo,'w')
+        th = threading.Thread(target=_feed, args=(stream,handle,errors))
+        th.daemon = True
+        th.start()
+        feeders.append(th)
+    if proc.stdin and not any(f is None for _,f in feeds): proc.stdin.close()
+    first = None
+    if fields is None:
+        first = proc.stdout.readline()
+        n = len(first.split("\t")) if first else 3
+        fields = _bed_fields[:n]+['column%i'%(k+1) for k in range(len(_bed_fields),n)]
+    parse = _parser(fields)
+    def _generate():
+        try:
+            if first: yield parse(first)
+            for line in proc.stdout:
+                if line.strip(): yield parse(line)
+            for th in feeders: th.join()
+            if errors: raise errors[0][0], errors[0][1], errors[0][2]
+            if proc.wait():
+                stderr.seek(0)
+                raise IOError("bedtools %s failed: %s" %(tool,stderr.read().strip()))
+        finally:
+            if proc.poll() is None: proc.kill()
+            proc.stdout.close()
+            stderr.close()
+            if tmpdir: shutil.rmtree(tmpdir)
+    return FeatureStream(_generate(), fields=fields)
@@ -0,0 +1,191 @@
+"""
+Cache of the results of `bbcflib.gfminer.run`. A result is stored under a key computed
+from the operation name, its (canonicalized) arguments and a fingerprint of each input file,
+so that rerunning the same operation on the same inputs only links the stored files
+into place::
+
+    from bbcflib.gfminer import run
+    from bbcflib.gfminer.cache import ResultCache
+    cache = ResultCache("/scratch/gfminer_cache", max_size=50*2**30)
+    run(operation="score_by_feature", output="scores.bed", cache=cache,
+        trackScores="density_file.sql", trackFeatures="genes.sql")
+    print cache.stats()
+
+Input files are fingerprinted by path, size and modification time, or by a hash of their
+content if *content_hash* is True (slower, but survives copies and touched files).
+When the cache exceeds *max_size* bytes, the least recently used results are removed.
+"""
+
+__all__ = ['ResultCache']
+
+import os, shutil, hashlib, cPickle
+from bbcflib.gfminer import _output_name
+
+def _canonical(obj):
+    """Representation of *obj* that does not depend on the order of dict items."""
+    if isinstance(obj,dict):
+        return "{%s}" % ",".join("%s:%s" % (_canonical(k),_canonical(obj[k])) for k in sorted(obj))
+    if isinstance(obj,(list,tuple)):
+        brackets = "[]" if isinstance(obj,list) else "()"
+        return brackets[0]+",".join(_canonical(x) for x in obj)+brackets[1]
+    if isinstance(obj,unicode):
+        obj = obj.encode('utf-8')
+    return repr(obj)
+
+class ResultCache(object):
+    """
+    Directory *path* storing the output files of `bbcflib.gfminer.run` calls.
+
+    :param path: (str) the cache directory, created if necessary.
+    :param max_size: (int) maximum total size of the cached files, in bytes,
+        or None for no limit. [None]
+    :param content_hash: (bool) fingerprint input files by their content rather than
+        by path, size and modification time. [False]
+    :param link: (bool) hardlink files in and out of the cache when possible, rather than
+        copying them. Linked outputs must then not be modified in place. [True]
+    """
+    def __init__(self, path, max_size=None, content_hash=False, link=True):
+        self.path = path
+        self.max_size = max_size
+        self.content_hash = content_hash
+        self.link = link
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def fingerprint(self, path):
+        """Return a string identifying the content of file *path*."""
+        if self.content_hash:
+            digest = hashlib.sha1()
+            with open(path,'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), ''):
+                    digest.update(block)
+            return digest.hexdigest()
+        st = os.stat(path)
+        return "%s:%i:%r" % (os.path.abspath(path),st.st_size,st.st_mtime)
+
+    def key(self, operation, params, inputs):
+        """
+        Return the key of a call to *operation* with arguments *params*
+        on the input files *inputs*.
+
+        :param operation: (str) the operation name.
+        :param params: (dict) its arguments, other than the input files.
+        :param inputs: (dict) lists of input file names, by argument name.
+        """
+        inputs = dict((k,[self.fingerprint(f) for f in files]) for k,files in inputs.iteritems())
+        return hashlib.sha1(_canonical([operation,params,inputs])).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.path,key)
+
+    def _place(self, source, target):
+        if os.path.exists(target): os.remove(target)
+        if self.link:
+            try:
+                os.link(source,target)
+                return
+            except OSError:
+                pass
+        shutil.copy2(source,target)
+
+    def detach(self, path):
+        """If file *path* is hardlinked (e.g. into the cache), replace it with a copy,
+        so that it can be modified without altering the cached result."""
+        if os.path.exists(path) and os.stat(path).st_nlink > 1:
+            tmp = path+".%i.tmp" % os.getpid()
+            shutil.copy2(path,tmp)
+            os.rename(tmp,path)
+
+    def _count(self, event):
+        stats = self._read_stats()
+        stats[event] += 1
+        with open(os.path.join(self.path,'stats'),'wb') as f:
+            cPickle.dump(stats, f, cPickle.HIGHEST_PROTOCOL)
+
+    def _read_stats(self):
+        try:
+            with open(os.path.join(self.path,'stats'),'rb') as f:
+                return cPickle.load(f)
+        except (IOError, EOFError):
+            return {'hits': 0, 'misses': 0}
+
+    def _entries(self):
+        return [e for e in os.listdir(self.path)
+                if os.path.exists(os.path.join(self.path,e,'entry'))]
+
+    def get(self, key, output, format):
+        """
+        If a result is stored under *key*, place its files at *output* and return
+        the output file name(s) as `run` would, otherwise return None.
+
+        :param output: (str) output file name given to `run`.
+        :param format: (str) output format, used to name the files of operations
+            returning several streams.
+        """
+        entry = self._entry(key)
+        try:
+            with open(os.path.join(entry,'entry'),'rb') as f:
+                multiple, names = cPickle.load(f)
+        except IOError:
+            self._count('misses')
+            return None
+        if multiple:
+            files = [_output_name(output,format,n) for n in range(len(names))]
+        else:
+            files = [output]
+        for name,target in zip(names,files):
+            self._place(os.path.join(entry,name),target)
+        os.utime(os.path.join(entry,'entry'),None)
+        self._count('hits')
+        return files if multiple else files[0]
+
+    def put(self, key, files):
+        """Store the output file name(s) *files* returned by `run` under *key*."""
+        multiple = isinstance(files,list)
+        if not multiple: files = [files]
+        entry = self._entry(key)
+        tmp = entry+".%i.tmp" % os.getpid()
+        if os.path.exists(tmp): shutil.rmtree(tmp)
+        os.mkdir(tmp)
+        names = ["%i_%s" % (n,os.path.basename(f)) for n,f in enumerate(files)]
+        for name,f in zip(names,files):
+            self._place(f,os.path.join(tmp,name))
+        with open(os.path.join(tmp,'entry'),'wb') as f:
+            cPickle.dump((multiple,names), f, cPickle.HIGHEST_PROTOCOL)
+        if os.path.exists(entry): shutil.rmtree(entry)
+        os.rename(tmp,entry)
+        self.evict()
+
+    def _size(self, entry):
+        entry = self._entry(entry)
+        return sum(os.path.getsize(os.path.join(entry,f)) for f in os.listdir(entry))
+
+    def evict(self, max_size=None):
+        """Remove the least recently used results until the cache holds at most
+        *max_size* bytes (the cache's *max_size* by default)."""
+        if max_size is None: max_size = self.max_size
+        if max_size is None: return
+        entries = [(os.path.getmtime(os.path.join(self.path,e,'entry')),e) for e in self._entries()]
+        entries.sort()
+        sizes = dict((e,self._size(e)) for _,e in entries)
+        total = sum(sizes.values())
+        for _,e in entries:
+            if total <= max_size: break
+            shutil.rmtree(self._entry(e))
+            total -= sizes[e]
+
+    def clear(self):
+        """Remove all results and reset the statistics."""
+        for e in self._entries():
+            shutil.rmtree(self._entry(e))
+        if os.path.exists(os.path.join(self.path,'stats')):
+            os.remove(os.path.join(self.path,'stats'))
+
+    def stats(self):
+        """Return a dict with the number of cache 'hits' and 'misses' so far,
+        the number of stored results ('entries') and their total 'size' in bytes."""
+        stats = self._read_stats()
+        entries = self._entries()
+        stats['entries'] = len(entries)
+        stats['size'] = sum(self._size(e) for e in entries)
+        return stats
@@ -1,8 +1,11 @@
-from bbcflib.track import FeatureStream
+from bbcflib.track import FeatureStream, Track, track, compile_selection
 from functools import wraps
-import sys, re, itertools, operator, random, string
+import sys, re, itertools, operator, random, string, cPickle, threading, Queue
 from numpy import log as nlog
 from numpy import asarray,mean,median,exp,nonzero,prod,around,argsort,float_
+from numpy import zeros,empty,unique,maximum,minimum,cumsum,searchsorted,int64,lexsort,arange,bincount
+from numpy import concatenate as nconcatenate
+from numpy.random import RandomState
 
 ####################################################################
 def ordered(fn):
@@ -33,12 +36,28 @@ def ordered(fn):
         else:
             new_fields = [r.fields for r in returned]
             nl = len(original_fields)
-            original_fields = [[f for f in original_fields[min(n,nl)] if f in nf]
+            original_fields = [[f for f in original_fields[min(n,nl-1)] if f in nf]
                                for n,nf in enumerate(new_fields)]
             return [reorder(r, fields=original_fields[n]) for n,r in enumerate(returned)]
 
     return wrapper
 
+####################################################################
+def getter(idxs):
+    """Return a function extracting the elements at positions *idxs* of a feature,
+    always as a tuple. To be built once per stream, then applied to every item.
+
+    :param idxs: (list of int) positions of the elements to extract.
+    :rtype: function
+    """
+    idxs = list(idxs)
+    if len(idxs) == 0:
+        return lambda x: ()
+    if len(idxs) == 1:
+        i = idxs[0]
+        return lambda x: (x[i],)
+    return operator.itemgetter(*idxs)
+
 ####################################################################
 def sentinelize(stream, sentinel=sys.maxint):
     """Append *sentinel* at the end of *iterable* (avoid StopIteration error)."""
@@ -79,20 +98,15 @@ def select(stream, fields=None, selection={}):
     :rtype: FeatureStream, or list of FeatureStream objects.
     """
     def _select(stream,idxs):
+        _get = getter(idxs)
         if selection:
-            sel = dict([(stream.fields.index(f),val) for f,val in selection.iteritems()])
+            _sel = dict((f,list(v) if isinstance(v,tuple) else v) for f,v in selection.iteritems())
+            _pass = compile_selection(_sel, stream.fields)
             for x in stream:
-                for k,val in sel.iteritems():
-                    if isinstance(val,(list,tuple)):
-                        if not x[k] in val: continue
-                    elif hasattr(val,'__call__'):
-                        if not val(x[k]): continue
-                    else:
-                        if not x[k] == val: continue
-                    yield tuple([x[i] for i in idxs])
+                if _pass(x): yield _get(x)
         else:
             for x in stream:
-                yield tuple([x[i] for i in idxs])
+                yield _get(x)
 
     if not fields: fields=stream.fields
     idxs = [stream.fields.index(f) for f in fields]
@@ -120,7 +134,8 @@ def reorder(stream,fields,last=False):
     else:
         _inds = [stream.fields.index(f) for f in fields]+[n for n,f in enumerate(stream.fields) if f not in fields]
     _flds = [stream.fields[n] for n in _inds]
-    return FeatureStream((tuple(x[n] for n in _inds) for x in stream), fields=_flds)
+    _get = getter(_inds)
+    return FeatureStream((_get(x) for x in stream), fields=_flds)
 
 ####################################################################
 def apply(stream,fields,functions):
@@ -133,12 +148,11 @@ def apply(stream,fields,functions):
     :rtype: FeatureStream, or list of FeatureStream objects
     """
     def _apply(stream,fields,functions):
-        nf = len(stream.fields)
-        idx = [stream.fields.index(f) for f in fields]
-        fct = dict(zip(idx,functions))
-        for i in range(nf): fct.setdefault(i, lambda x:x)
+        fct = zip([stream.fields.index(f) for f in fields],functions)
         for x in stream:
-            yield tuple([fct[i](x[i]) for i in range(nf)])
+            y = list(x)
+            for i,fn in fct: y[i] = fn(y[i])
+            yield tuple(y)
 
     if isinstance(fields,str): fields = [fields]
     if hasattr(functions,'__call__'): functions = [functions]
@@ -191,13 +205,15 @@ def concat_fields( stream, infields, outfield='name', separator='|', as_tuple=Fa
         to_extend = [None]
     out_indx = _infields.index(outfield)
     in_indx = [stream.fields.index(f) for f in infields]
+    _get_out = getter(in_out_indx)
+    _get_in = getter(in_indx)
     def _concat(stream):
         for x in stream:
-            y = [x[i] for i in in_out_indx]+to_extend
+            y = list(_get_out(x))+to_extend
             if as_tuple:
-                y[out_indx] = tuple((x[i] for i in in_indx))
+                y[out_indx] = _get_in(x)
             else:
-                y[out_indx] = separator.join([str(x[i]) for i in in_indx])
+                y[out_indx] = separator.join([str(v) for v in _get_in(x)])
             yield tuple(y)
     return FeatureStream(_concat(stream),_infields)
 
@@ -365,6 +381,109 @@ def unroll( stream, regions, fields=['score'] ):
                 pos+=1
     return FeatureStream(_unr(s),fields=s.fields[nf:])
 
+####################################################################
+def _region_list(regions):
+    """Return *regions* (see `unroll_array`) as a list of (chr, start, end) tuples,
+    where chr is None if chromosomes are not specified."""
+    if isinstance(regions,FeatureStream):
+        si = regions.fields.index('start')
+        ei = regions.fields.index('end')
+        ci = regions.fields.index('chr') if 'chr' in regions.fields else None
+        return [(x[ci] if ci is not None else None, x[si], x[ei]) for x in regions]
+    if isinstance(regions,(list,tuple)):
+        if not isinstance(regions[0],(list,tuple)): regions = [regions]
+        if len(regions[0]) > 2: return [tuple(r[:3]) for r in regions]
+        return [(None,)+tuple(r[:2]) for r in regions]
+    raise ValueError("regions: Expected tuple or FeatureStream, got %s." % type(regions))
+
+def unroll_array( stream, regions, field='score', default=0, dtype=float_ ):
+    """Returns a numpy array with one element per base position in *regions*, containing
+    the *field* value of the feature of *stream* covering it (*default* elsewhere).
+    The array is allocated once and filled by slices, one per feature, so that time and
+    memory do not depend on the number of base positions. Equivalent to, but much faster than::
+
+        numpy.array([x[0] for x in unroll(stream,regions,fields=[field])])
+
+    For example, ``unroll_array([(10,12,0.5), (14,15,1.2)], regions=(9,16))`` returns::
+
+        array([0., 0.5, 0.5, 0., 0., 1.2, 0.])
+              9   10   11   12  13  14   15
+
+    :param stream: FeatureStream object, sorted w.r.t. 'chr' (if any), 'start' and 'end'.
+    :param regions: either a pair (start,end) or an ordered list of such pairs (or of triples
+        (chr,start,end)) or a FeatureStream interpreted as bounds of the region(s) to return.
+        Several regions are concatenated in the output.
+    :param field: (str) name of the field to report. ['score']
+    :param default: value for positions not covered by any feature. [0]
+    :param dtype: numpy type of the array elements. [numpy.float_]
+    :rtype: numpy.ndarray
+    """
+    regions = _region_list(regions)
+    with_chrom = regions[0][0] is not None and 'chr' in stream.fields
+    _f = ['start','end',field]
+    if with_chrom: _f.append('chr')
+    s = reorder(stream,_f)
+    result = zeros(sum(r[2]-r[1] for r in regions), dtype=dtype)
+    if default: result[:] = default
+    last_region = dict((r[0],n) for n,r in enumerate(regions)) # last region index for each chr
+    x = next(s,None)
+    offset = 0
+    for n,(chrom,rstart,rend) in enumerate(regions):
+        while x is not None:
+            if with_chrom and x[3] != chrom:
+                if last_region.get(x[3],-1) > n: break # keep it for a later region
+                x = next(s,None)
+                continue
+            if x[1] <= rstart:
+                x = next(s,None)
+                continue
+            if x[0] >= rend: break
+            result[offset+max(x[0],rstart)-rstart : offset+min(x[1],rend)-rstart] = x[2]
+            if x[1] > rend: break
+            x = next(s,None)
+        offset += rend-rstart
+    return result
+
+def _unroll_blocks( stream, regions, block_size, field='score', dtype=float_ ):
+    """Same as `unroll_array` (with *default* 0), but yields the array by consecutive
+    blocks of *block_size* positions (the last one may be shorter), so that the whole
+    array is never held in memory."""
+    regions = _region_list(regions)
+    with_chrom = regions[0][0] is not None and 'chr' in stream.fields
+    _f = ['start','end',field]
+    if with_chrom: _f.append('chr')
+    s = reorder(stream,_f)
+    total = sum(r[2]-r[1] for r in regions)
+    if total <= 0: return
+    last_region = dict((r[0],n) for n,r in enumerate(regions))
+    x = next(s,None)
+    block = zeros(min(block_size,total), dtype=dtype)
+    boffset = 0 # start of the block in the concatenated regions
+    offset = 0  # start of the current region in the concatenated regions
+    for n,(chrom,rstart,rend) in enumerate(regions):
+        pstart = rstart
+        while pstart < rend:
+            bi = offset+pstart-rstart-boffset
+            pend = min(rend, pstart+len(block)-bi)
+            while x is not None:
+                if with_chrom and x[3] != chrom:
+                    if last_region.get(x[3],-1) > n: break
+                    x = next(s,None)
+                    continue
+                if x[1] <= pstart:
+                    x = next(s,None)
+                    continue
+                if x[0] >= pend: break
+                block[bi+max(x[0],pstart)-pstart : bi+min(x[1],pend)-pstart] = x[2]
+                if x[1] > pend: break
+                x = next(s,None)
+            if bi+pend-pstart == len(block):
+                yield block
+                boffset += len(block)
+                if boffset < total: block = zeros(min(block_size,total-boffset), dtype=dtype)
+            pstart = pend
+        offset += rend-rstart
+
 ####################################################################
 def sorted_stream(stream,chrnames=[],fields=['chr','start','end'],reverse=False):
     """Sorts a stream according to *fields* values. Will load the entire stream in memory.
@@ -390,33 +509,560 @@ def sorted_stream(stream,chrnames=[],fields=['chr','start','end'],reverse=False)
     return FeatureStream((feature_list[t[-1]] for t in sort_list), stream.fields)
 
 ####################################################################
+def _allowed_territory(chrlen, include=None, exclude=None):
+    """Return two arrays (starts, ends) of the disjoint, sorted intervals of [0, *chrlen*)
+    that are covered by *include* (if not None) and not by *exclude*.
+    *include* and *exclude* are lists of (start,end) pairs."""
+    if include is None:
+        allowed = [[0,chrlen]]
+    else:
+        allowed = []
+        for start,end in sorted(include):
+            start = max(0,start)
+            end = min(chrlen,end)
+            if start >= end: continue
+            if allowed and start <= allowed[-1][1]:
+                allowed[-1][1] = max(allowed[-1][1],end)
+            else:
+                allowed.append([start,end])
+    if exclude:
+        exclude = sorted(exclude)
+        remaining = []
+        k = 0
+        for start,end in allowed:
+            while k < len(exclude) and exclude[k][1] <= start: k+=1
+            j = k
+            while j < len(exclude) and exclude[j][0] < end:
+                if exclude[j][0] > start: remaining.append([start,exclude[j][0]])
+                start = max(start,exclude[j][1])
+                j+=1
+            if start < end: remaining.append([start,end])
+        allowed = remaining
+    starts = asarray([x[0] for x in allowed], dtype=int64)
+    ends = asarray([x[1] for x in allowed], dtype=int64)
+    return starts, ends
+
+def _random_starts(lengths, starts, ends, nrand, rng):
+    """For each feature length in *lengths*, draw *nrand* random start positions such that
+    the feature lies entirely within one of the intervals [*starts*, *ends*), uniformly
+    amongst all possible placements. Returns an array of shape (len(lengths), nrand)."""
+    lengths = asarray(lengths, dtype=int64)
+    result = zeros((len(lengths),nrand), dtype=int64)
+    for flen in unique(lengths):
+        rows = nonzero(lengths == flen)[0]
+        nplaces = maximum(ends-starts-flen+1, 0) # number of possible starts in each interval
+        cumul = cumsum(nplaces)
+        if len(cumul) == 0 or cumul[-1] == 0:
+            raise ValueError("No room to place a feature of length %i." % flen)
+        draws = rng.randint(0, cumul[-1], size=(len(rows),nrand))
+        idx = searchsorted(cumul, draws, side='right')
+        result[rows] = starts[idx] + draws - (cumul[idx]-nplaces[idx])
+    return result
+
 @ordered
-def shuffled(stream, chrlen=sys.maxint, repeat_number=1, sorted=True):
+def shuffled(stream, chrlen=sys.maxint, repeat_number=1, sorted=True,
+             include=None, exclude=None, seed=None, nshuffles=None):
     """Return a stream of randomly located features of the same length and annotation
-    as these of the original stream.
+    as these of the original stream. Positions are drawn uniformly amongst all locations
+    where the whole feature fits in the allowed territory: the regions of *include*
+    (or the whole chromosome) minus the regions of *exclude*.
+    Will load the entire stream in memory.
 
     :param stream: FeatureStream object.
-    :param chrlen: (int) chromosome length. [9223372036854775807]
+    :param chrlen: (int) chromosome length, or a dict ``{chr: length}`` (or a *chrmeta*
+        dict) if *stream* has a 'chr' field. [9223372036854775807]
     :param repeat_number: (int) *repeat_number* random features are yielded per input feature. [1]
     :param sorted: (bool) whether or not to sort the output stream. [True]
-    :rtype: FeatureStream
+    :param include: (FeatureStream) if given, features are only placed inside these regions.
+    :param exclude: (FeatureStream) regions (e.g. assembly gaps or blacklisted regions)
+        that random features must not overlap.
+    :param seed: (int) seed of the random number generator, for reproducible results.
+    :param nshuffles: (int) if given, return a list of *nshuffles* independent shuffled
+        streams, all drawn in the same pass.
+    :rtype: FeatureStream, or list of FeatureStream objects.
     """
-    import random
     _f = ['start','end']
     features = reorder(stream,_f)
-    def _shuffled(_s):
-        randpos = []
-        for feat in _s:
-            feat_len = feat[1]-feat[0]
-            for s in xrange(repeat_number):
-                if len(randpos) == 0:
-                    randpos = [random.randint(0, chrlen-feat_len) for i in xrange(10000)]
-                start = randpos.pop()
-                yield (start,start+feat_len)+feat[2:]
-    if sorted:
-        return sorted_stream(FeatureStream(_shuffled(features),features.fields),fields=_f)
+    has_chr = 'chr' in features.fields
+
+    def _by_chrom(regions):
+        """Group the (start,end) pairs of *regions* by chromosome (key None if no 'chr' field)."""
+        if regions is None: return None
+        regions = reorder(regions,_f)
+        ci = regions.fields.index('chr') if (has_chr and 'chr' in regions.fields) else None
+        grouped = {}
+        for x in regions:
+            grouped.setdefault(x[ci] if ci is not None else None,[]).append((x[0],x[1]))
+        return grouped
+
+    def _get(grouped,chrom):
+        if grouped is None: return None
+        if None in grouped: return grouped[None]
+        return grouped.get(chrom,[])
+
+    def _length(chrom):
+        if isinstance(chrlen,dict):
+            L = chrlen[chrom]
+            return L['length'] if isinstance(L,dict) else L
+        return chrlen
+
+    rng = RandomState(seed)
+    nout = nshuffles or 1
+    incl = _by_chrom(include)
+    excl = _by_chrom(exclude)
+    feats = list(features)
+    chri = features.fields.index('chr') if has_chr else None
+    chrnames = []
+    bychr = {}
+    for n,x in enumerate(feats):
+        chrom = x[chri] if has_chr else None
+        if not(chrom in bychr):
+            bychr[chrom] = []
+            chrnames.append(chrom)
+        bychr[chrom].append(n)
+    out = [[None]*(len(feats)*repeat_number) for k in range(nout)]
+    for chrom in chrnames:
+        idx = bychr[chrom]
+        starts,ends = _allowed_territory(_length(chrom),_get(incl,chrom),_get(excl,chrom))
+        lengths = [feats[n][1]-feats[n][0] for n in idx]
+        randpos = _random_starts(lengths,starts,ends,nout*repeat_number,rng)
+        for i,n in enumerate(idx):
+            feat = feats[n]
+            for k in range(nout):
+                for r in range(repeat_number):
+                    pos = int(randpos[i,k*repeat_number+r])
+                    out[k][n*repeat_number+r] = (pos,pos+lengths[i])+feat[2:]
+    _sf = ['chr']+_f if has_chr else _f
+    res = []
+    for feat_list in out:
+        s = FeatureStream(feat_list,features.fields)
+        if sorted: s = sorted_stream(s,chrnames=chrnames,fields=_sf)
+        res.append(s)
+    if nshuffles is None: return res[0]
+    return res
+
+####################################################################
+class IntervalIndex(object):
+    """
+    In-memory index of the features of a stream, for repeated overlap, nearest-feature
+    and containment queries. Features are stored, for each chromosome, as a nested
+    containment list (Alekseyenko & Lee, 2007) in numpy arrays: features sorted by start,
+    where features contained in another one are moved to a sub-list of the latter.
+    In each list, ends are then sorted too, so that a query costs O(log n + k) for
+    k features found. Example::
+
+        index = IntervalIndex(genes_stream)
+        index.overlap(1200, 1500, chrom='chr1')  # features overlapping [1200,1500)
+        index.nearest(1200, 1500, chrom='chr1')  # closest features and their distance
+        index.save('genes.idx')
+        index = IntervalIndex.load('genes.idx')
+
+    Queries return the original feature tuples, sorted w.r.t. start and end.
+
+    .. attribute:: fields
+
+        The fields of the indexed stream.
+
+    .. attribute:: chromosomes
+
+        Indexed chromosome names (a single None key if the stream has no 'chr' field).
+    """
+    def __init__(self, stream):
+        self.fields = list(stream.fields)
+        si = stream.fields.index('start')
+        ei = stream.fields.index('end')
+        ci = stream.fields.index('chr') if 'chr' in stream.fields else None
+        rows = {}
+        for x in stream:
+            rows.setdefault(x[ci] if ci is not None else None, []).append(x)
+        self._rows = rows
+        self._lists = {}
+        for chrom,feats in rows.iteritems():
+            self._lists[chrom] = self._build(asarray([x[si] for x in feats], dtype=int64),
+                                             asarray([x[ei] for x in feats], dtype=int64))
+
+    @property
+    def chromosomes(self):
+        return self._rows.keys()
+
+    def __len__(self):
+        return sum(len(x) for x in self._rows.itervalues())
+
+    @staticmethod
+    def _build(starts, ends):
+        """Return a dict of arrays representing the nested containment list of the intervals
+        [*starts*, *ends*). Sub-lists are stored contiguously in a flat layout:
+        'sub_start' and 'sub_end' give the bounds of the sub-list of each interval."""
+        n = len(starts)
+        order = lexsort((-ends,starts)) # by start, then largest first
+        s = starts[order]
+        e = ends[order]
+        parent = zeros(n, dtype=int64)
+        stack = []
+        for i in xrange(n):
+            while stack and e[stack[-1]] < e[i]: stack.pop()
+            parent[i] = stack[-1] if stack else -1
+            stack.append(i)
+        flat = argsort(parent, kind='mergesort') # grouped by parent, sorted by start
+        pos = zeros(n, dtype=int64)
+        pos[flat] = arange(n)
+        counts = bincount(parent+1, minlength=n+1)
+        offsets = cumsum(counts)-counts
+        sub_start = zeros(n, dtype=int64)
+        sub_end = zeros(n, dtype=int64)
+        has_sub = nonzero(counts[1:])[0]
+        sub_start[pos[has_sub]] = offsets[has_sub+1]
+        sub_end[pos[has_sub]] = offsets[has_sub+1]+counts[has_sub+1]
+        by_start = argsort(starts, kind='mergesort')
+        by_end = argsort(ends, kind='mergesort')
+        return {'start': s[flat], 'end': e[flat], 'id': order[flat],
+                'sub_start': sub_start, 'sub_end': sub_end, 'top': counts[0],
+                'by_start': by_start, 'sorted_starts': starts[by_start],
+                'by_end': by_end, 'sorted_ends': ends[by_end]}
+
+    def _select(self, chrom, ids):
+        if len(ids) == 0: return []
+        rows = self._rows[chrom]
+        return [rows[i] for i in sorted(ids)]
+
+    def overlap_ids(self, start, end, chrom=None):
+        """Return the indices (in their chromosome's order of insertion) of the features
+        overlapping [*start*, *end*)."""
+        L = self._lists.get(chrom)
+        if L is None: return []
+        S = L['start']; E = L['end']
+        SS = L['sub_start']; SE = L['sub_end']
+        found = []
+        todo = [(0,L['top'])]
+        while todo:
+            lo,hi = todo.pop()
+            i = lo+searchsorted(E[lo:hi], start, side='right')
+            while i < hi and S[i] < end:
+                found.append(i)
+                if SS[i] < SE[i]: todo.append((SS[i],SE[i]))
+                i+=1
+        return list(L['id'][found])
+
+    def overlap(self, start, end, chrom=None):
+        """Features overlapping [*start*, *end*)."""
+        return self._select(chrom, self.overlap_ids(start,end,chrom))
+
+    def contains(self, start, end, chrom=None):
+        """Features containing the whole interval [*start*, *end*)."""
+        L = self._lists.get(chrom)
+        if L is None: return []
+        S = L['start']; E = L['end']
+        SS = L['sub_start']; SE = L['sub_end']
+        found = []
+        todo = [(0,L['top'])]
+        while todo:
+            lo,hi = todo.pop()
+            # in a list, both starts and ends are sorted: containing features are contiguous
+            i = lo+searchsorted(E[lo:hi], end, side='left')
+            j = lo+searchsorted(S[lo:hi], start, side='right')
+            for k in xrange(i,j):
+                found.append(k)
+                if SS[k] < SE[k]: todo.append((SS[k],SE[k]))
+        return self._select(chrom, L['id'][found])
+
+    def within(self, start, end, chrom=None):
+        """Features entirely contained in [*start*, *end*)."""
+        si = self.fields.index('start')
+        ei = self.fields.index('end')
+        return [x for x in self.overlap(start,end,chrom) if x[si] >= start and x[ei] <= end]
+
+    def nearest(self, start, end, chrom=None):
+        """Return the features closest to [*start*, *end*) and their distance to it:
+        the overlapping features if any (distance 0), otherwise the features ending
+        closest before *start* and/or starting closest after *end*.
+
+        :rtype: tuple (list of features, int). The distance is None if the chromosome is empty.
+        """
+        L = self._lists.get(chrom)
+        if L is None or len(L['id']) == 0: return [],None
+        ids = self.overlap_ids(start,end,chrom)
+        if ids: return self._select(chrom,ids),0
+        sstarts = L['sorted_starts']
+        sends = L['sorted_ends']
+        i = searchsorted(sends, start, side='right')-1 # last end <= start
+        j = searchsorted(sstarts, end, side='left')     # first start >= end
+        dleft = start-sends[i] if i >= 0 else None
+        dright = sstarts[j]-end if j < len(sstarts) else None
+        left = right = []
+        if dleft is not None:
+            i0 = searchsorted(sends, sends[i], side='left')
+            left = list(L['by_end'][i0:i+1])
+        if dright is not None:
+            j1 = searchsorted(sstarts, sstarts[j], side='right')
+            right = list(L['by_start'][j:j1])
+        if dright is None or (dleft is not None and dleft < dright):
+            return self._select(chrom,left),int(dleft)
+        if dleft is None or dright < dleft:
+            return self._select(chrom,right),int(dright)
+        return self._select(chrom,left+right),int(dleft)
+
+    def preceding(self, start, chrom=None, strict=True):
+        """Return the features ending closest before *start*, and the distance
+        from their end to *start*. If *strict* is False, features ending at *start*
+        (book-ended) are included.
+
+        :rtype: tuple (list of features, int). The distance is None if there is no such feature.
+        """
+        L = self._lists.get(chrom)
+        if L is None: return [],None
+        sends = L['sorted_ends']
+        i = searchsorted(sends, start, side='left' if strict else 'right')-1 # last end < start (or <=)
+        if i < 0: return [],None
+        i0 = searchsorted(sends, sends[i], side='left')
+        return self._select(chrom,L['by_end'][i0:i+1]),int(start-sends[i])
+
+    def following(self, end, chrom=None, strict=True):
+        """Return the features starting closest after *end*, and the distance
+        from *end* to their start. If *strict* is False, features starting at *end*
+        (book-ended) are included.
+
+        :rtype: tuple (list of features, int). The distance is None if there is no such feature.
+        """
+        L = self._lists.get(chrom)
+        if L is None: return [],None
+        sstarts = L['sorted_starts']
+        j = searchsorted(sstarts, end, side='right' if strict else 'left') # first start > end (or >=)
+        if j >= len(sstarts): return [],None
+        j1 = searchsorted(sstarts, sstarts[j], side='right')
+        return self._select(chrom,L['by_start'][j:j1]),int(sstarts[j]-end)
+
+    def query(self, stream, method='overlap'):
+        """Bulk query: for each item of the sorted *stream* (which must have fields
+        'start' and 'end', and 'chr' if the index has one), yield a pair
+        ``(item, result)``, where *result* is the result of the given *method*
+        ('overlap', 'contains', 'within' or 'nearest') for this item."""
+        si = stream.fields.index('start')
+        ei = stream.fields.index('end')
+        ci = stream.fields.index('chr') if ('chr' in stream.fields and 'chr' in self.fields) else None
+        fn = getattr(self,method)
+        for x in stream:
+            yield x, fn(x[si], x[ei], x[ci] if ci is not None else None)
+
+    def save(self, path):
+        """Write the index to file *path*, to be reloaded with `IntervalIndex.load`."""
+        with open(path,'wb') as f:
+            cPickle.dump(self.__dict__, f, cPickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        """Return the index saved in file *path* by `save`."""
+        index = cls.__new__(cls)
+        with open(path,'rb') as f:
+            index.__dict__.update(cPickle.load(f))
+        return index
+
+####################################################################
+def _reopen(source):
+    """Open a new `Track` on the file of *source* (a Track or a file name), for use in
+    another thread: sqlite connections can only be used by the thread that created them."""
+    if isinstance(source,Track):
+        return track(source.path, format=source.format, chrmeta=source.chrmeta, fields=source.fields)
+    return track(source)
+
+def _track_chunks(source, chrnames, field, chunk_size, extra=()):
+    """Yield (chrom, starts, ends, values, labels) arrays of at most *chunk_size* items of
+    *source* (a FeatureStream, a Track or a file name), never spanning two chromosomes, where
+    *labels* holds the *extra* fields (an object array with one row per item). Streams without
+    a 'chr' field are a single chromosome None. Tracks are reopened, so that sqlite connections
+    belong to the reading thread."""
+    extra = list(extra)
+    if isinstance(source,(basestring,Track)):
+        source = _reopen(source)
+        if source.format == 'sql': chrnames = [c for c in chrnames if c in source.tables]
+        streams = ((chrom,source.read(selection=chrom, fields=['start','end',field]+extra, skip=True))
+                   for chrom in chrnames)
+    elif 'chr' in source.fields:
+        source = reorder(source,['chr','start','end',field]+extra)
+        streams = ((chrom,(x[1:] for x in rows))
+                   for chrom,rows in itertools.groupby(source, operator.itemgetter(0)))
     else:
-        return FeatureStream(_shuffled(features),features.fields)
+        source = reorder(source,['start','end',field]+extra)
+        streams = [(None,source)]
+    nextra = len(extra)
+    try:
+        for chrom,stream in streams:
+            while True:
+                rows = list(itertools.islice(stream,chunk_size))
+                if not rows: break
+                labels = empty((len(rows),nextra), dtype=object)
+                if nextra: labels[:] = [x[3:3+nextra] for x in rows]
+                yield (chrom, asarray([x[0] for x in rows], dtype=int64),
+                       asarray([x[1] for x in rows], dtype=int64),
+                       asarray([x[2] for x in rows], dtype=float_), labels)
+    finally:
+        if isinstance(source,Track): source.close()
+
+def _read_ahead(generate, size):
+    """Run the generator returned by *generate()* in a background thread, keeping up to
+    *size* of its items in advance, and yield them. Exceptions are raised again here.
+    If this generator is closed before the end, the thread stops reading and closes
+    the generator (so that it releases its files)."""
+    queue = Queue.Queue(size)
+    done = object()
+    stop = threading.Event()
+    def _put(x):
+        while not stop.is_set():
+            try:
+                queue.put(x, timeout=.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+    def _fill():
+        items = generate()
+        try:
+            for item in items:
+                if not _put((None,item)): return
+            _put((None,done))
+        except Exception:
+            _put((sys.exc_info(),None))
+        finally:
+            items.close()
+    reader = threading.Thread(target=_fill)
+    reader.daemon = True
+    reader.start()
+    try:
+        while True:
+            error,item = queue.get()
+            if error is not None: raise error[0], error[1], error[2]
+            if item is done: break
+            yield item
+    finally:
+        stop.set()
+
+class LockstepReader(object):
+    """
+    Read several score tracks in parallel, chromosome by chromosome and by chunks, and yield
+    their values on a common grid of segments, cut at every breakpoint of any track::
+
+        X1: ______666666666______
+        X2: __2222222222_________
+        segments [0,2) [2,6) [6,12) [12,15), values [[0,0],[0,2],[6,2],[6,0]]
+
+    Each iteration yields a tuple ``(chrom, starts, ends, values, present)`` of numpy arrays,
+    where *values[k,i]* is the value of track *i* on segment [*starts[k]*, *ends[k]*) (or *fill*),
+    and *present[k,i]* says whether track *i* has an item there. Within a chromosome, the
+    segments of consecutive batches are contiguous, starting at 0 and ending at the last
+    item end of all tracks. A batch is produced as soon as every track has been read past its
+    end, so memory is bounded by *chunk_size* items per track, and each track is read ahead
+    in its own thread while the caller processes the previous batch::
+
+        for chrom,starts,ends,values,present in LockstepReader([t1,t2], chrnames=['chr1','chr2']):
+            merged = values.mean(1)
+
+    With *extra* fields, the tuple has a sixth member *labels*, a list with for each track an
+    object array whose row *k* holds the *extra* fields of the item of the track on segment *k*
+    (None where it has none).
+
+    :param tracks: list of `Track` objects, file names or FeatureStream objects with fields
+        'start', 'end', *field* and 'chr' (a stream without it is a single chromosome named None),
+        sorted by chromosome and start. Tracks are read one chromosome at a time (a new `Track`
+        is opened for the reading thread), streams are iterated by the reading thread, so they
+        must not come from an sqlite `Track` unless *readahead* is 0.
+    :param field: (str) the name of the field holding the values. ['score']
+    :param chrnames: (list of str) chromosome order: streams must follow it, and tracks are read
+        in this order. By default, the sorted chromosome names of the tracks' *chrmeta*, or for
+        streams only, the order in which chromosomes are met (streams must then list their
+        chromosomes in the same relative order). [None]
+    :param chunk_size: (int) number of items read at once from each track. [10000]
+    :param readahead: (int) number of chunks each thread reads in advance; 0 reads the tracks
+        in the calling thread. [2]
+    :param fill: (float) value of a track where it has no item. [0.]
+    :param extra: (list of str) other fields of the items to report, present in every track. [None]
+    """
+    def __init__(self, tracks, field='score', chrnames=None, chunk_size=10000, readahead=2, fill=0.,
+                 extra=None):
+        self.tracks = tracks
+        self.field = field
+        self.chunk_size = chunk_size
+        self.readahead = readahead
+        self.fill = fill
+        self.extra = list(extra or [])
+        if chrnames is None:
+            chrnames = set()
+            for t in tracks:
+                if isinstance(t,basestring): t = track(t)
+                if isinstance(t,Track): chrnames.update(t.chrmeta)
+            chrnames = sorted(chrnames)
+        self.chrnames = list(chrnames)
+
+    def _chunks(self, source):
+        generate = lambda: _track_chunks(source, self.chrnames, self.field, self.chunk_size, self.extra)
+        if self.readahead > 0:
+            return _read_ahead(generate, self.readahead)
+        return generate()
+
+    def __iter__(self):
+        ntracks = len(self.tracks)
+        nextra = len(self.extra)
+        readers = [self._chunks(t) for t in self.tracks]
+        rank = dict((c,n) for n,c in enumerate(self.chrnames))
+        nothing = (zeros(0,dtype=int64),zeros(0,dtype=int64),zeros(0),zeros((0,nextra),dtype=object))
+        try:
+            heads = [next(r,None) for r in readers]
+            for h in heads:
+                if h is not None: rank.setdefault(h[0],len(rank))
+            while any(h is not None for h in heads):
+                chrom = min((h[0] for h in heads if h is not None), key=rank.get)
+                # Tracks whose next chunk is on *chrom*; buffers hold (starts, ends, values, labels)
+                available = [i for i,h in enumerate(heads) if h is not None and h[0] == chrom]
+                buffers = [h[1:] if i in available else nothing for i,h in enumerate(heads)]
+                for i in available: heads[i] = None
+                lower = 0
+                frontier = -1
+                while available or any(len(b[0]) for b in buffers):
+                    # Read more items for the tracks that are empty or set the last frontier
+                    for i in available[:]:
+                        if len(buffers[i][0]) and buffers[i][0][-1] > frontier: continue
+                        new = next(readers[i],None)
+                        if new is not None: rank.setdefault(new[0],len(rank))
+                        if new is None or new[0] != chrom:
+                            heads[i] = new
+                            available.remove(i)
+                        else:
+                            buffers[i] = tuple(nconcatenate((b,n)) for b,n in zip(buffers[i],new[1:]))
+                    # Every item starting before the frontier has been read from all tracks
+                    if available:
+                        frontier = min(buffers[i][0][-1] for i in available)
+                        upper = frontier
+                    else:
+                        frontier = sys.maxint
+                        upper = max([b[1].max() for b in buffers if len(b[1])] or [lower])
+                    batch = []
+                    for i,(s,e,v,x) in enumerate(buffers):
+                        n = searchsorted(s, frontier, 'left')
+                        batch.append((s[:n], minimum(e[:n],upper), v[:n], x[:n]))
+                        tail = nonzero(e[:n] > upper)[0]
+                        buffers[i] = (nconcatenate((zeros(len(tail),dtype=int64)+upper, s[n:])),
+                                      nconcatenate((e[tail], e[n:])), nconcatenate((v[tail], v[n:])),
+                                      nconcatenate((x[tail], x[n:])))
+                    if upper <= lower: continue
+                    bounds = unique(nconcatenate([[lower,upper]]+[b[0] for b in batch]+[b[1] for b in batch]))
+                    starts = bounds[:-1]
+                    values = zeros((len(starts),ntracks))+self.fill
+                    present = zeros((len(starts),ntracks), dtype=bool)
+                    labels = []
+                    for i,(s,e,v,x) in enumerate(batch):
+                        if nextra: labels.append(empty((len(starts),nextra), dtype=object))
+                        if not len(s): continue
+                        j = searchsorted(s, starts, 'right')-1
+                        covered = (j >= 0) & (e[maximum(j,0)] > starts)
+                        present[:,i] = covered
+                        values[covered,i] = v[j[covered]]
+                        if nextra: labels[i][covered] = x[j[covered]]
+                    lower = upper
+                    if nextra:
+                        yield chrom, starts, bounds[1:], values, present, labels
+                    else:
+                        yield chrom, starts, bounds[1:], values, present
+        finally:
+            for r in readers:
+                r.close()
 
 ####################################################################
 def strand_merge(x):
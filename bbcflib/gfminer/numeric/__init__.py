@@ -6,8 +6,10 @@ from bbcflib.gfminer import *
 ###############################################################################
 _members = {'score_array': ['trackList'],
             'correlation': ['trackList'],
+            'correlation_matrix': ['trackList'],
             'feature_matrix': ['trackScores','trackFeatures'],
-            'summed_feature_matrix': ['trackScores','trackFeatures']
+            'summed_feature_matrix': ['trackScores','trackFeatures'],
+            'tile_matrix': ['trackList']
             }
 class numeric(gfminerGroup):
     def __init__(self):
@@ -16,3 +18,4 @@ class numeric(gfminerGroup):
 
 from .signal import *
 from .regions import *
+from .rle import *
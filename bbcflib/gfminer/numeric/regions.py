@@ -1,8 +1,127 @@
 from bbcflib.gfminer.stream import score_by_feature, segment_features
 from bbcflib.gfminer.common import sorted_stream
+from bbcflib.gfminer import _output_name
+from bbcflib.track import FeatureStream, Track, track
+from numpy.lib.format import open_memmap
+import itertools, os
 import numpy
 
-def feature_matrix(trackScores,trackFeatures,segment=False,method='mean',**kw):
+# Methods computed by filling the matrix directly from the score tracks
+_direct_methods = ['sum','mean','arithmetic','coverage']
+
+def _bin_layout(starts, ends, reverse, nbins, upstream, downstream):
+    """
+    Return the boundaries of the bins `segment_features` cuts features into,
+    as two arrays of shape (number of features, number of bins), and the index
+    of each bin (counted from the upstream end of the feature).
+    """
+    xlen = ends-starts
+    def _flank(flank):
+        if flank is None: return numpy.zeros(len(starts),dtype=numpy.int64), 0
+        if flank[0] > 1:  return numpy.zeros(len(starts),dtype=numpy.int64)+int(flank[0]), flank[1]
+        return (.5+flank[0]*xlen).astype(numpy.int64), flank[1]
+    updist,upbins = _flank(upstream)
+    downdist,downbins = _flank(downstream)
+    body = [starts+xlen*k//nbins for k in range(nbins+1)]
+    fwd = [starts-updist*k//upbins for k in range(upbins,0,-1)] + body \
+          + [ends+downdist*(k+1)//downbins for k in range(downbins)]
+    rev = [starts-downdist*k//downbins for k in range(downbins,0,-1)] + body \
+          + [ends+updist*(k+1)//upbins for k in range(upbins)]
+    bounds = numpy.where(reverse[:,None], numpy.column_stack(rev), numpy.column_stack(fwd))
+    ntot = bounds.shape[1]-1
+    labels = numpy.where(reverse[:,None], ntot-1-numpy.arange(ntot), numpy.arange(ntot))
+    return bounds[:,:-1], bounds[:,1:], labels
+
+def _read_features(trackFeatures, nbins, upstream, downstream):
+    """Load *trackFeatures* and return the feature names, chromosomes and bin layout."""
+    fields = trackFeatures.fields
+    feats = list(trackFeatures)
+    starti = fields.index('start')
+    endi = fields.index('end')
+    names = [x[fields.index('name')] for x in feats]
+    if 'chr' in fields: chroms = [x[fields.index('chr')] for x in feats]
+    else:               chroms = [None]*len(feats)
+    if 'strand' in fields:
+        reverse = numpy.array([x[fields.index('strand')] < 0 for x in feats], dtype=bool)
+    else:
+        reverse = numpy.zeros(len(feats), dtype=bool)
+    starts = numpy.array([x[starti] for x in feats], dtype=numpy.int64)
+    ends = numpy.array([x[endi] for x in feats], dtype=numpy.int64)
+    return (names, chroms) + _bin_layout(starts, ends, reverse, nbins, upstream, downstream)
+
+def _group_bins(chroms, bstarts, bends, targets, weights, bychr):
+    """Split the bins by chromosome (or keep a single group if not *bychr*) and sort them
+    by start. Empty bins are dropped, they never intersect any score."""
+    groups = {}
+    if bychr:
+        chroms = numpy.array(chroms, dtype=object)
+        keys = set(chroms)
+    else:
+        keys = [None]
+    for c in keys:
+        rows = numpy.nonzero(chroms == c)[0] if bychr else slice(None)
+        a = bstarts[rows].ravel()
+        b = bends[rows].ravel()
+        t = targets[rows].ravel()
+        w = weights[rows].ravel()
+        keep = b > a
+        order = numpy.argsort(a[keep], kind='mergesort')
+        a,b,t,w = a[keep][order],b[keep][order],t[keep][order],w[keep][order]
+        groups[c] = (a, b, t, w, (b-a).max() if len(a) else 0)
+    return groups
+
+def _fill_chunk(out, group, starts, ends, scores):
+    """Add to *out* (a 1-dim view) the weighted intersections of the bins in *group*
+    with the score items (*starts*, *ends*, *scores*)."""
+    a, b, targets, weights, maxbin = group
+    if len(a) == 0 or len(starts) == 0: return
+    order = numpy.argsort(starts, kind='mergesort')
+    starts, ends, scores = starts[order], ends[order], scores[order]
+    maxitem = (ends-starts).max()
+    i0 = numpy.searchsorted(a, starts[0]-maxbin, 'right')
+    i1 = numpy.searchsorted(a, ends.max(), 'left')
+    if i1 <= i0: return
+    ca, cb = a[i0:i1], b[i0:i1]
+    k0 = numpy.searchsorted(starts, ca-maxitem, 'right')
+    k1 = numpy.searchsorted(starts, cb, 'left')
+    counts = numpy.maximum(k1-k0, 0)
+    total = counts.sum()
+    if total == 0: return
+    ibin = numpy.repeat(numpy.arange(len(ca)), counts)
+    iitem = numpy.arange(total) - numpy.repeat(numpy.cumsum(counts)-counts-k0, counts)
+    overlap = numpy.minimum(cb[ibin], ends[iitem]) - numpy.maximum(ca[ibin], starts[iitem])
+    keep = overlap > 0
+    ibin, iitem = ibin[keep], iitem[keep]
+    numpy.add.at(out, targets[i0+ibin], scores[iitem]*overlap[keep]*weights[i0+ibin])
+
+def _fill_matrix(out, trackScores, layout, targets, weights, method, chunk_size):
+    """Fill the 2-dim array *out* (one column per score track) reading each track once,
+    by chunks of *chunk_size* items."""
+    chroms, bstarts, bends = layout
+    groups = {}
+    for n,t in enumerate(trackScores):
+        bychr = 'chr' in t.fields and chroms[0:1] != [None]
+        if not(bychr in groups):
+            groups[bychr] = _group_bins(chroms, bstarts, bends, targets, weights, bychr)
+        group = groups[bychr]
+        si,ei,vi = [t.fields.index(f) for f in ['start','end','score']]
+        chrkey = (lambda x: x[t.fields.index('chr')]) if bychr else (lambda x: None)
+        column = out[:,n]
+        while 1:
+            rows = list(itertools.islice(t,chunk_size))
+            if not rows: break
+            for c,items in itertools.groupby(rows,chrkey):
+                if not(c in group): continue
+                items = list(items)
+                starts = numpy.array([x[si] for x in items], dtype=numpy.int64)
+                ends = numpy.array([x[ei] for x in items], dtype=numpy.int64)
+                if method == 'coverage':
+                    scores = numpy.ones(len(items))
+                else:
+                    scores = numpy.array([x[vi] for x in items], dtype=numpy.float64)
+                _fill_chunk(column, group[c], starts, ends, scores)
+
+def feature_matrix(trackScores,trackFeatures,segment=False,method='mean',memmap=None,chunk_size=100000,**kw):
     """
     Return an array with as many lines as there are features in *trackFeatures*, and as many columns
     as there are score tracks in *trackScores*. Each element in the matrix thus corresponds to the
@@ -37,16 +156,52 @@ def feature_matrix(trackScores,trackFeatures,segment=False,method='mean',**kw):
         R:  [[3.  2.]
              [6.  0.]]
 
-    Note: the whole segmented features track will be loaded in memory.
+    With methods 'sum', 'mean' and 'coverage', the bin layout is computed once as arrays and
+    the matrix is filled directly, each score track being read once by chunks of *chunk_size*
+    items (score tracks then need not be sorted). Features sharing the same name are pooled
+    into one row, and rows follow the order of first appearance in *trackFeatures*.
+    Other methods go through `segment_features` and `score_by_feature`, and the whole
+    segmented features track is loaded in memory.
 
     :param trackScores: (FeatureStream, or list of FeatureStream objects) score track(s).
     :param trackFeatures: (FeatureStream) feature track.
     :param segment: (bool) segment each feature into bins.[False]
     :param method: (str) Operation applied to the list of scores for one feature.
-        It is the `method` argument to `stream.score_by_feature` - one of 'sum','mean','median','min','max'.
+        It is the `method` argument to `stream.score_by_feature` - one of 'sum','mean','median','min','max',
+        'coverage', 'qXX' (percentile).
+    :param memmap: (str) if given, the result is a `numpy.memmap` array backed by this file. [None]
+    :param chunk_size: (int) number of score items read at once. [100000]
     :param **kw: arguments to pass to segment_features (`nbins`,`upstream`,`downstream`).
     :rtype: tuple (numpy.ndarray of strings, numpy.ndarray of floats)
     """
+    if not(isinstance(trackScores,(list,tuple))): trackScores = [trackScores]
+    if method in _direct_methods:
+        if segment:
+            nbins = kw.get('nbins',segment_features.func_defaults[0])
+            layout = _read_features(trackFeatures, nbins, kw.get('upstream'), kw.get('downstream'))
+        else:
+            layout = _read_features(trackFeatures, 1, None, None)
+        names, chroms, bstarts, bends, labels = layout
+        rows = {}
+        for n in names: rows.setdefault(n,len(rows))
+        feat_names = numpy.array(sorted(rows, key=rows.get))
+        ntot = labels.shape[1]
+        targets = numpy.array([rows[n] for n in names], dtype=numpy.int64)[:,None]*ntot + labels
+        if method == 'sum':
+            weights = numpy.ones(targets.shape)
+        else:
+            lengths = numpy.bincount(targets.ravel(), weights=(bends-bstarts).ravel(),
+                                     minlength=len(rows)*ntot)
+            weights = 1./numpy.maximum(lengths[targets],1)
+        shape = (len(rows),ntot,len(trackScores)) if segment else (len(rows),len(trackScores))
+        if memmap:
+            scores_mat = numpy.memmap(memmap, dtype=numpy.float64, mode='w+', shape=shape)
+            scores_mat[:] = 0
+        else:
+            scores_mat = numpy.zeros(shape)
+        _fill_matrix(scores_mat.reshape(len(rows)*ntot,len(trackScores)), trackScores,
+                     (chroms,bstarts,bends), targets, weights, method, chunk_size)
+        return (feat_names,scores_mat)
     nbins = 1
     nscores = 1
     if segment:
@@ -75,7 +230,7 @@ def feature_matrix(trackScores,trackFeatures,segment=False,method='mean',**kw):
     scores_mat = numpy.array(scores_dict.values())
     return (feat_names,scores_mat)
 
-def summed_feature_matrix(trackScores,trackFeatures,method='mean',**kw):
+def summed_feature_matrix(trackScores,trackFeatures,method='mean',chunk_size=100000,**kw):
     """
     Each feature in *trackFeatures* is segmented into bins using bbcflib.gfminer.stream.segment_features
     (with parameters passed from *\*\*kw*).
@@ -95,15 +250,31 @@ def summed_feature_matrix(trackScores,trackFeatures,method='mean',**kw):
             [4.  1.],   # bin 1
             [6.  1.]]   # bin 2
 
-    Note: the whole segmented features track will be loaded in memory.
+    With methods 'sum', 'mean' and 'coverage', the bins are filled directly as in `feature_matrix`.
+    Otherwise the whole segmented features track will be loaded in memory.
 
     :param trackScores: (FeatureStream, or list of FeatureStream objects) score track(s).
     :param trackFeatures: (FeatureStream) feature track.
     :param method: (str) Operation applied to the list of scores for one feature.
-        It is the `method` argument to `stream.score_by_feature` - one of 'sum','mean','median','min','max'.
+        It is the `method` argument to `stream.score_by_feature` - one of 'sum','mean','median','min','max',
+        'coverage', 'qXX' (percentile).
+    :param chunk_size: (int) number of score items read at once. [100000]
     :param **kw: arguments to pass to segment_features (`nbins`,`upstream`,`downstream`).
     :rtype: numpy.ndarray, int (number of features)
     """
+    if method in _direct_methods:
+        if not(isinstance(trackScores,(list,tuple))): trackScores = [trackScores]
+        nbins = kw.get('nbins',segment_features.func_defaults[0])
+        names, chroms, bstarts, bends, labels = _read_features(trackFeatures, nbins,
+                                                               kw.get('upstream'), kw.get('downstream'))
+        if method == 'sum':
+            weights = numpy.ones(labels.shape)
+        else:
+            weights = 1./numpy.maximum(bends-bstarts,1)
+        averages = numpy.zeros(shape=(labels.shape[1],len(trackScores)))
+        _fill_matrix(averages, trackScores, (chroms,bstarts,bends), labels, weights,
+                     method, chunk_size)
+        return averages, len(names)
     nfields = len(trackFeatures.fields)
     trackFeatures = sorted_stream(segment_features(trackFeatures,**kw))
     all_means = score_by_feature(trackScores,trackFeatures,method=method)
@@ -121,3 +292,134 @@ def summed_feature_matrix(trackScores,trackFeatures,method='mean',**kw):
     return averages, (ntot+1)/nbins
 
 
+
+def _tile_chunk(column, starts, ends, values, offset, length, bin_size, method):
+    """Add to *column* the contribution of the items (*starts*, *ends*, *values*) of one
+    chromosome to its bins, which begin at row *offset*."""
+    starts = numpy.maximum(starts, 0)
+    ends = numpy.minimum(ends, length)
+    keep = ends > starts
+    starts, ends, values = starts[keep], ends[keep], values[keep]
+    if len(starts) == 0: return
+    first = starts//bin_size
+    if method == 'count':
+        numpy.add.at(column, offset+first, 1)
+        return
+    nbins = (ends-1)//bin_size-first+1
+    ibin = numpy.repeat(first, nbins) + numpy.arange(nbins.sum()) \
+           - numpy.repeat(numpy.cumsum(nbins)-nbins, nbins)
+    iitem = numpy.repeat(numpy.arange(len(starts)), nbins)
+    if method == 'max':
+        numpy.maximum.at(column, offset+ibin, values[iitem])
+        return
+    overlap = numpy.minimum(ends[iitem], (ibin+1)*bin_size) - numpy.maximum(starts[iitem], ibin*bin_size)
+    if method == 'coverage':
+        numpy.add.at(column, offset+ibin, overlap)
+    else:
+        numpy.add.at(column, offset+ibin, values[iitem]*overlap)
+
+def tile_matrix(trackList, bin_size, chrmeta=None, method='sum', output=None, format=None, chunk_size=100000):
+    """
+    Cut the genome into consecutive bins of *bin_size* bases and return an array with one row
+    per bin and one column per track in *trackList*, each track being read once, by chunks
+    of *chunk_size* items (tracks need not be sorted). Example::
+
+               012345678901234567
+        bins:  |----|----|----|--   (bin_size=5, chromosome length 18)
+        X:     ___66666_____2222_
+        Y:     ##______####____##   (reads)
+
+                           X    Y                                  Y
+        method='sum':   [[12.  2.]              method='count':  [1.
+                         [18.  2.]                                1.
+                         [ 4.  2.]                                0.
+                         [ 4.  2.]]                               1.]
+
+    With 'sum', each item adds its score times the number of bases it shares with the bin,
+    'mean' divides these sums by the bin length (the mean score per base), 'coverage' is the
+    fraction of the bin covered by items, 'max' is the highest score of the items overlapping
+    the bin, and 'count' is the number of items starting in the bin (e.g. read counts).
+    Items without a 'score' field (and reads of bam files) count as a score of 1.
+
+    The bins of each chromosome follow each other in the order of the sorted chromosome names;
+    the first element of the result tells where each chromosome starts: bin *k* of the list
+    ``(chrom, row, nbins)`` is row *row+k* and covers [*k\*bin_size*, *(k+1)\*bin_size*), the last
+    one ending at the chromosome length.
+
+    :param trackList: (list of) `Track` objects (score tracks or bam files), file names or
+        FeatureStream objects with fields 'chr', 'start', 'end' and optionally 'score'.
+    :param bin_size: (int) bin length in bases.
+    :param chrmeta: (dict) chromosome lengths, e.g. ``{'chr1': {'length': 1234}}``. By default,
+        that of the first `Track` in *trackList*. [None]
+    :param method: (str) one of 'sum', 'mean', 'max', 'coverage' or 'count'. ['sum']
+    :param output: (str) file name to write the result to. If None, the array is kept in
+        memory. [None]
+    :param format: (str) output format, by default given by the extension of *output*:
+        'npy' (the array is a memory-mapped file filled in place, see `numpy.lib.format.open_memmap`),
+        or a track format such as 'sql' or 'bedGraph', in which case the non-zero bins of each
+        track are written to a track, named *output* if there is a single track, or as
+        `gfminer.run` names several outputs otherwise. [None]
+    :param chunk_size: (int) number of items read at once. [100000]
+    :rtype: tuple (list of (chrom, row, nbins), numpy.ndarray of floats)
+    """
+    if not(isinstance(trackList,(list,tuple))): trackList = [trackList]
+    if not(method in ['sum','mean','max','coverage','count']):
+        raise ValueError("Unknown tiling method %s." % method)
+    trackList = [track(t) if isinstance(t,basestring) else t for t in trackList]
+    if chrmeta is None:
+        chrmeta = ([t.chrmeta for t in trackList if isinstance(t,Track)] or [None])[0]
+        if not chrmeta: raise ValueError("Chromosome lengths (chrmeta) are needed to tile the genome.")
+    tiles = []
+    nrows = 0
+    for c in sorted(chrmeta):
+        nbins = (chrmeta[c]['length']+bin_size-1)//bin_size
+        tiles.append((c,nrows,nbins))
+        nrows += nbins
+    offsets = dict((c,(row,chrmeta[c]['length'])) for c,row,n in tiles)
+    if output and not format:
+        format = os.path.splitext(output)[1][1:]
+    shape = (nrows,len(trackList))
+    if output and format == 'npy':
+        scores_mat = open_memmap(output, mode='w+', dtype=numpy.float64, shape=shape)
+    else:
+        scores_mat = numpy.zeros(shape)
+    if method == 'max': scores_mat[:] = -numpy.inf
+    for n,t in enumerate(trackList):
+        if isinstance(t,Track):
+            fields = ['chr','start','end']
+            if t.format != 'bam' and 'score' in t.fields: fields.append('score')
+            t = t.read(fields=fields)
+        getters = [t.fields.index(f) for f in ['chr','start','end']]
+        vi = t.fields.index('score') if 'score' in t.fields else None
+        column = scores_mat[:,n]
+        while 1:
+            rows = list(itertools.islice(t,chunk_size))
+            if not rows: break
+            for c,items in itertools.groupby(rows,lambda x:x[getters[0]]):
+                if not(c in offsets): continue
+                items = list(items)
+                starts = numpy.array([x[getters[1]] for x in items], dtype=numpy.int64)
+                ends = numpy.array([x[getters[2]] for x in items], dtype=numpy.int64)
+                if vi is None: values = numpy.ones(len(items))
+                else: values = numpy.array([x[vi] for x in items], dtype=numpy.float64)
+                _tile_chunk(column, starts, ends, values, offsets[c][0], offsets[c][1], bin_size, method)
+    if method == 'max':
+        scores_mat[scores_mat == -numpy.inf] = 0
+    elif method in ['mean','coverage']:
+        for c,row,nbins in tiles:
+            lengths = numpy.minimum(numpy.arange(1,nbins+1)*bin_size, offsets[c][1]) \
+                      - numpy.arange(nbins)*bin_size
+            scores_mat[row:row+nbins] /= lengths[:,None]
+    if output and format == 'npy':
+        scores_mat.flush()
+    elif output:
+        def _bins(n):
+            for c,row,nbins in tiles:
+                for k in numpy.nonzero(scores_mat[row:row+nbins,n])[0]:
+                    yield (c, k*bin_size, min((k+1)*bin_size,offsets[c][1]), scores_mat[row+k,n])
+        for n in range(len(trackList)):
+            outf = output if len(trackList) == 1 else _output_name(output,format,n)
+            out = track(outf, format=format, chrmeta=chrmeta, fields=['chr','start','end','score'])
+            out.write(FeatureStream(_bins(n), fields=['chr','start','end','score']))
+            out.close()
+    return tiles, scores_mat
@@ -0,0 +1,267 @@
+"""
+Run-length encoded signals. An `RleSignal` holds, for each chromosome, the piecewise-constant
+signal of a score track as two numpy arrays (run ends and run values), so that signal algebra
+is computed on whole chromosomes at once instead of chaining streams, e.g.::
+
+    from bbcflib.gfminer.numeric import RleSignal
+    a = RleSignal.from_track(track("treatment.sql"))
+    b = RleSignal.from_track(track("control.sql"))
+    ratio = ((a+1)/(b+1)).apply(numpy.log2)
+    enriched = (ratio > 1)*ratio
+    enriched.to_track("log_ratio.sql", chrmeta=track("treatment.sql").chrmeta)
+"""
+
+from bbcflib.track import FeatureStream, track as _track
+from numpy import asarray, zeros, empty, cumsum, searchsorted, union1d, concatenate, errstate
+from numpy import int64, float64, nonzero, maximum, minimum, append, isscalar, add
+import operator
+
+__all__ = ['RleSignal']
+
+def _compress(ends, values):
+    """Merge consecutive runs with equal values."""
+    if len(values) < 2: return ends, values
+    change = values[1:] != values[:-1]
+    keep_end = append(change, True)
+    keep_val = concatenate(([True], change))
+    return ends[keep_end], values[keep_val]
+
+def _extend(ends, values, length):
+    """Pad the runs with a zero run up to *length*."""
+    if len(ends) and ends[-1] >= length: return ends, values
+    return append(ends, length), append(values, 0.)
+
+class RleSignal(object):
+    """
+    Piecewise-constant signal over several chromosomes. For each chromosome, run *k*
+    covers positions ``[ends[k-1], ends[k])`` (starting at 0) and has value ``values[k]``.
+    Positions not covered by any feature have value 0. A chromosome ends with its last run:
+    when combining two signals, the shorter one is extended with zeros, but operations with
+    a scalar only apply up to that end, so build signals with a *chrmeta* (or from tracks)
+    to have them span whole chromosomes.
+
+    Signals support elementwise arithmetic (``+``, ``-``, ``*``, ``/``, ``**``) and comparisons
+    (``<``, ``>``, ... giving 1. or 0.) between two signals or with a scalar, and any
+    elementwise function through `apply`. Results are computed run by run, and consecutive
+    runs with equal values are merged.
+
+    :param runs: (dict) ``{chromosome: (ends, values)}`` with two arrays of the same length.
+    """
+    def __init__(self, runs=None):
+        self.runs = {}
+        for chrom,(ends,values) in (runs or {}).iteritems():
+            self.runs[chrom] = _compress(asarray(ends,dtype=int64), asarray(values,dtype=float64))
+
+    @property
+    def chromosomes(self):
+        return sorted(self.runs)
+
+    def length(self, chrom):
+        """End of the last run of chromosome *chrom* (0 if absent)."""
+        ends = self.runs.get(chrom,([],))[0]
+        return int(ends[-1]) if len(ends) else 0
+
+    def __len__(self):
+        """Total number of runs."""
+        return sum(len(e) for e,v in self.runs.itervalues())
+
+    ######################## Conversions ########################
+    @classmethod
+    def from_stream(cls, stream, field='score', chrmeta=None, chrom=None):
+        """
+        Build a signal from a stream with fields 'start', 'end', *field*, and 'chr'
+        unless *chrom* is given. The values of overlapping features are added.
+
+        :param stream: FeatureStream.
+        :param field: (str) the field holding the values. ['score']
+        :param chrmeta: (dict) chromosome lengths (e.g. `Track.chrmeta`): each chromosome
+            is extended with zeros up to its length. [None]
+        :param chrom: (str) chromosome name of a stream without 'chr' field. [None]
+        :rtype: RleSignal
+        """
+        si = stream.fields.index('start')
+        ei = stream.fields.index('end')
+        vi = stream.fields.index(field)
+        ci = stream.fields.index('chr') if chrom is None else None
+        coords = {}
+        for x in stream:
+            coords.setdefault(x[ci] if ci is not None else chrom, []).append((x[si],x[ei],x[vi]))
+        runs = {}
+        for c,rows in coords.iteritems():
+            rows = asarray(rows, dtype=float64)
+            starts = rows[:,0].astype(int64)
+            ends = rows[:,1].astype(int64)
+            length = max(ends.max(), (chrmeta or {}).get(c,{}).get('length',0))
+            runs[c] = cls._from_intervals(starts, ends, rows[:,2], length)
+        for c,meta in (chrmeta or {}).iteritems():
+            if not(c in runs) and meta.get('length'):
+                runs[c] = (asarray([meta['length']]), asarray([0.]))
+        return cls(runs)
+
+    @staticmethod
+    def _from_intervals(starts, ends, values, length):
+        """Runs of the sum of the intervals [*starts*, *ends*) with *values*, on [0, *length*)."""
+        bounds = union1d(concatenate((starts, ends)), [0, length])
+        delta = zeros(len(bounds), dtype=float64)
+        add.at(delta, searchsorted(bounds, starts), values)
+        add.at(delta, searchsorted(bounds, ends), -values)
+        level = cumsum(delta)[:-1]
+        return bounds[1:], level
+
+    @classmethod
+    def from_track(cls, track, field='score', chromosomes=None):
+        """
+        Build a signal from a track (or a file name), reading it chromosome by chromosome.
+
+        :param track: `Track` object or file name.
+        :param field: (str) the field holding the values. ['score']
+        :param chromosomes: (list of str) chromosomes to read, all by default. [None]
+        :rtype: RleSignal
+        """
+        if isinstance(track,basestring): track = _track(track)
+        runs = {}
+        for c in (chromosomes or track.chrmeta.keys()):
+            stream = track.read(selection=c, fields=['start','end',field])
+            sig = cls.from_stream(stream, field=field, chrom=c,
+                                  chrmeta={c: track.chrmeta.get(c,{})})
+            runs.update(sig.runs)
+        return cls(runs)
+
+    def to_stream(self, chrom=None, zeros=False):
+        """
+        Return the runs as a stream with fields 'chr', 'start', 'end', 'score'.
+
+        :param chrom: (str or list of str) chromosome(s) to output, all (sorted) by default. [None]
+        :param zeros: (bool) also output runs with value 0. [False]
+        :rtype: FeatureStream
+        """
+        if chrom is None: chrom = self.chromosomes
+        if isinstance(chrom,basestring): chrom = [chrom]
+        def _generate():
+            for c in chrom:
+                if not(c in self.runs): continue
+                ends, values = self.runs[c]
+                starts = concatenate(([0], ends[:-1]))
+                idx = xrange(len(ends)) if zeros else nonzero(values)[0]
+                for k in idx:
+                    yield (c, int(starts[k]), int(ends[k]), float(values[k]))
+        return FeatureStream(_generate(), fields=['chr','start','end','score'])
+
+    def to_track(self, path, chrmeta=None, **kw):
+        """
+        Write the signal (without zero runs) to a track, one chromosome at a time.
+
+        :param path: (str) file name of the new track.
+        :param chrmeta: (dict) chromosome information, by default their lengths in the signal. [None]
+        :param kw: additional arguments passed to `track` (e.g. *info*).
+        :rtype: str, the file name.
+        """
+        if chrmeta is None: chrmeta = dict((c,{'length': self.length(c)}) for c in self.runs)
+        out = _track(path, chrmeta=chrmeta, fields=['chr','start','end','score'], **kw)
+        for c in self.chromosomes:
+            out.write(self.to_stream(c), chrom=c)
+        out.close()
+        return path
+
+    def to_array(self, chrom, start=0, end=None):
+        """Return the values at each position of [*start*, *end*) of chromosome *chrom*."""
+        ends, values = self.runs[chrom]
+        if end is None: end = int(ends[-1])
+        out = zeros(end-start, dtype=float64)
+        i = searchsorted(ends, start, side='right')
+        j = min(searchsorted(ends, end, side='left')+1, len(ends))
+        bounds = concatenate(([start], minimum(ends[i:j], end))) - start
+        for k in xrange(j-i):
+            out[bounds[k]:bounds[k+1]] = values[i+k]
+        return out
+
+    ######################## Arithmetic ########################
+    def _binary(self, other, op):
+        with errstate(divide='ignore', invalid='ignore'):
+            if isscalar(other):
+                return RleSignal(dict((c,(e,op(v,other))) for c,(e,v) in self.runs.iteritems()))
+            runs = {}
+            for c in set(self.runs) | set(other.runs):
+                length = max(self.length(c), other.length(c))
+                ea, va = _extend(*(self.runs.get(c) or (zeros(0,dtype=int64),zeros(0))), length=length)
+                eb, vb = _extend(*(other.runs.get(c) or (zeros(0,dtype=int64),zeros(0))), length=length)
+                ends = union1d(ea, eb)
+                runs[c] = (ends, op(va[searchsorted(ea, ends)], vb[searchsorted(eb, ends)]))
+            return RleSignal(runs)
+
+    def apply(self, fn):
+        """Return the signal with the elementwise function *fn* (e.g. `numpy.log2`)
+        applied to its values."""
+        with errstate(divide='ignore', invalid='ignore'):
+            return RleSignal(dict((c,(e,fn(v))) for c,(e,v) in self.runs.iteritems()))
+
+    def __add__(self, other): return self._binary(other, operator.add)
+    def __sub__(self, other): return self._binary(other, operator.sub)
+    def __mul__(self, other): return self._binary(other, operator.mul)
+    def __div__(self, other): return self._binary(other, operator.truediv)
+    __truediv__ = __div__
+    def __pow__(self, other): return self._binary(other, operator.pow)
+    def __radd__(self, other): return self._binary(other, lambda v,x: x+v)
+    def __rsub__(self, other): return self._binary(other, lambda v,x: x-v)
+    def __rmul__(self, other): return self._binary(other, lambda v,x: x*v)
+    def __rdiv__(self, other): return self._binary(other, lambda v,x: x/v)
+    __rtruediv__ = __rdiv__
+    def __neg__(self): return self.apply(operator.neg)
+    def __abs__(self): return self.apply(abs)
+    def __lt__(self, other): return self._binary(other, lambda v,x: (v < x)*1.)
+    def __le__(self, other): return self._binary(other, lambda v,x: (v <= x)*1.)
+    def __gt__(self, other): return self._binary(other, lambda v,x: (v > x)*1.)
+    def __ge__(self, other): return self._binary(other, lambda v,x: (v >= x)*1.)
+
+    def maximum(self, other):
+        """Elementwise maximum with another signal or a scalar."""
+        return self._binary(other, maximum)
+
+    def minimum(self, other):
+        """Elementwise minimum with another signal or a scalar."""
+        return self._binary(other, minimum)
+
+    ######################## Reductions ########################
+    def window_reduce(self, chrom, starts, ends, method='mean'):
+        """
+        Reduce the signal over each window [*starts[k]*, *ends[k]*) of chromosome *chrom*.
+        Positions beyond the end of the signal count as zeros.
+
+        :param starts: (array of int) window starts.
+        :param ends: (array of int) window ends.
+        :param method: (str) one of 'sum', 'mean', 'max', 'min', or 'coverage' (number
+            of positions with a non-zero value). ['mean']
+        :rtype: numpy array of floats.
+        """
+        starts = asarray(starts, dtype=int64)
+        ends = asarray(ends, dtype=int64)
+        if not(chrom in self.runs):
+            return zeros(len(starts))
+        rends, values = _extend(*self.runs[chrom], length=max(self.length(chrom), ends.max()+1 if len(ends) else 0))
+        if method in ['sum','mean','coverage']:
+            v = values if method != 'coverage' else (values != 0)*1.
+            rstarts = concatenate(([0], rends[:-1]))
+            integral = concatenate(([0.], cumsum(v*(rends-rstarts))))
+            def _at(x):
+                k = searchsorted(rends, x, side='right')
+                return integral[k] + (x-rstarts[minimum(k,len(v)-1)])*v[minimum(k,len(v)-1)]*(k < len(v))
+            total = _at(ends)-_at(starts)
+            if method == 'mean':
+                with errstate(divide='ignore', invalid='ignore'):
+                    return total/(ends-starts)
+            return total
+        if method in ['max','min']:
+            fn = maximum if method == 'max' else minimum
+            i = searchsorted(rends, starts, side='right')
+            j = searchsorted(rends, ends-1, side='right')
+            idx = empty(2*len(starts), dtype=int64)
+            idx[0::2] = i
+            idx[1::2] = j+1
+            return fn.reduceat(append(values, 0.), idx)[0::2]
+        raise ValueError("Unknown method %s." %method)
+
+    def bins(self, chrom, size, method='mean'):
+        """Reduce the signal over consecutive bins of *size* bases along chromosome *chrom*
+        (see `window_reduce`)."""
+        starts = range(0, self.length(chrom), size)
+        return self.window_reduce(chrom, starts, [min(s+size,self.length(chrom)) for s in starts], method)
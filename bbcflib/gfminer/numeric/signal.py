@@ -1,22 +1,39 @@
-from bbcflib.gfminer.common import unroll
+from bbcflib.gfminer.common import unroll_array, getter, _region_list, _unroll_blocks
 from bbcflib.track import FeatureStream
-from numpy.fft import fft, ifft
-from numpy import conjugate,array,asarray,mean,sqrt,real,hstack
+from numpy.fft import rfft, irfft
+from numpy import conjugate,array,asarray,mean,sqrt,real,hstack,zeros,cumsum,empty,nan
+from numpy import float32,float64,complex64,complex128
 from numpy import concatenate as ncat
-from math import log
+from numpy.lib.format import open_memmap
+from math import log, ceil
+import cPickle, itertools
 
-def score_array(trackList,fields=['score']):
+def score_array(trackList,fields=['score'],chunk_size=100000):
     """Returns a numeric array with the *fields* columns from each input track
-    and a vector of row labels, taken from the *name* field which must match in all tracks."""
+    and a vector of row labels, taken from the *name* field which must match in all tracks.
+    Rows follow the order of the names in the first track. The array is allocated once,
+    and each track is read once by chunks of *chunk_size* items, written with a single
+    indexed assignment per chunk. Names absent from a track get NaN in its columns."""
     if not(isinstance(trackList,(list,tuple))): trackList=[trackList]
-    sidx = [[t.fields.index(f) for f in fields] for t in trackList]
-    nidx = [t.fields.index('name') for t in trackList]
-    dico = dict((k[nidx[0]],[k[i] for i in sidx[0]]) for k in trackList[0])
-    nums = asarray(dico.values())
-    labs = asarray(dico.keys())
-    for n,tn in enumerate(trackList[1:]):
-        dico = dict((k[nidx[n+1]],[k[i] for i in sidx[n+1]]) for k in tn)
-        nums = hstack((nums,[dico[k] for k in labs]))
+    if isinstance(fields,basestring): fields=[fields]
+    nf = len(fields)
+    first = list(trackList[0])
+    nidx = trackList[0].fields.index('name')
+    rows = {}
+    for x in first: rows.setdefault(x[nidx],len(rows))
+    labs = asarray(sorted(rows, key=rows.get))
+    nums = empty((len(rows),nf*len(trackList)))
+    nums.fill(nan)
+    for n,t in enumerate(trackList):
+        _get = getter([t.fields.index(f) for f in fields])
+        nidx = t.fields.index('name')
+        items = iter(first) if n == 0 else t
+        while 1:
+            chunk = list(itertools.islice(items,chunk_size))
+            if not chunk: break
+            chunk = [x for x in chunk if x[nidx] in rows]
+            if not chunk: continue
+            nums[asarray([rows[x[nidx]] for x in chunk]), n*nf:(n+1)*nf] = [_get(x) for x in chunk]
     return (nums,labs)
 
 def vec_reduce(x):
@@ -29,6 +46,182 @@ def vec_reduce(x):
     else:
         return x-x[0]
 
+def _fft_size(n):
+    """Smallest integer >= *n* with no prime factor larger than 5: FFTs of such sizes are
+    about as fast as powers of 2, with much less padding."""
+    best = 2**int(ceil(log(max(n,1),2)))
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            p = p35
+            while p < n: p *= 2
+            best = min(best,p)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+def _correlation_layout(n, limits, block_size):
+    """Return the limits (clipped to the signal length *n*), the largest lag K,
+    the block size and the FFT size used to correlate signals of length *n*."""
+    if limits[1]-limits[0] > 2*n:
+        limits = (-n+1,n-1)
+    K = max(abs(limits[0]),abs(limits[1]))
+    if block_size is None: block_size = max(65536,16*K)
+    block_size = max(min(block_size,n),K,1)
+    return limits, K, block_size, _fft_size(block_size+2*K)
+
+def _block_spectra(track, regions, K, block_size, nfft, dtype, stats):
+    """
+    Yield, for each block of the unrolled *track*, the spectrum of the block and the spectrum
+    of the block extended by *K* positions on each side with its neighbours' values.
+    Values are shifted by the mean of the first block, and *stats* receives the length,
+    sum, sum of squares, first and last *K* values of the shifted signal, from which
+    `_reduced_correlation` centers and reduces the result.
+    """
+    ctype = complex64 if dtype == float32 else complex128
+    blocks = _unroll_blocks(track, regions, block_size, dtype=float64)
+    cur = next(blocks,None)
+    if cur is None: return
+    shift = cur.mean()
+    cur = cur-shift
+    prev = zeros(K)
+    stats.update(n=0, sum=0., sumsq=0., head=cur[:K], tail=zeros(0))
+    while cur is not None:
+        nxt = next(blocks,None)
+        if nxt is not None: nxt = nxt-shift
+        stats['n'] += len(cur)
+        stats['sum'] += cur.sum()
+        stats['sumsq'] += (cur*cur).sum()
+        stats['tail'] = ncat((stats['tail'],cur))[-K:] if K else zeros(0)
+        left = prev[len(prev)-K:] if K else zeros(0)
+        right = nxt[:K] if (K and nxt is not None) else zeros(0)
+        ext = ncat((left, cur, right, zeros(K-len(right))))
+        yield (rfft(cur.astype(dtype),nfft).astype(ctype),
+               rfft(ext.astype(dtype),nfft).astype(ctype))
+        prev = cur
+        cur = nxt
+
+def _reduced_correlation(raw, sa, sb, K):
+    """Center and reduce *raw*, the correlation at lags -K..K of two shifted signals
+    summarized by *sa* and *sb* (see `_block_spectra`), as `vec_reduce` would."""
+    n = sa['n']
+    da = sa['sum']/n
+    db = sb['sum']/n
+    var = (sa['sumsq']/n-da*da)*(sb['sumsq']/n-db*db)
+    if var <= 1e-12: return zeros(2*K+1)
+    def _partial(x,total):
+        # sums of the first k values, k = 0..K
+        c = ncat(([0.],cumsum(x)))
+        return ncat((c,[total]*(K+1-len(c))))
+    heada, taila = _partial(sa['head'],sa['sum']), _partial(sa['tail'][::-1],sa['sum'])
+    headb, tailb = _partial(sb['head'],sb['sum']), _partial(sb['tail'][::-1],sb['sum'])
+    lags = range(-K,K+1)
+    suma = asarray([sa['sum']-(taila[k] if k >= 0 else heada[-k]) for k in lags])
+    sumb = asarray([sb['sum']-(headb[k] if k >= 0 else tailb[-k]) for k in lags])
+    count = asarray([max(n-abs(k),0) for k in lags])
+    return (raw-db*suma-da*sumb+count*da*db)/(n*sqrt(var))
+
+class Spectra(object):
+    """
+    Spectra of a score track, computed once (by blocks) for `correlation_matrix`,
+    so that the track can be correlated with other ones without being read again.
+    If *path* is given, spectra are written to this file instead of memory, and
+    can be reloaded later with `Spectra.load`. Example::
+
+        s1 = Spectra(track1, regions, limits=(-500,500), path='track1.spectra')
+        s1 = Spectra.load('track1.spectra')
+        corr = correlation_matrix([s1,track2,track3], regions, limits=(-500,500))
+
+    Parameters are those of `correlation_matrix`, which must be called with the same
+    *regions*, *limits*, *block_size* and *dtype*.
+    """
+    def __init__(self, track, regions, limits=(-1000,1000), block_size=None, dtype=float32, path=None):
+        n = sum(r[2]-r[1] for r in _region_list(regions))
+        self.layout = _correlation_layout(n, limits, block_size)
+        self.dtype = dtype
+        self.stats = {}
+        limits, K, block_size, nfft = self.layout
+        shape = ((n+block_size-1)/block_size, 2, nfft/2+1)
+        ctype = complex64 if dtype == float32 else complex128
+        if path:
+            self.data = open_memmap(path, mode='w+', dtype=ctype, shape=shape)
+        else:
+            self.data = zeros(shape, dtype=ctype)
+        for j,(A,W) in enumerate(_block_spectra(track, regions, K, block_size, nfft, dtype, self.stats)):
+            self.data[j,0] = A
+            self.data[j,1] = W
+        if path:
+            self.data.flush()
+            with open(path+'.meta','wb') as f:
+                cPickle.dump((self.layout,self.dtype,self.stats), f, cPickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        """Return the spectra written to file *path* (memory-mapped, read-only)."""
+        spectra = cls.__new__(cls)
+        with open(path+'.meta','rb') as f:
+            spectra.layout, spectra.dtype, spectra.stats = cPickle.load(f)
+        spectra.data = open_memmap(path, mode='r')
+        return spectra
+
+    def blocks(self):
+        """Yield the pairs of spectra of successive blocks."""
+        for j in xrange(len(self.data)):
+            yield self.data[j,0], self.data[j,1]
+
+def correlation_matrix(trackList, regions, limits=(-1000,1000), block_size=None, dtype=float32):
+    """
+    Calculates the cross-correlation between every pair of tracks in *trackList* (see `correlation`)
+    and returns an array *C* of shape (n, n, limits[1]-limits[0]+1) with n = len(trackList), where
+    *C[i,j]* is the correlation vector of tracks i and j at lags [L,L+1,...,R-1,R].
+
+    The spectrum (real FFT, of a fast size) of each track is computed once and shared by all pairs,
+    instead of once per pair. Tracks can also be given as `Spectra` objects, computed beforehand.
+    Signals are processed by blocks of *block_size* positions, so that memory does not depend
+    on the total length of *regions*: about (n*(n+1)/2 + 2*n) * (block_size + 2*max(|L|,|R|))
+    complex numbers are held at once. Smaller blocks also make the final inverse transform
+    of each pair cheaper.
+    Spectra are stored in single precision unless *dtype* is `numpy.float64`.
+
+    :param trackList: list of FeatureStream or `Spectra` objects.
+    :param regions: a tuple (start,end) or a FeatureStream with the bounds of the regions to consider (see `unroll_array`).
+        In the latter case, all regions will be concatenated.
+    :param limits: (tuple (int,int)) maximum lag to consider. [-1000,1000]
+    :param block_size: (int) number of positions processed at once (at least the largest lag).
+        [max(65536, 16 times the largest lag)]
+    :param dtype: `numpy.float32` or `numpy.float64`, precision of the FFTs. [numpy.float32]
+    :rtype: numpy.ndarray
+    """
+    if isinstance(regions,FeatureStream):
+        regions = _region_list(regions)
+    n = sum(r[2]-r[1] for r in _region_list(regions))
+    layout = _correlation_layout(n, limits, block_size)
+    limits, K, block_size, nfft = layout
+    stats = []
+    iters = []
+    for t in trackList:
+        if isinstance(t,Spectra):
+            if t.layout != layout or t.dtype != dtype:
+                raise ValueError("Spectra computed with different parameters: %s." % (t.layout,))
+            stats.append(t.stats)
+            iters.append(t.blocks())
+        else:
+            stats.append({})
+            iters.append(_block_spectra(t, regions, K, block_size, nfft, dtype, stats[-1]))
+    ntracks = len(trackList)
+    ctype = complex64 if dtype == float32 else complex128
+    acc = dict(((p,q),zeros(nfft/2+1, dtype=ctype)) for p in range(ntracks) for q in range(p,ntracks))
+    for spectra in zip(*iters):
+        for (p,q),a in acc.iteritems():
+            a += conjugate(spectra[p][0])*spectra[q][1]
+    result = zeros((ntracks,ntracks,limits[1]-limits[0]+1))
+    for (p,q),a in acc.iteritems():
+        corr = _reduced_correlation(irfft(a,nfft)[:2*K+1], stats[p], stats[q], K)
+        result[p,q] = corr[limits[0]+K:limits[1]+K+1]
+        result[q,p] = corr[::-1][limits[0]+K:limits[1]+K+1]
+    return result
+
 def correlation(trackList, regions, limits=(-1000,1000), with_acf=False):
     """
     Calculates the cross-correlation between two streams and
@@ -58,37 +251,21 @@ def correlation(trackList, regions, limits=(-1000,1000), with_acf=False):
                 |_____ /^\ _________| lag +8
         |______________/^\__|  <-
 
+    Each track is transformed once, see `correlation_matrix`.
+
     :param trackList: list of FeatureStream objects
-    :param regions: a tuple (start,end) or a FeatureStream with the bounds of the regions to consider (see `unroll`).
+    :param regions: a tuple (start,end) or a FeatureStream with the bounds of the regions to consider (see `unroll_array`).
         In the latter case, all regions will be concatenated.
     :param limits: (tuple (int,int)) maximum lag to consider. [-1000,1000]
     :param with_acf: (bool) include auto-correlations. [False]
     :rtype: list of floats, or list of lists of floats.
     """
-    ##### One could profit from numpy to reduce the memory space used for
-    ##### storing these - long - arrays ('dtype' is float64 by default).
-    if isinstance(regions,FeatureStream):
-        _reg = list(regions)
-        x = [array([s[0] for s in unroll(t,FeatureStream(_reg,fields=regions.fields))])
-             for t in trackList]
-        _reg = []
-    else:
-        x = [array([s[0] for s in unroll(t,regions)]) for t in trackList]
-    x = [vec_reduce(t) for t in x]
-    if limits[1]-limits[0] > 2*len(x[0]):
-        limits = (-len(x[0])+1,len(x[0])-1)
-    N = len(x[0])+limits[1]-limits[0]-1
-    ##### convert to nearest power of 2, fft gets orders of magnitude faster...
-    N = 2**int(log(2+N,2)+.5)
-    def _corr(x1,x2,N):
-        corr = ifft(conjugate(fft(x1,N))*fft(x2,N))/len(x1)
-        corr = ncat((corr[N+limits[0]:], corr[:limits[1]+1]))
-        return real(corr)
+    C = correlation_matrix(trackList, regions, limits, dtype=float64)
     if with_acf:
-        return [[_corr(x1,x2,N) for x2 in x[n:]] for n,x1 in enumerate(x)]
+        return [[C[n,m] for m in range(n,len(trackList))] for n in range(len(trackList))]
     elif len(trackList) == 2:
-        return _corr(x[0],x[1],N)
+        return C[0,1]
     else:
-        return [[_corr(x1,x2,N) for x2 in x[n+1:]] for n,x1 in enumerate(x[:-1])]
+        return [[C[n,m] for m in range(n+1,len(trackList))] for n in range(len(trackList)-1)]
 
 ################################################################################
@@ -0,0 +1,167 @@
+"""
+Lazy query plans for gfminer operations. A plan is a tree of nodes describing where
+streams come from and what is done to them, e.g.::
+
+    from bbcflib.gfminer import plan, stream
+    scores = plan.Sort(plan.Select(plan.Read(track("density.sql")), selection={'chr':'chr1'}))
+    genes = plan.Select(plan.Read(track("genes.bed")), fields=['chr','start','end','name'],
+                        selection={'chr':'chr1'})
+    p = plan.Apply(stream.score_by_feature, {'trackScores': [scores], 'trackFeatures': [genes]})
+    p = plan.optimize(p)
+    print p.explain()
+    result = p.execute()
+
+Nothing is read before `execute` is called. `optimize` rewrites the tree so that:
+
+* field projections and selections are pushed down into the track's `read`
+  (sqlite tracks then apply them in the query, text tracks while parsing),
+* consecutive `Select` steps are fused into one.
+
+`gfminer.run` builds and optimizes such a plan for every call. It does not sort its
+inputs: as for direct calls, operations expecting sorted streams need sorted files
+(sqlite tracks are read sorted by 'start' and 'end'), or an explicit `Sort` step.
+"""
+
+__all__ = ['Read','Select','Sort','Apply','optimize']
+
+from bbcflib.track import FeatureStream, compile_selection
+from bbcflib.gfminer.common import select, sorted_stream
+
+def _alternatives(selection):
+    """Return *selection* as a list of dicts (alternatives), or None if it cannot be
+    expressed this way (e.g. a FeatureStream)."""
+    if selection is None: return None
+    if isinstance(selection,basestring): return [{'chr': selection}]
+    if isinstance(selection,dict): return [selection]
+    if isinstance(selection,(list,tuple)) and all(isinstance(s,(basestring,dict)) for s in selection):
+        return [{'chr': s} if isinstance(s,basestring) else s for s in selection]
+    return None
+
+def _conjunction(sel1, sel2):
+    """Selection satisfied by items passing both *sel1* and *sel2* (lists of alternatives),
+    or None if they cannot be combined (filters on a same field, or selections that are
+    not dicts, see `_alternatives`)."""
+    if sel1 is None or sel2 is None: return None
+    result = []
+    for a in sel1:
+        for b in sel2:
+            if any(k in a for k in b): return None
+            result.append(dict(a.items()+b.items()))
+    return result
+
+###############################################################################
+class Node(object):
+    """Base class of plan nodes."""
+    def children(self):
+        return []
+
+    def describe(self):
+        return self.__class__.__name__
+
+    def explain(self, indent=0):
+        """Return a text representation of the plan, one node per line."""
+        lines = ["  "*indent+self.describe()]
+        for child in self.children():
+            lines.append(child.explain(indent+1))
+        return "\n".join(lines)
+
+    def execute(self):
+        raise NotImplementedError
+
+class Read(Node):
+    """Read *track* with the given *selection* and *fields* (see `Track.read`)."""
+    def __init__(self, track, selection=None, fields=None):
+        self.track = track
+        self.selection = selection
+        self.fields = fields
+
+    def describe(self):
+        return "Read(%s, selection=%s, fields=%s)" % (self.track.path,self.selection,self.fields)
+
+    def execute(self):
+        return self.track.read(selection=self.selection, fields=self.fields)
+
+class Select(Node):
+    """Keep only *fields* of the items of *child* satisfying *selection*
+    (see `bbcflib.track.compile_selection`, ranges include their bounds as in `Track.read`)."""
+    def __init__(self, child, fields=None, selection=None):
+        self.child = child
+        self.fields = fields
+        self.selection = selection
+
+    def children(self):
+        return [self.child]
+
+    def describe(self):
+        return "Select(fields=%s, selection=%s)" % (self.fields,self.selection)
+
+    def execute(self):
+        stream = self.child.execute()
+        if self.selection:
+            _pass = compile_selection(self.selection, stream.fields)
+            stream = FeatureStream((x for x in stream if _pass(x)), fields=stream.fields)
+        if self.fields:
+            stream = select(stream, self.fields)
+        return stream
+
+class Sort(Node):
+    """Sort the output of *child* w.r.t. *fields* (see `common.sorted_stream`)."""
+    def __init__(self, child, fields=['chr','start','end'], chrnames=[]):
+        self.child = child
+        self.fields = fields
+        self.chrnames = chrnames
+
+    def children(self):
+        return [self.child]
+
+    def describe(self):
+        return "Sort(fields=%s)" % (self.fields,)
+
+    def execute(self):
+        return sorted_stream(self.child.execute(), chrnames=self.chrnames, fields=self.fields)
+
+class Apply(Node):
+    """Call *funct* with the keyword arguments *params*, plus, for each key of *inputs*,
+    the list of streams produced by the corresponding nodes."""
+    def __init__(self, funct, inputs, params=None):
+        self.funct = funct
+        self.inputs = inputs
+        self.params = params or {}
+
+    def children(self):
+        return [n for k in sorted(self.inputs) for n in self.inputs[k]]
+
+    def describe(self):
+        return "Apply(%s, %s)" % (self.funct.__name__, ", ".join(sorted(self.inputs)+sorted(self.params)))
+
+    def execute(self):
+        kwargs = dict(self.params)
+        for k,nodes in self.inputs.iteritems():
+            kwargs[k] = [n.execute() for n in nodes]
+        return self.funct(**kwargs)
+
+###############################################################################
+def optimize(node):
+    """Return an equivalent plan where selections and projections are pushed down into
+    `Read` nodes and consecutive `Select` nodes are fused."""
+    if isinstance(node,Apply):
+        return Apply(node.funct, dict((k,[optimize(n) for n in nodes])
+                                      for k,nodes in node.inputs.iteritems()), node.params)
+    if isinstance(node,Sort):
+        return Sort(optimize(node.child), node.fields, node.chrnames)
+    if isinstance(node,Select):
+        child = optimize(node.child)
+        if not(node.fields or node.selection): return child
+        if isinstance(child,(Select,Read)):
+            if not node.selection:
+                selection = child.selection
+            elif not child.selection:
+                selection = node.selection
+            else:
+                selection = _conjunction(_alternatives(child.selection),_alternatives(node.selection))
+            if selection is not None or not(node.selection or child.selection):
+                if isinstance(child,Select):
+                    return optimize(Select(child.child, node.fields or child.fields, selection))
+                return Read(child.track, selection, node.fields or child.fields)
+        return Select(child, node.fields, node.selection)
+    return node
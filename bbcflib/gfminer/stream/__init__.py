@@ -14,7 +14,18 @@ _members = {'merge_scores': ['trackList'],
             'combine': ['trackList'],
             'segment_features': ['trackList'],
             'getNearestFeature': ['features','annotations'],
+            'overlap_genome': ['trackList','trackFeatures'],
+            'intersectBed': ['a','b'],
+            'mergeBed': ['i'],
+            'closestBed': ['a','b'],
+            'coverageBed': ['a','b'],
+            'complementBed': ['i'],
+            'slopBed': ['i'],
+            'flankBed': ['i'],
+            'mapBed': ['a','b'],
             }
+# Operators taking streams spanning all chromosomes at once
+_genomewide = ['overlap_genome','complementBed']
 
 class stream(gfminerGroup):
     def __init__(self):
@@ -24,5 +35,6 @@ class stream(gfminerGroup):
 from .intervals import *
 from .scores import *
 from .annotate import *
+from .bedtools import *
 
 
@@ -1,4 +1,3 @@
-import sys
 from bbcflib.gfminer import common
 from bbcflib.track import FeatureStream
 
@@ -25,7 +24,10 @@ def getNearestFeature(features, annotations, thresholdPromot=2000, thresholdInte
 
     :param features: (FeatureStream) features track.
     :param annotations: (FeatureStream) gene annotation track
-        (e.g. as obtained with assembly.gene_track()).
+        (e.g. as obtained with assembly.gene_track()), or a `common.IntervalIndex` of it.
+        An index can be built once, e.g. for the whole genome, and reused for several calls.
+        If both tracks have a 'chr' field, features are only compared to genes of the
+        same chromosome.
     :param thresholdPromot: (int) associates the promoter of each gene which promoter is within
         this distance of the feature. Above the threshold, associates only the closest. [2000]
     :param thresholdInter: (int) no gene beyond this distance will be considered. [100000]
@@ -52,24 +54,27 @@ def getNearestFeature(features, annotations, thresholdPromot=2000, thresholdInte
        -----|______|------|------------------|______|-----  (attributed to gene1)
              gene 1      thresholdUTR         gene 2
     """
-    def _get_feature(_t,_a):
-        F = []
-        _a = common.sentinelize(_a, [sys.maxint]*len(_a.fields))
+    def _get_feature(_t,index):
+        _annot = common.getter([index.fields.index(f) for f in ['start','end','name','strand']])
+        chroms = index.chromosomes
+        if 'chr' in _t.fields and chroms != [None]:
+            chri = _t.fields.index('chr')
+            default_chrom = None
+        else:
+            chri = None
+            default_chrom = chroms[0] if len(chroms) == 1 else None
         for peak in _t:
             distMinBefore = distMinAfter = thresholdInter+1
             gene = dist = typeLoc = ""
             geneBefore = geneAfter = strandBefore = strandAfter = None
             included = 0
-            # keep only genes which don't start too far
-            for annot in _a:
-                F.append(annot)
-                if annot[0] > peak[1]+thresholdInter: break
-            # remove genes that end too far
-            fpop = -1 # always keep one gene before
-            for annot in F:
-                if annot[1] > peak[0]-thresholdInter: break
-                fpop += 1
-            if fpop>0: F = F[fpop:]
+            # Candidates: genes touching the peak, in the annotation order,
+            # and the closest gene on each side (the first one in case of ties)
+            chrom = peak[chri] if chri is not None else default_chrom
+            F = index.overlap(peak[0]-1, peak[1]+1, chrom)
+            before = index.preceding(peak[0], chrom)[0]
+            after = index.following(peak[1], chrom)[0]
+            F = [_annot(x) for x in F+before[:1]+after[:1]]
             for annot in F:
                 # if the peak is totally included in the gene
                 if (peak[0]>=annot[0]) and (annot[1]>=peak[1]):
@@ -203,7 +208,8 @@ def getNearestFeature(features, annotations, thresholdPromot=2000, thresholdInte
     if isinstance(features,(tuple,list)): features = features[0]
     if isinstance(annotations,(tuple,list)): annotations = annotations[0]
     features = common.reorder(features,['start','end'])
-    annot = common.reorder(annotations,['start','end','name','strand'])
+    if not isinstance(annotations,common.IntervalIndex):
+        annotations = common.IntervalIndex(annotations)
     _fields = features.fields+['gene','location_type','distance']
-    return FeatureStream(_get_feature(features,annot),fields=_fields)
+    return FeatureStream(_get_feature(features,annotations),fields=_fields)
 
@@ -0,0 +1,418 @@
+"""
+In-process equivalents of the most used `BedTools <http://bedtools.readthedocs.org>`_ commands
+wrapped in :mod:`bbcflib.gfminer.bedtools`. They take and return
+:func:`FeatureStream <bbcflib.track.FeatureStream>` objects instead of file names,
+so that they can be chained without writing intermediate files, e.g.::
+
+    from bbcflib.gfminer.stream import intersectBed, mergeBed, slopBed
+    t = track("peaks.bed")
+    s = mergeBed(intersectBed(slopBed(t.read(), g=t.chrmeta, b=100), genes.read(), u=True))
+
+Argument names are those of the command-line options. The second stream (*b*) is loaded
+in memory (see `common.IntervalIndex`), the first one (*a* or *i*) is streamed.
+Intervals are half-open as in bed files, so that book-ended features do not overlap.
+When both streams of a command have a field with the same name, the one from *b* is
+renamed with a suffix '_b' in the output.
+"""
+
+import itertools
+from bbcflib.gfminer import common
+from bbcflib.gfminer.stream.intervals import concatenate
+from bbcflib.track import FeatureStream, strand_to_int
+
+def _stream(s):
+    """Concatenate *s* if it is a list of streams (as passed by `gfminer.run`)."""
+    if isinstance(s,(list,tuple)):
+        return s[0] if len(s) == 1 else concatenate(list(s))
+    return s
+
+def _chrom_lengths(g):
+    """Return a dict {chromosome: length} from a chrmeta dictionary or the name
+    of a genome file (with lines 'chr<tab>length'), and the list of chromosomes
+    in the order of the file (sorted for a dictionary)."""
+    if isinstance(g,basestring):
+        with open(g) as f:
+            g = [line.split()[:2] for line in f if line.strip() and not line.startswith('#')]
+        return dict((c,int(l)) for c,l in g), [c for c,l in g]
+    return (dict((c,v['length'] if isinstance(v,dict) else v) for c,v in g.iteritems()),
+            sorted(g.keys()))
+
+def _b_fields(afields, bfields):
+    return [f+'_b' if f in afields else f for f in bfields]
+
+def _indexes(a, b, s, S):
+    """Index *b* (by strand if *s* or *S*), and return a function giving, for an item
+    of *a*, the index and chromosome to query."""
+    ci = a.fields.index('chr') if ('chr' in a.fields and 'chr' in b.fields) else None
+    if not(s or S):
+        index = common.IntervalIndex(b)
+        return lambda x: (index, x[ci] if ci is not None else None)
+    bsi = b.fields.index('strand')
+    asi = a.fields.index('strand')
+    rows = {}
+    for y in b:
+        rows.setdefault(strand_to_int(y[bsi]),[]).append(y)
+    index = dict((k,common.IntervalIndex(FeatureStream(v,fields=b.fields))) for k,v in rows.iteritems())
+    empty = common.IntervalIndex(FeatureStream([],fields=b.fields))
+    sign = 1 if s else -1
+    return lambda x: (index.get(sign*strand_to_int(x[asi]),empty), x[ci] if ci is not None else None)
+
+def _operation(o):
+    """Function aggregating a list of values as bedtools' '-o' option *o*."""
+    ops = {'sum': sum,
+           'min': min,
+           'max': max,
+           'mean': lambda v: sum(v)/float(len(v)),
+           'median': _median,
+           'count': len,
+           'count_distinct': lambda v: len(set(v)),
+           'distinct': lambda v: ",".join(str(x) for x in _unique(v)),
+           'collapse': lambda v: ",".join(str(x) for x in v),
+           'first': lambda v: v[0],
+           'last': lambda v: v[-1]}
+    if not(o in ops):
+        raise ValueError("Unknown operation %s, must be one of %s." %(o,", ".join(sorted(ops))))
+    return ops[o]
+
+def _median(v):
+    v = sorted(v)
+    n = len(v)
+    return v[n//2] if n%2 else (v[n//2-1]+v[n//2])/2.
+
+def _unique(v):
+    seen = set()
+    return [x for x in v if not(x in seen or seen.add(x))]
+
+def _columns(fields, c, o):
+    """Indices, operations, aggregating functions and output names of the columns *c*
+    with operations *o*."""
+    if isinstance(c,basestring): c = c.split(',')
+    if isinstance(o,basestring): o = o.split(',')
+    if len(o) == 1: o = o*len(c)
+    if len(o) != len(c):
+        raise ValueError("Need one operation per column, or a single one.")
+    names = [f if c.count(f) == 1 else f+'_'+op for f,op in zip(c,o)]
+    return [fields.index(f) for f in c], o, [_operation(op) for op in o], names
+
+###############################################################################
+def intersectBed(a, b, wa=False, wb=False, wo=False, u=False, v=False, c=False,
+                 f=None, r=False, s=False, S=False):
+    """
+    Equivalent of ``bedtools intersect -a a -b b``: for each feature of *a* and each
+    feature of *b* overlapping it, report the overlapping part of the former.
+
+    :param a: FeatureStream, with fields 'start' and 'end' at least.
+    :param b: FeatureStream.
+    :param wa: (bool) report the original feature of *a* rather than the overlap. [False]
+    :param wb: (bool) also report the overlapping feature of *b*. [False]
+    :param wo: (bool) report the original features of *a* and *b*, and the number of
+        overlapping bases (field 'overlap'). [False]
+    :param u: (bool) report each feature of *a* once if it overlaps *b*. [False]
+    :param v: (bool) report the features of *a* that do not overlap *b*. [False]
+    :param c: (bool) report each feature of *a* with the number of overlapping
+        features of *b* (field 'count'). [False]
+    :param f: (float) minimum overlap, as a fraction of the length of the feature of *a*. [None]
+    :param r: (bool) require the fraction *f* for the feature of *b* as well. [False]
+    :param s: (bool) only consider overlaps on the same strand. [False]
+    :param S: (bool) only consider overlaps on opposite strands. [False]
+    :rtype: FeatureStream
+    """
+    a = _stream(a); b = _stream(b)
+    _index = _indexes(a, b, s, S)
+    asi = a.fields.index('start'); aei = a.fields.index('end')
+    bsi = b.fields.index('start'); bei = b.fields.index('end')
+    def _hits(x):
+        index, chrom = _index(x)
+        hits = index.overlap(x[asi], x[aei], chrom)
+        if f:
+            la = x[aei]-x[asi]
+            hits = [y for y in hits
+                    if min(x[aei],y[bei])-max(x[asi],y[bsi]) >= f*la
+                    and not(r and min(x[aei],y[bei])-max(x[asi],y[bsi]) < f*(y[bei]-y[bsi]))]
+        return hits
+    def _clip(x,y):
+        x = list(x)
+        x[asi] = max(x[asi],y[bsi])
+        x[aei] = min(x[aei],y[bei])
+        return tuple(x)
+    def _generate():
+        for x in a:
+            hits = _hits(x)
+            if v:
+                if not hits: yield x
+            elif u:
+                if hits: yield x
+            elif c:
+                yield x+(len(hits),)
+            elif wo:
+                for y in hits:
+                    yield x+tuple(y)+(min(x[aei],y[bei])-max(x[asi],y[bsi]),)
+            else:
+                for y in hits:
+                    z = x if wa else _clip(x,y)
+                    yield z+tuple(y) if wb else z
+    fields = list(a.fields)
+    if c: fields += ['count']
+    elif wo: fields += _b_fields(a.fields,b.fields)+['overlap']
+    elif wb and not(u or v): fields += _b_fields(a.fields,b.fields)
+    return FeatureStream(_generate(), fields=fields)
+
+def mergeBed(i, d=0, s=False, c=None, o='sum'):
+    """
+    Equivalent of ``bedtools merge -i i``: merge overlapping and book-ended features
+    into one. The stream must be sorted w.r.t. 'chr' and 'start'.
+
+    :param i: FeatureStream.
+    :param d: (int) maximum distance between features to be merged. [0]
+    :param s: (bool) only merge features on the same strand. [False]
+    :param c: (str or list of str) fields to aggregate in the merged features. [None]
+    :param o: (str or list of str) operations applied to the fields *c*, among 'sum', 'min', 'max',
+        'mean', 'median', 'count', 'count_distinct', 'distinct', 'collapse', 'first', 'last'. ['sum']
+    :rtype: FeatureStream with fields 'chr' (if in *i*), 'start', 'end', and *c*.
+    """
+    i = _stream(i)
+    si = i.fields.index('start'); ei = i.fields.index('end')
+    ci = i.fields.index('chr') if 'chr' in i.fields else None
+    sti = i.fields.index('strand') if s else None
+    cols, _, ops, names = _columns(i.fields, c or [], o)
+    def _output(chrom, cluster):
+        start, end, rows = cluster
+        z = (start, end)+tuple(op([r[k] for r in rows]) for k,op in zip(cols,ops))
+        return (chrom,)+z if ci is not None else z
+    def _generate():
+        for chrom, rows in itertools.groupby(i, lambda x: x[ci] if ci is not None else None):
+            current = {}  # one cluster per strand
+            closed = []
+            for x in rows:
+                key = strand_to_int(x[sti]) if s else None
+                cl = current.get(key)
+                if cl is not None and x[si] <= cl[1]+d:
+                    cl[1] = max(cl[1],x[ei])
+                    cl[2].append(x)
+                    continue
+                if cl is not None:
+                    if s: closed.append(cl)
+                    else: yield _output(chrom,cl)
+                current[key] = [x[si],x[ei],[x]]
+            closed.extend(current.values())
+            closed.sort(key=lambda cl: (cl[0],cl[1]))
+            for cl in closed:
+                yield _output(chrom,cl)
+    fields = (['chr'] if ci is not None else [])+['start','end']+names
+    return FeatureStream(_generate(), fields=fields)
+
+def closestBed(a, b, d=False, t='all', io=False, s=False, S=False):
+    """
+    Equivalent of ``bedtools closest -a a -b b``: report each feature of *a* with its
+    closest feature(s) in *b* (overlapping ones if any). If *b* has no feature on the
+    chromosome, the fields of *b* are set to '.' (-1 for 'start' and 'end').
+
+    :param a: FeatureStream.
+    :param b: FeatureStream.
+    :param d: (bool) add the distance to the closest feature (field 'distance'): 0 if they overlap,
+        the number of bases between them plus one otherwise (as bedtools does), -1 if there is none. [False]
+    :param t: (str) how ties are reported: 'all', 'first' or 'last' (in the order of *b*). ['all']
+    :param io: (bool) ignore overlapping features. [False]
+    :param s: (bool) only consider features on the same strand. [False]
+    :param S: (bool) only consider features on opposite strands. [False]
+    :rtype: FeatureStream
+    """
+    a = _stream(a); b = _stream(b)
+    _index = _indexes(a, b, s, S)
+    asi = a.fields.index('start'); aei = a.fields.index('end')
+    missing = tuple(-1 if f in ['start','end'] else '.' for f in b.fields)
+    def _closest(x):
+        index, chrom = _index(x)
+        if not io:
+            hits = index.overlap(x[asi], x[aei], chrom)
+            if hits: return hits, 0
+        left, dl = index.preceding(x[asi], chrom, strict=False)
+        right, dr = index.following(x[aei], chrom, strict=False)
+        if dl is None and dr is None: return [], -1
+        if dr is None or (dl is not None and dl < dr): return left, dl+1
+        if dl is None or dr < dl: return right, dr+1
+        return left+right, dl+1
+    def _generate():
+        for x in a:
+            hits, dist = _closest(x)
+            if not hits: hits = [missing]
+            elif t == 'first': hits = hits[:1]
+            elif t == 'last': hits = hits[-1:]
+            for y in hits:
+                yield x+tuple(y)+(dist,) if d else x+tuple(y)
+    fields = list(a.fields)+_b_fields(a.fields,b.fields)+(['distance'] if d else [])
+    return FeatureStream(_generate(), fields=fields)
+
+def coverageBed(a, b, s=False, S=False):
+    """
+    Equivalent of ``bedtools coverage -a a -b b`` (bedtools >= 2.24): report each
+    feature of *a* with the number of features of *b* overlapping it ('count'),
+    the number of its bases they cover ('covered'), its length ('length') and the
+    covered fraction ('fraction').
+
+    :param a: FeatureStream.
+    :param b: FeatureStream, e.g. reads.
+    :param s: (bool) only count features on the same strand. [False]
+    :param S: (bool) only count features on opposite strands. [False]
+    :rtype: FeatureStream
+    """
+    a = _stream(a); b = _stream(b)
+    _index = _indexes(a, b, s, S)
+    asi = a.fields.index('start'); aei = a.fields.index('end')
+    bsi = b.fields.index('start'); bei = b.fields.index('end')
+    def _generate():
+        for x in a:
+            index, chrom = _index(x)
+            hits = sorted((max(y[bsi],x[asi]),min(y[bei],x[aei]))
+                          for y in index.overlap(x[asi], x[aei], chrom))
+            covered = 0
+            pos = x[asi]
+            for start,end in hits:
+                if end > pos:
+                    covered += end-max(start,pos)
+                    pos = end
+            length = x[aei]-x[asi]
+            yield x+(len(hits), covered, length, covered/float(length) if length else 0.)
+    return FeatureStream(_generate(), fields=list(a.fields)+['count','covered','length','fraction'])
+
+def complementBed(i, g):
+    """
+    Equivalent of ``bedtools complement -i i -g g``: report the regions of the genome
+    not covered by any feature. The stream must be sorted w.r.t. 'start' within each
+    chromosome, and its chromosomes must follow the order of *g*. As bedtools does,
+    chromosomes of *g* without any feature are reported entirely, at their place in *g*
+    (the lines order of a genome file, or the sorted names of a dictionary).
+
+    :param i: FeatureStream, with fields 'chr', 'start' and 'end'.
+    :param g: the chromosome lengths: a chrmeta dictionary (e.g. `Track.chrmeta`),
+        or a genome file (lines 'chr<tab>length').
+    :rtype: FeatureStream with fields 'chr', 'start' and 'end'.
+    """
+    i = _stream(i)
+    chrlen, chrnames = _chrom_lengths(g)
+    si = i.fields.index('start'); ei = i.fields.index('end'); ci = i.fields.index('chr')
+    rank = dict((c,n) for n,c in enumerate(chrnames))
+    def _generate():
+        seen = set()
+        k = 0 # chromosomes of *g* before rank *k* are done
+        for chrom, rows in itertools.groupby(i, lambda x: x[ci]):
+            if not(chrom in chrlen): continue
+            for c in chrnames[k:rank[chrom]]:
+                if not(c in seen): yield (c, 0, chrlen[c])
+            k = max(k, rank[chrom]+1)
+            seen.add(chrom)
+            pos = 0
+            for x in rows:
+                if x[si] > pos: yield (chrom, pos, x[si])
+                pos = max(pos, x[ei])
+            if pos < chrlen[chrom]: yield (chrom, pos, chrlen[chrom])
+        for c in chrnames[k:]:
+            if not(c in seen): yield (c, 0, chrlen[c])
+    return FeatureStream(_generate(), fields=['chr','start','end'])
+
+def _extensions(i, g, b, l, r, s):
+    """Common part of `slopBed` and `flankBed`: return a function giving, for an item
+    of *i*, the sizes of its left and right extensions, and the chromosome length."""
+    if b is not None: l = r = b
+    if l is None or r is None:
+        raise ValueError("Need either b, or both l and r.")
+    chrlen = _chrom_lengths(g)[0]
+    ci = i.fields.index('chr')
+    sti = i.fields.index('strand') if s else None
+    def _ext(x):
+        if s and strand_to_int(x[sti]) == -1: return r, l, chrlen.get(x[ci])
+        return l, r, chrlen.get(x[ci])
+    return _ext
+
+def slopBed(i, g, b=None, l=None, r=None, s=False):
+    """
+    Equivalent of ``bedtools slop -i i -g g``: extend each feature on both sides,
+    without going beyond the chromosome bounds.
+
+    :param i: FeatureStream, with fields 'chr', 'start' and 'end'.
+    :param g: the chromosome lengths: a chrmeta dictionary (e.g. `Track.chrmeta`),
+        or a genome file (lines 'chr<tab>length').
+    :param b: (int) number of bases to add on both sides. [None]
+    :param l: (int) number of bases to add before the start. [None]
+    :param r: (int) number of bases to add after the end. [None]
+    :param s: (bool) *l* and *r* are relative to the strand (*l* upstream). [False]
+    :rtype: FeatureStream
+    """
+    i = _stream(i)
+    _ext = _extensions(i, g, b, l, r, s)
+    si = i.fields.index('start'); ei = i.fields.index('end')
+    def _generate():
+        for x in i:
+            left, right, length = _ext(x)
+            x = list(x)
+            x[si] = max(0, x[si]-left)
+            x[ei] = x[ei]+right if length is None else min(length, x[ei]+right)
+            yield tuple(x)
+    return FeatureStream(_generate(), fields=i.fields)
+
+def flankBed(i, g, b=None, l=None, r=None, s=False):
+    """
+    Equivalent of ``bedtools flank -i i -g g``: report the flanking regions of
+    each feature (the left one first), within the chromosome bounds. Empty flanks
+    are not reported.
+
+    :param i: FeatureStream, with fields 'chr', 'start' and 'end'.
+    :param g: the chromosome lengths: a chrmeta dictionary (e.g. `Track.chrmeta`),
+        or a genome file (lines 'chr<tab>length').
+    :param b: (int) size of the flanks on both sides. [None]
+    :param l: (int) size of the flank before the start. [None]
+    :param r: (int) size of the flank after the end. [None]
+    :param s: (bool) *l* and *r* are relative to the strand (*l* upstream). [False]
+    :rtype: FeatureStream
+    """
+    i = _stream(i)
+    _ext = _extensions(i, g, b, l, r, s)
+    si = i.fields.index('start'); ei = i.fields.index('end')
+    def _generate():
+        for x in i:
+            left, right, length = _ext(x)
+            if left > 0 and x[si] > 0:
+                y = list(x)
+                y[si] = max(0, x[si]-left)
+                y[ei] = x[si]
+                yield tuple(y)
+            if right > 0 and (length is None or x[ei] < length):
+                y = list(x)
+                y[si] = x[ei]
+                y[ei] = x[ei]+right if length is None else min(length, x[ei]+right)
+                yield tuple(y)
+    return FeatureStream(_generate(), fields=i.fields)
+
+def mapBed(a, b, c='score', o='sum', f=None, s=False, S=False):
+    """
+    Equivalent of ``bedtools map -a a -b b``: report each feature of *a* with the
+    values of fields *c* of the features of *b* overlapping it, aggregated by the
+    operations *o*. Without any overlapping feature, the value is '.' (0 for counts).
+
+    :param a: FeatureStream.
+    :param b: FeatureStream.
+    :param c: (str or list of str) fields of *b* to aggregate. ['score']
+    :param o: (str or list of str) operations applied to the fields *c*
+        (see `mergeBed`). ['sum']
+    :param f: (float) minimum overlap, as a fraction of the length of the feature of *a*. [None]
+    :param s: (bool) only consider features on the same strand. [False]
+    :param S: (bool) only consider features on opposite strands. [False]
+    :rtype: FeatureStream
+    """
+    a = _stream(a); b = _stream(b)
+    _index = _indexes(a, b, s, S)
+    asi = a.fields.index('start'); aei = a.fields.index('end')
+    bsi = b.fields.index('start'); bei = b.fields.index('end')
+    cols, opnames, ops, names = _columns(b.fields, c, o)
+    empty = tuple(0 if op in ['count','count_distinct'] else '.' for op in opnames)
+    def _generate():
+        for x in a:
+            index, chrom = _index(x)
+            hits = index.overlap(x[asi], x[aei], chrom)
+            if f:
+                hits = [y for y in hits if min(x[aei],y[bei])-max(x[asi],y[bsi]) >= f*(x[aei]-x[asi])]
+            if hits:
+                yield x+tuple(op([y[k] for y in hits]) for k,op in zip(cols,ops))
+            else:
+                yield x+empty
+    return FeatureStream(_generate(), fields=list(a.fields)+_b_fields(a.fields,names))
@@ -1,6 +1,7 @@
-import sys
+import sys, heapq, bisect, itertools
+from numpy import asarray, where
 from bbcflib.gfminer import common
-from bbcflib.track import FeatureStream
+from bbcflib.track import FeatureStream, compile_selection
 
 # "tracks" and "streams" refer to FeatureStream objects all over here.
 
@@ -43,6 +44,8 @@ def concatenate(trackList, fields=None, remove_duplicates=False, group_by=None,
         sorted w.r.t the *N* first fields."""
         current = [x.next()[:N] for x in _t] # init
         allfields = [t.fields for t in _t]
+        if group_by:
+            group_idx = [[f.index(g) for g in group_by] for f in allfields]
         n = _find_min(current)
         last = current[n]
         current[n] = _t[n].next()[:N]
@@ -57,7 +60,7 @@ def concatenate(trackList, fields=None, remove_duplicates=False, group_by=None,
             n = _find_min(current)
             if current[n][0] == sys.maxint: break
             if group_by:
-                idx = [allfields[n].index(f) for f in group_by]
+                idx = group_idx[n]
                 if all(current[n][i] == last[i] for i in idx):
                     last = tuple(current[n][i] if i in idx \
                             else aggregate.get(allfields[n][i],common.generic_merge)((last[i],current[n][i])) \
@@ -97,27 +100,17 @@ def selection(trackList,selection):
 
         sel = [{'chr':'chrI', 'start':(1,10000)}, {'chr':'chrI', 'end':(1000000,1500000)}]
 
-    Values can be tuples (range of values), lists (of possible values), or a single element.
+    Values can be tuples (range of values, `None` for an open end), lists (of possible values),
+    functions returning True or False, or a single element.
+    The selection is compiled once into a single predicate, see `bbcflib.track.compile_selection`.
 
     :param trackList: FeatureStream, or list of FeatureStream objects.
     :param selection: (dict, or list of dict) the filter described above.
     """
-    def _check_fields(item,filter):
-        for k,v in filter.iteritems():
-            z = item[k]
-            if isinstance(v,tuple):
-                if float(z) < v[0] or float(z) >= v[1]:
-                    return False
-            elif isinstance(v,list):
-                if z not in v:
-                    return False
-            elif z!= v: return False
-        return True
-
     def _filter(stream,selection):
-        filters = [dict([(stream.fields.index(f),v) for f,v in sel.iteritems()]) for sel in selection]
+        _pass = compile_selection(selection, stream.fields, closed=False)
         for x in stream:
-            if any(_check_fields(x,f) for f in filters): yield x
+            if _pass(x): yield x
 
     if isinstance(trackList,FeatureStream): trackList = [trackList]
     if isinstance(selection,dict): selection = [selection]
@@ -172,6 +165,108 @@ def overlap(trackList,trackFeatures,strict=False,annotate=False,flatten=common.c
     _tf = common.reorder(trackFeatures,['start','end'])
     return FeatureStream(_overlap(_tl,_tf,stranded,strict), _tl.fields)
 
+###############################################################################
+@common.ordered
+def overlap_genome(trackList, trackFeatures, chrnames=None, stranded=None,
+                   fraction=0.0, strict=False):
+    """
+    For each stream in *trackList*, keep only items overlapping at least one element
+    of *trackFeatures*, and add a field 'overlap' with the number of base pairs of the
+    item covered by *trackFeatures*. Unlike `overlap`, the streams may contain any number
+    of chromosomes: both are swept together in a single pass, chromosome after chromosome. ::
+
+        X: ____########_________#############______
+        Y: __________######__######______##________
+        R: ____##########_______#############______
+                  (2)                (6)
+
+    The input streams need to be sorted w.r.t 'chr', 'start' and 'end', with the chromosomes
+    of both streams in the order of *chrnames* (alphabetical order by default, as `run` reads
+    them). Chromosomes missing from one stream are skipped as the other one moves past them,
+    so that only the current chromosome's window is kept in memory.
+    If several tracks are given in either trackList or trackFeatures, they will be
+    concatenated into one.
+
+    :param trackList: FeatureStream - the elements to be filtered.
+    :param trackFeatures: FeatureStream - the filter.
+    :param chrnames: (list of str) the order of the chromosomes in both streams,
+        e.g. ``assembly.chrnames``; chromosomes not listed come last, sorted. [None]
+    :param stranded: (bool) if True, only count features on the same strand as the item.
+        If None, this is done whenever both streams have a 'strand' field. [None]
+    :param fraction: (float) minimum fraction of each item's length that must be covered
+        by *trackFeatures*. [0.0]
+    :param strict: (bool) if True, keep only items entirely containing a feature of
+        *trackFeatures*. [False]
+    :rtype: FeatureStream
+    """
+    def _overlap(tl,tf):
+        has_chr = 'chr' in tl.fields and 'chr' in tf.fields
+        if has_chr:
+            tl_chr = tl.fields.index('chr')
+            tf_chr = tf.fields.index('chr')
+        if stranded:
+            tl_strand = tl.fields.index('strand')
+            tf_strand = tf.fields.index('strand')
+        rank = dict((c,n) for n,c in enumerate(chrnames or []))
+        def _key(c):
+            return (rank.get(c,len(rank)), c)
+        head = [next(tf,None)]
+
+        def _features(chrom):
+            """Features of *chrom* in trackFeatures, skipping those of earlier chromosomes."""
+            k = _key(chrom)
+            while head[0] is not None:
+                y = head[0]
+                c = _key(y[tf_chr])
+                if c > k: return # left for a later chromosome
+                head[0] = next(tf,None)
+                if c == k: yield y
+
+        window = []
+        chrom = None
+        features = tf
+        y = head[0]
+        for x in tl:
+            xstart = x[0]
+            xend = x[1]
+            if has_chr and x[tl_chr] != chrom:
+                if chrom is not None and _key(x[tl_chr]) < _key(chrom):
+                    raise ValueError("Chromosome %s comes after %s in trackList, "
+                                     "not in the order of chrnames." % (x[tl_chr],chrom))
+                chrom = x[tl_chr]
+                window = []
+                features = _features(chrom)
+                y = next(features,None)
+            # load features starting before the end of x
+            while y is not None and y[0] < xend:
+                window.append(y)
+                y = next(features,None)
+            window = [w for w in window if w[1] > xstart]
+            covered = 0
+            contains = False
+            last = xstart
+            for w in window:
+                if w[0] >= xend: break
+                if stranded and w[tf_strand] != x[tl_strand]: continue
+                if w[0] >= xstart and w[1] <= xend: contains = True
+                start = max(w[0],last)
+                end = min(w[1],xend)
+                if end > start:
+                    covered += end-start
+                    last = end
+            if covered == 0: continue
+            if strict and not contains: continue
+            if covered < fraction*(xend-xstart): continue
+            yield x+(covered,)
+
+    if isinstance(trackList,(list,tuple)): trackList = concatenate(trackList)
+    if isinstance(trackFeatures,(list,tuple)): trackFeatures = concatenate(trackFeatures)
+    if stranded is None:
+        stranded = 'strand' in trackList.fields and 'strand' in trackFeatures.fields
+    _tl = common.reorder(trackList,['start','end'])
+    _tf = common.reorder(trackFeatures,['start','end'])
+    return FeatureStream(_overlap(_tl,_tf), _tl.fields+['overlap'])
+
 ###############################################################################
 @common.ordered
 def neighborhood(trackList, before_start=None, after_end=None,
@@ -214,34 +309,53 @@ def neighborhood(trackList, before_start=None, after_end=None,
     :param on_strand: (bool) True to respect strand orientation. [False]
     :rtype: FeatureStream
     """
-    def _generate_single(track,a,b,c,d):
+    def _generate_single(track):
+        """Variable-size windows: buffer them in a heap, and release the smallest
+        as soon as it ends before the current feature starts."""
         _buf = []
         for x in track:
-            if a:
-                if on_strand and x[2]<0:
-                    _buf.append((x[0]-after_end,     x[0]+before_end+1) + x[2:])
-                    _buf.append((x[1]-after_start-1, x[1]+before_start) + x[2:])
-                else:
-                    _buf.append((x[0]-before_start, x[0]+after_start+1) + x[2:])
-                    _buf.append((x[1]-before_end-1, x[1]+after_end)     + x[2:])
-            elif b:
-                if on_strand and x[2]<0:
-                    _buf.append((x[1]-after_start-1, x[1]+before_start)  + x[2:])
-                else:
-                    _buf.append((x[0]-before_start,  x[0]+after_start+1) + x[2:])
-            elif c:
-                if on_strand and x[2]<0:
-                    _buf.append((x[0]-after_end,    x[0]+before_end+1) + x[2:])
-                else:
-                    _buf.append((x[1]-before_end-1, x[1]+after_end)    + x[2:])
-            elif d:
-                if on_strand and x[2]<0:
-                    _buf.append((x[0]-after_end,    x[1]+before_start) + x[2:])
-                else:
-                    _buf.append((x[0]-before_start, x[1]+after_end)    + x[2:])
-            _buf.sort()
-            while _buf and _buf[0][1] < x[0]: yield _buf.pop(0)
-        while _buf: yield _buf.pop(0)
+            if on_strand and x[2]<0:
+                heapq.heappush(_buf, (x[0]-after_end,    x[1]+before_start) + x[2:])
+            else:
+                heapq.heappush(_buf, (x[0]-before_start, x[1]+after_end)    + x[2:])
+            while _buf and _buf[0][1] < x[0]: yield heapq.heappop(_buf)
+        while _buf: yield heapq.heappop(_buf)
+
+    def _generate_fixed(track,a,b,c,chunk=10000):
+        """Fixed-size windows around starts and/or ends: compute them by chunks of
+        features with numpy. A window never starts more than *maxback* bp before
+        the start of its feature, so once a chunk is sorted, all windows starting
+        before (last start - *maxback*) can be released."""
+        # (anchor, offset of the window start, offset of the window end) on each strand
+        if a:
+            fwd = [(0,-before_start,after_start+1), (1,-before_end-1,after_end)]
+            rev = [(0,-after_end,before_end+1), (1,-after_start-1,before_start)]
+        elif b:
+            fwd = [(0,-before_start,after_start+1)]
+            rev = [(1,-after_start-1,before_start)]
+        else:
+            fwd = [(1,-before_end-1,after_end)]
+            rev = [(0,-after_end,before_end+1)]
+        maxback = max([-w[1] for w in fwd+(rev if on_strand else [])])
+        _buf = []
+        while 1:
+            rows = list(itertools.islice(track,chunk))
+            if not rows: break
+            bounds = (asarray([x[0] for x in rows]), asarray([x[1] for x in rows]))
+            rest = [x[2:] for x in rows]
+            if on_strand: neg = asarray([x[2]<0 for x in rows], dtype=bool)
+            for (fa,fs,fe),(ra,rs,re) in zip(fwd,rev):
+                starts = bounds[fa]+fs
+                ends = bounds[fa]+fe
+                if on_strand:
+                    starts = where(neg, bounds[ra]+rs, starts)
+                    ends = where(neg, bounds[ra]+re, ends)
+                _buf.extend((s,e)+r for s,e,r in itertools.izip(starts.tolist(),ends.tolist(),rest))
+            _buf.sort() # mostly sorted already
+            n = bisect.bisect_left(_buf, (rows[-1][0]-maxback,))
+            for y in _buf[:n]: yield y
+            del _buf[:n]
+        for y in _buf: yield y
 
     _fields = ['start','end']
     if on_strand: _fields += ['strand']
@@ -257,86 +371,73 @@ def neighborhood(trackList, before_start=None, after_end=None,
         case1 = case2 = False
     if before_end is None:
         case1 = case3 = False
+    if case1 or case2 or case3:
+        _generate = lambda t: _generate_fixed(t,case1,case2,case3)
+    elif case4:
+        _generate = _generate_single
+    else:
+        _generate = lambda t: iter([])
     if isinstance(trackList,(list,tuple)):
         tl = [common.reorder(t,_fields) for t in trackList]
-        return [FeatureStream(_generate_single(t,case1,case2,case3,case4),
-                                    fields=t.fields) for t in tl]
+        return [FeatureStream(_generate(t), fields=t.fields) for t in tl]
     else:
         tl = common.reorder(trackList,_fields)
-        return FeatureStream(_generate_single(tl,case1,case2,case3,case4),
-                                   fields=tl.fields)
+        return FeatureStream(_generate(tl), fields=tl.fields)
 
 ###############################################################################
-def _combine(trackList,fn,win_size,aggregate):
-    """Generator - see function `combine` below."""
+def _combine(trackList,fn,aggregate):
+    """Generator - see function `combine` below.
+    A priority queue holds the next start or end event of every track (each track is
+    cobbled, so at most one of its features is active at a time). Events are processed
+    by breakpoint, and *fn* is evaluated once per breakpoint."""
     N = len(trackList)
     fields = trackList[0].fields
-    trackList = [common.sentinelize(t, [sys.maxint]*len(t.fields)) for t in trackList]
-    init = [trackList[i].next() for i in range(N)] # the first element of each track
+    trackList = [common.sentinelize(t,None) for t in trackList]
+    init = [t.next() for t in trackList]
+    # Empty tracks keep their slot and stay inactive
+    if all(x is None for x in init): return
     activity = [False]*N # a vector of boolean values for the N tracks at a given position
-    z = [None]*N
-    # If there are empty tracks, remove them, and their index from init
-    for i in xrange(N-1,-1,-1):
-        if init[i][0] == sys.maxint:
-            N-=1
-            trackList.pop(i)
-            init.pop(i)
-    if N == 0: return
-    available_tracks = range(N-1,-1,-1)
-    # Sort starts and ends of all init elements indifferently; record the origin track index.
-    current = [(init[i][0],i)+init[i][2:] for i in range(N)]+[(init[i][1],i) for i in range(N)]
-    current.sort()
-
-    # Init step: set all tracks beginning at the starting point as 'active'
+    z = [None]*N         # meta info of the active feature of each track
+    active = []          # sorted indices of the active tracks
+    if fn is union:          test = lambda: len(active) > 0
+    elif fn is intersection: test = lambda: len(active) == N
+    else:                    test = lambda: fn(activity)
+    aggreg = [aggregate.get(f,common.generic_merge) for f in fields[2:]]
+    # Events are (position, 0 for an end/1 for a start, track index, feature)
+    events = [(x[0],1,i,x) for i,x in enumerate(init) if x is not None]
+    heapq.heapify(events)
     is_chr = 'chr' in fields
     if is_chr:
-        empty = (current[0][2],)+('0',)*len(fields[3:]) # write chr name if a region has no other annotation
+        empty = (events[0][3][2],)+('0',)*len(fields[3:]) # write chr name if a region has no other annotation
     else:
         empty = ('0',)*len(fields[2:])
-    start = current[0][0]
-    while current[0][0] == start:
-        i = current[0][1]          # track index
-        activity[i] = True         # set this track to 'active'
-        z[i] = current.pop(0)[2:]  # z records all meta info
-
-    k=1
-    while available_tracks or current:
-        # Load all elements within *win_size* bp in *current*
-        to_remove = []
-        limit = k * win_size
-        while current[0][0] >= limit:
-            k+=1
-            limit = k * win_size
-        for i in available_tracks:
-            a = [0,0]
-            while a[1] < limit:
-                a = trackList[i].next()
-                if a[0] == sys.maxint:  # track i is completely read:
-                    to_remove.append(i) # remove it from the tracks list
-                else:
-                    current.append((a[0],i)+a[2:])
-                    current.append((a[1],i))
-        for i in to_remove:
-            available_tracks.remove(i)
-        if not current: continue
-        current.sort()
-        # Calculate boolean values for this window
-        while current and current[0][0] < limit:
-            next = current[0][0]
-            if fn(activity):
-                feat_aggreg = [None]*len(fields[2:])
-                for n,f in enumerate(fields[2:]):
-                    feats = tuple(zi[n] for zi in z if zi)
-                    try: feat_aggreg[n] = aggregate.get(f,common.generic_merge)(feats)
-                    except IndexError: feat_aggreg = empty
-                yield (start,next) + tuple(feat_aggreg)
-            while current and current[0][0] == next:
-                i = current[0][1]               # track index
-                activity[i] = not(activity[i])  # reverse activity
-                zi = current.pop(0)[2:]         # record meta info
-                z[i] = zi if activity[i] else None
-            start = next
-        k+=1
+
+    def _toggle(pos):
+        """Process all events at position *pos*."""
+        while events and events[0][0] == pos:
+            p,is_start,i,x = heapq.heappop(events)
+            if is_start:
+                activity[i] = True
+                z[i] = x[2:]
+                bisect.insort(active,i)
+                heapq.heappush(events,(x[1],0,i,x))
+            else:
+                activity[i] = False
+                z[i] = None
+                active.remove(i)
+                y = trackList[i].next()
+                if y is not None: heapq.heappush(events,(y[0],1,i,y))
+
+    start = events[0][0]
+    _toggle(start)
+    while events:
+        next = events[0][0]
+        if test():
+            try: feat_aggreg = tuple(f(tuple(z[i][n] for i in active)) for n,f in enumerate(aggreg))
+            except IndexError: feat_aggreg = empty
+            yield (start,next) + feat_aggreg
+        _toggle(next)
+        start = next
 
 @common.ordered
 def combine(trackList, fn, win_size=1000, aggregate={}):
@@ -351,7 +452,7 @@ def combine(trackList, fn, win_size=1000, aggregate={}):
 
     :param trackList: list of FeatureStream objects.
     :param fn: boolean function to apply, such as bbcflib.gfminer.stream.union.
-    :param win_size: (int) window size, in bp.
+    :param win_size: (int) ignored, kept for backward compatibility.
     :param aggregate: (dict) for each field name given as a key, its value is the function
         to apply to the vector containing all trackList's values for this field in order
         to merge them. E.g. ``{'score': lambda x: sum(x)/len(x)}`` will return the average of
@@ -365,7 +466,7 @@ def combine(trackList, fn, win_size=1000, aggregate={}):
         _f += ['chr']
     if isinstance(fn,str): fn = eval(fn) # can type "combine(...,fn='intersection')"
     trackList = [common.cobble(common.reorder(t,fields=_f)) for t in trackList]
-    return common.fusion(FeatureStream(_combine(trackList,fn,win_size,aggregate),
+    return common.fusion(FeatureStream(_combine(trackList,fn,aggregate),
                                        fields=trackList[0].fields))
 
 def exclude(x,indexList):
@@ -455,9 +556,8 @@ def segment_features(trackList,nbins=10,upstream=None,downstream=None):
                 cur_chr = x[chri]
                 if cur_chr != last_chr:
                     last_chr = cur_chr
-                    for bf in buffer:
-                        yield bf[1]
-                    buffer = []
+                    while buffer:
+                        yield heapq.heappop(buffer)[1]
             xs = list(x)
             xlen = (xs[endi]-xs[starti])
             if uprel:
@@ -475,7 +575,7 @@ def segment_features(trackList,nbins=10,upstream=None,downstream=None):
                     xs[starti] = start
                     xs[endi] = s
                     start = s
-                    buffer.append( [key,tuple(xs)+(ntot-n,)] )
+                    heapq.heappush(buffer, (key,tuple(xs)+(ntot-n,)))
 #                    yield tuple(xs)+(ntot-n,)
             else:                                 # either no 'strand' field, or forward strand
                 allsteps = [x[starti]-updist*k/upbins for k in range(upbins,0,-1)]\
@@ -487,16 +587,13 @@ def segment_features(trackList,nbins=10,upstream=None,downstream=None):
                     xs[starti] = start
                     xs[endi] = s
                     start = s
-                    buffer.append( [key,tuple(xs)+(n,)] )
+                    heapq.heappush(buffer, (key,tuple(xs)+(n,)))
 #                    yield tuple(xs)+(n,)
-            buffer.sort()
-            for n,bf in enumerate(buffer):
-                if bf[0] > (x[starti],x[endi]): break
-                yield bf[1]
-            if n>0: buffer = buffer[n:]
-        buffer.sort()
-        for bf in buffer:
-            yield bf[1]
+            xkey = (x[starti],x[endi])
+            while buffer and buffer[0][0] <= xkey:
+                yield heapq.heappop(buffer)[1]
+        while buffer:
+            yield heapq.heappop(buffer)[1]
     if isinstance(trackList, (list,tuple)):
         return [FeatureStream(_split_feat(t), fields=t.fields+['bin'])
                 for t in trackList]
@@ -1,10 +1,15 @@
 # coding: utf-8
 
-import sys
+import sys, os, math, itertools, tempfile, shutil, atexit, cPickle, bisect
+from collections import deque
 from bbcflib.gfminer import common
 from bbcflib.gfminer.stream import concatenate
 from bbcflib.track import FeatureStream
-from numpy import asarray, zeros
+from numpy import asarray, zeros, memmap, float64, around, sort, argsort, vstack, nonzero, prod
+from numpy import exp, median, fromfile, unique, searchsorted, where, inf, maximum, arange, int64
+from numpy import concatenate as nconcatenate, cumsum, clip, add, minimum, bincount
+from numpy import repeat as nrepeat
+from numpy import log as nlog
 
 def _sum(scores,denom=None):
     return sum(scores)
@@ -40,8 +45,107 @@ def _median(scores,denom=None):
 _score_functions = {'arithmetic':_arithmetic_mean, 'geometric':_geometric_mean, 'sum':_sum,
                     'mean': _arithmetic_mean, 'min':_min, 'max':_max, 'median':_median}
 
+# Same operations on a list of (score, length) pairs, as if each score was repeated *length* times.
+def _weighted_sum(pairs,denom=None):
+    return sum(s*l for s,l in pairs)
+
+def _weighted_mean(pairs,denom):
+    return sum(s*l for s,l in pairs)*denom
+
+def _weighted_geometric_mean(pairs,denom):
+    # Sum of logs: the product of the s**l overflows (or underflows) on long features.
+    # No score or a zero score gives 0, an odd number of negative bases has no real root (nan).
+    if not pairs or any(s == 0 for s,l in pairs): return 0.0
+    if sum(l for s,l in pairs if s < 0) % 2: return float('nan')
+    return math.exp(denom*sum(l*math.log(abs(s)) for s,l in pairs))
+
+def _weighted_min(pairs,denom=None):
+    return min(s for s,l in pairs) if pairs else 0
+
+def _weighted_max(pairs,denom=None):
+    return max(s for s,l in pairs) if pairs else 0
+
+def _coverage(pairs,denom):
+    return sum(l for s,l in pairs)*denom
+
+def _weighted_nth(pairs, ns):
+    """Return the values of rank *ns* (sorted list of ints) in the per-base expansion of *pairs*."""
+    pairs = sorted(pairs)
+    result = []
+    k = 0
+    cumlen = pairs[0][1]
+    for n in ns:
+        while cumlen <= n:
+            k += 1
+            cumlen += pairs[k][1]
+        result.append(pairs[k][0])
+    return result
+
+def _weighted_median(pairs,denom=None):
+    if not pairs: return 0
+    total = sum(l for s,l in pairs)
+    if total % 2:
+        return _weighted_nth(pairs,[(total-1)/2])[0]
+    else:
+        return sum(_weighted_nth(pairs,[total/2-1,total/2]))*.5
+
+def _weighted_quantile(q):
+    """Return a function computing the *q*-th percentile (lower rank) of weighted scores."""
+    def _quantile(pairs,denom=None):
+        if not pairs: return 0
+        total = sum(l for s,l in pairs)
+        return _weighted_nth(pairs,[int(q*(total-1)/100.)])[0]
+    return _quantile
+
+_weighted_functions = {'arithmetic':_weighted_mean, 'geometric':_weighted_geometric_mean,
+                       'sum':_weighted_sum, 'mean':_weighted_mean, 'min':_weighted_min,
+                       'max':_weighted_max, 'median':_weighted_median, 'coverage':_coverage}
+
+def _merge_values(values, present, method):
+    """Reduce the (segments x tracks) matrix of scores *values*, where *present* says which
+    tracks have an item on each segment, with the `merge_scores` *method*."""
+    nseg, ntracks = values.shape
+    count = present.sum(1)
+    if hasattr(method,'__call__'):
+        return asarray([method([values[k,i] for i in xrange(ntracks) if present[k,i]])
+                        for k in xrange(nseg)], dtype=float64)
+    elif method == 'sum':
+        return values.sum(1)
+    elif method == 'geometric':
+        return where(present,values,1.).prod(1)**(1.0/ntracks)
+    elif method == 'min':
+        return where(present,values,inf).min(1)
+    elif method == 'max':
+        return where(present,values,-inf).max(1)
+    elif method == 'median':
+        ranked = sort(where(present,values,inf),1)
+        lo = maximum(count-1,0)/2
+        hi = count/2
+        return (ranked[arange(nseg),lo]+ranked[arange(nseg),hi])*.5
+    return values.sum(1)/ntracks
+
+def _merge_labels(labels, present):
+    """Merge the other fields of the tracks on each segment: *labels* has, for each track, an
+    object array (segments x fields). Returns one list of strings per field, with the value
+    if all tracks present on the segment agree, else their values joined by '|'."""
+    nseg, ntracks = present.shape
+    columns = []
+    for n in xrange(labels[0].shape[1] if labels else 0):
+        distinct = set(v for i in xrange(ntracks) for v in labels[i][present[:,i],n].tolist())
+        if len(distinct) == 1 and not(None in distinct):
+            columns.append([str(distinct.pop())]*nseg)
+            continue
+        column = []
+        for k in xrange(nseg):
+            vals = [str(labels[i][k,n]) for i in xrange(ntracks)
+                    if present[k,i] and not(labels[i][k,n] is None)]
+            if len(set(vals)) == 1: column.append(vals[0])
+            else:                   column.append("|".join(vals))
+        columns.append(column)
+    return columns
+
 @common.ordered
-def merge_scores(trackList, method='arithmetic'):
+def merge_scores(trackList, method='arithmetic', chunk_size=10000):
     """
     Creates a stream with per-base average of several score tracks::
 
@@ -49,50 +153,39 @@ def merge_scores(trackList, method='arithmetic'):
         X2: _____2222222222__________
         R:  _____11111444443333______
 
+    Tracks are read together by a `common.LockstepReader`, by chunks of *chunk_size* items
+    and chromosome by chromosome if they have a 'chr' field. Every track's score is looked up
+    for each segment between the breakpoints of all tracks, and the resulting
+    (segments x tracks) matrix is reduced with numpy.
+
     :param trackList: list of FeatureStream objects.
-    :param method: (str) type of average: one of 'arithmetic','geometric', or 'sum' (no average).
+    :param method: (str) type of average: one of 'arithmetic','geometric','median','min','max',
+        or 'sum' (no average), or a function applied to the list of scores at each position.
+    :param chunk_size: (int) number of items read at once from each track. [10000]
     :rtype: FeatureStream
     """
-    tracks = [FeatureStream(common.sentinelize(x,[sys.maxint]*len(x.fields)), x.fields)
-              for x in trackList]
-    tracks = [common.reorder(t,['start','end','score']) for t in tracks]
+    tracks = [common.reorder(t,['start','end','score']) for t in trackList]
     fields = [f for f in tracks[0].fields if all([f in t.fields for t in tracks])] # common fields
-    elements = [list(x.next()) for x in tracks]
-    track_denom = 1.0/len(trackList)
-
-    if hasattr(method,'__call__'):
-        mean_fn = lambda scores,denom:method(scores)
-    else:
-        mean_fn = _score_functions.get(method,_arithmetic_mean)
-    for i in xrange(len(tracks)-1, -1, -1):
-        if elements[i][0] == sys.maxint:
-            tracks.pop(i)
-            elements.pop(i)
+    if not(hasattr(method,'__call__')) and method not in _score_functions:
+        method = 'arithmetic'
+    if not('chr' in fields) and any('chr' in t.fields for t in tracks):
+        tracks = [common.select(t,fields) for t in tracks]
+    extra = [f for f in fields[3:] if f != 'chr']
 
     def _stream(tracks):
-        while tracks:
-            start = min([x[0] for x in elements])
-            end = min([x[0] for x in elements if x[0]>start]+[x[1] for x in elements])
-            scores = [x[2] for x in elements if x[1]>start and x[0]<end]
-            if len(fields) > 3:
-                rest = []
-                for i in range(len(fields[3:])):
-                    r = [str(x[3+i]) for x in elements if not(x[3+i] is None) and x[1]>start and x[0]<end]
-                    if all([x == r[0] for x in r]):
-                        rest.append(r[0])
-                    else:
-                        rest.append( "|".join(r) )
-                yield (start, end, mean_fn(scores,track_denom)) + tuple(rest)
-            else:
-                yield (start, end, mean_fn(scores,track_denom))
-            for i in xrange(len(tracks)-1, -1, -1):
-                if elements[i][0] < end:
-                    elements[i][0] = end
-                if elements[i][1] <= end:
-                    elements[i] = list(tracks[i].next())
-                if elements[i][0] == sys.maxint:
-                    tracks.pop(i)
-                    elements.pop(i)
+        # Streams are read in this thread: they may come from an sqlite track
+        reader = common.LockstepReader(tracks, chunk_size=chunk_size, readahead=0, extra=extra)
+        for batch in reader:
+            chrom, starts, ends, values, present = batch[:5]
+            keep = nonzero(present.any(1))[0]
+            if not len(keep): continue
+            present = present[keep]
+            merged = _merge_values(values[keep], present, method)
+            labels = _merge_labels([x[keep] for x in batch[5]], present) if extra else []
+            rest = [[chrom]*len(keep) if f == 'chr' else labels[extra.index(f)] for f in fields[3:]]
+            for item in itertools.izip(starts[keep].tolist(),ends[keep].tolist(),merged.tolist(),*rest):
+                yield item
+
     return FeatureStream(_stream(tracks),fields)
 
 ###############################################################################
@@ -127,6 +220,7 @@ def filter_scores(trackScores,trackFeatures,method='sum',strict=False,annotate=F
     def _stream(ts,tf):
         tf = common.sentinelize(tf,[sys.maxint]*len(tf.fields))
         info_idx = [k for k,f in enumerate(tf.fields) if f not in ts.fields]
+        _info = common.getter(info_idx) if annotate else lambda y: ()
         if stranded:
             ts_strand_idx = ts.fields.index('strand')
             tf_strand_idx = tf.fields.index('strand')
@@ -153,7 +247,7 @@ def filter_scores(trackScores,trackFeatures,method='sum',strict=False,annotate=F
             # Yield intersections
             for y in Y:
                 if not same_strand(x,y): continue
-                info = tuple([y[k] for k in info_idx]) if annotate else ()
+                info = _info(y)
                 if strict and (y[0] > xstart or y[1] < xend): continue
                 if y[0] >= xend : continue    # keep for next iteration
                 start = xstart if y[0] < xstart else y[0]
@@ -197,7 +291,10 @@ def score_by_feature(trackScores,trackFeatures,method='mean'):
     :param trackScores: (list of) one or several -sorted- score track(s) (FeatureStream).
     :param trackFeatures: (FeatureStream) one -sorted- feature track.
     :param method: (str of function): operation applied to the list of scores from one feature.
-        Can be one of 'sum','mean','median','min','max', or a custom function.
+        Can be one of 'sum','mean','median','min','max','geometric','coverage' (the fraction
+        of the feature covered by score items), 'qXX' (the XX-th percentile, e.g. 'q90'),
+        or a custom function. Built-in methods weight each score by the length of its
+        intersection with the feature, a custom function receives the list of per-base scores.
     :rtype: FeatureStream
     """
     def _stream(ts,tf):
@@ -206,9 +303,14 @@ def score_by_feature(trackScores,trackFeatures,method='mean'):
         start_idx = tf.fields.index('start')
         end_idx = tf.fields.index('end')
         if hasattr(method,'__call__'):
+            expand = True
             mean_fn = lambda scores,denom:method(scores)
+        elif method[0] == 'q' and method[1:].replace('.','',1).isdigit():
+            expand = False
+            mean_fn = _weighted_quantile(float(method[1:]))
         else:
-            mean_fn = _score_functions.get(method,_arithmetic_mean)
+            expand = False
+            mean_fn = _weighted_functions.get(method,_weighted_mean)
         for y in tf:
             ystart = y[start_idx]
             yend = y[end_idx]
@@ -229,7 +331,8 @@ def score_by_feature(trackScores,trackFeatures,method='mean'):
                     else:              start = s[0]
                     if yend <  s[1]:   end   = yend
                     else:              end   = s[1]
-                    scores_y.extend([s[2]]*(end-start))
+                    if expand: scores_y.extend([s[2]]*(end-start))
+                    else:      scores_y.append((s[2],end-start))
                 scores += (mean_fn(scores_y,1.0/(yend-ystart)),)
             yield tuple(y)+scores
 
@@ -244,9 +347,52 @@ def score_by_feature(trackScores,trackFeatures,method='mean'):
     return FeatureStream(_stream(_ts,trackFeatures), trackFeatures.fields+_fields)
 
 ###############################################################################
+def _box_passes(window_size, kernel):
+    """Widths of the successive box filters approximating *kernel*."""
+    if kernel == 'box':
+        return [window_size]
+    elif kernel == 'triangular':
+        return [(window_size+1)/2]*2
+    elif kernel == 'gaussian':
+        return [(window_size+2)/3]*3
+    raise ValueError("Unknown kernel '%s': use 'box', 'triangular' or 'gaussian'." % kernel)
+
+def _round_significant(x, bits=40):
+    """Round the values of float64 array *x* to *bits* significant bits (about 12 digits),
+    in place, by rounding their binary mantissa."""
+    drop = 52-bits
+    raw = x.view(int64)
+    raw += 1 << (drop-1)
+    raw &= ~((1 << drop)-1)
+    return x
+
+def _smooth_chunk(feats, lo, hi, widths):
+    """Return the smoothed signal at positions [*lo*, *hi*) given all features *feats*
+    (start, end, score) that can reach these positions.
+    The signal is summed per base in float64, and windows are summed with cumulative sums.
+    Windows that no feature reaches are exactly 0, and results are rounded to 40 significant
+    bits (about 12 digits) so that they do not depend on where the chunk starts."""
+    left = sum(w/2 for w in widths)
+    right = sum(w-1-w/2 for w in widths)
+    xlo = lo-left
+    n = hi+right-xlo
+    fstart = clip(asarray([x[0] for x in feats], dtype=int64)-xlo, 0, n)
+    fend = clip(asarray([x[1] for x in feats], dtype=int64)-xlo, 0, n)
+    fscore = asarray([x[2] for x in feats], dtype=float64)
+    lengths = maximum(fend-fstart, 0)
+    covered = nrepeat(fstart-cumsum(lengths)+lengths, lengths) + arange(lengths.sum())
+    signal = bincount(covered, weights=nrepeat(fscore, lengths), minlength=n)[:n]
+    support = bincount(covered, minlength=n)[:n] > 0
+    for k,w in enumerate(widths):
+        sums = cumsum(nconcatenate(([0.],signal)))
+        counts = cumsum(nconcatenate(([0],support)))
+        support = (counts[w:]-counts[:-w]) > 0
+        signal = where(support, (sums[w:]-sums[:-w])/w, 0.)
+    return _round_significant(signal)
+
 @common.ordered
 def window_smoothing( trackList, window_size, step_size=1, stop_val=sys.maxint,
-                      featurewise=False ):
+                      featurewise=False, kernel='box', chunk_size=1000000 ):
     """
     Given a (list of) signal track(s) *trackList*, a *window_size* L (in base pairs by default,
     or in number of features if *featurewise* is True),  and a *step_size*,
@@ -256,11 +402,22 @@ def window_smoothing( trackList, window_size, step_size=1, stop_val=sys.maxint,
         X: __________666666666666____________
         R: ______12345666666666654321________ (not exact scores here)
 
+    In bp, the signal is built by chunks of *chunk_size* positions (plus the window margins) in an
+    array, filtered with cumulative sums, and consecutive positions with equal scores are merged
+    into a single feature. Smoothed scores are rounded to 12 significant digits, which makes the
+    result independent of *chunk_size*. The output then has fields 'start', 'end', 'score',
+    and 'chr' if the input has one: other fields are dropped, as smoothed positions do not
+    correspond to features.
+    The *kernel* can be 'box' (plain average), 'triangular' or 'gaussian'; the latter two are
+    obtained by respectively two and three successive box filters of width L/2 and L/3.
+
     :param trackList: FeatureStream, or list of FeatureStream objects.
     :param window_size: (int) window size in bp.
     :param step_size: (int) step length (one score returned per *step_size* positions). [1]
     :param stop_val: (int) sequence length. [sys.maxint]
     :param featurewise: (bool) bp (False), or number of features (True). [False]
+    :param kernel: (str) one of 'box','triangular','gaussian'. Ignored if *featurewise*. ['box']
+    :param chunk_size: (int) number of positions smoothed at once. [1000000]
     :rtype: FeatureStream
 
     Example of windows, window_size=9, step_size=3:
@@ -268,8 +425,7 @@ def window_smoothing( trackList, window_size, step_size=1, stop_val=sys.maxint,
     [0,1,2,3,4,5,6,7,8,9), [3,4,5,6,7,8,9,10,11,12), ...
     """
     def _stepping_mean(track,score,denom):
-        score = 0.0
-        F = []
+        F = deque()
         score = 0.0
         nmid = window_size/2
         for x in track:
@@ -278,82 +434,67 @@ def window_smoothing( trackList, window_size, step_size=1, stop_val=sys.maxint,
             if len(F) < window_size: continue
             yield (F[nmid][0],F[nmid][1],round(score*denom+1e-7,6))+F[nmid][3:]
             for shift in xrange(step_size):
-                score -= F.pop(0)[2]
+                score -= F.popleft()[2]
 
     def _running_mean(track,win_start,denom):
-        score = 0.0
-        F = []
-        for x in track:
-            F.append(x)
-            fstart = F[0][0]
-            fend = F[0][1]
-            chrom = F[0][3]
-            win_start = max(win_start,fstart-window_size)
-            win_end = win_start+window_size
-            lstart = F[-1][0]
-            lend = F[-1][1]
-            while win_end < lend:
-                delta = 0
-                steps = [fend-win_start,lend-win_end]
-                if fstart>win_start: steps.append(fstart-win_start)
-                else: delta -= F[0][2]
-                if lstart>win_end:   steps.append(lstart-win_end)
-                else: delta += F[-1][2]
-                nsteps = min(steps)
-                sst = -(win_start % step_size)%step_size
-                sen = -(win_start+nsteps % step_size)%step_size
-                win_center = (win_start+win_end)/2
-                if abs(delta) > 1e-11:
-                    delta *= denom
-                    score += delta*sst
-                    for step in xrange(sst,nsteps,step_size):
-                        if score>1e-11 and win_center+step>=0 and win_center+step+step_size<=stop_val:
-                            yield (win_center+step,win_center+step+step_size,score,chrom)
-                        score += delta*step_size
-                    score -= delta*sen
-                else:
-                    if score>1e-11 and win_center+sst>=0 and win_center+sen+nsteps<=stop_val:
-                        yield (win_center+sst,win_center+sen+nsteps,score,chrom)
-                win_start += nsteps
-                win_end += nsteps
-                if fend <= win_start:
-                    F.pop(0)
-                    if F:
-                        fstart = F[0][0]
-                        fend = F[0][1]
-                        win_start = max(win_start,fstart-window_size)
-                        win_end = win_start+window_size
-                        if win_end > stop_val: break
-        while F:
-            delta = 0
-            steps = [fend-win_start]
-            if fstart>win_start: steps.append(fstart-win_start)
-            else: delta -= F[0][2]
-            nsteps = min(steps)
-            sst = -(win_start % step_size)%step_size
-            sen = -(win_start+nsteps % step_size)%step_size
-            win_center = (win_start+win_end)/2
-            if abs(delta) > 1e-11:
-                delta *= denom
-                score += delta*sst
-                for step in xrange(sst,nsteps,step_size):
-                    if score>1e-11 and win_center+step>=0 and win_center+step+step_size<=stop_val:
-                        yield (win_center+step,win_center+step+step_size,score,chrom)
-                    score += delta*step_size
-                score -= delta*sen
-            else:
-                if score>1e-11 and win_center+sst>=0 and win_center+sen+nsteps<=stop_val:
-                    yield (win_center+sst,win_center+sen+nsteps,score,chrom)
-            win_start += nsteps
-            win_end += nsteps
-            if fend <= win_start:
-                F.pop(0)
-                if F:
-                    fstart = F[0][0]
-                    fend = F[0][1]
-                    win_start = max(win_start,fstart-window_size)
-                    win_end = win_start+window_size
-                    if win_end > stop_val: break
+        widths = _box_passes(window_size, kernel)
+        left = sum(w/2 for w in widths)
+        right = sum(w-1-w/2 for w in widths)
+        offset = window_size/2   # a window starts *offset* bp before its center
+        has_chr = 'chr' in track.fields
+        track = common.sentinelize(track, None)
+        nxt = track.next()
+        pending = None           # last run, kept until the next one is known
+        while nxt is not None:
+            chrom = nxt[3] if has_chr else None
+            feats = []
+            pos = nxt[0]-right
+            while 1:
+                # Load all features that can reach the chunk [pos, pos+chunk_size)
+                while nxt is not None and nxt[0] < pos+chunk_size+right \
+                        and (nxt[3] if has_chr else None) == chrom:
+                    feats.append(nxt)
+                    nxt = track.next()
+                feats = [x for x in feats if x[1] > pos-left]
+                if not feats:
+                    if nxt is None or (nxt[3] if has_chr else None) != chrom: break
+                    pos = nxt[0]-right
+                    continue
+                if feats[0][0]-right > pos or pos < 0:
+                    # Skip positions that no feature can reach, then reload
+                    pos = max(feats[0][0]-right, 0)
+                    continue
+                end = min(pos+chunk_size, stop_val)
+                if pos >= end: break
+                scores = _smooth_chunk(feats, pos, end, widths)
+                # Keep positions whose window starts at a multiple of step_size
+                first = -(pos-offset) % step_size
+                starts = arange(pos+first, end, step_size)
+                scores = scores[first::step_size]
+                pos = end
+                if len(starts) == 0: continue
+                change = nonzero(scores[1:] != scores[:-1])[0]+1
+                first_idx = nconcatenate(([0],change))
+                run_starts = starts[first_idx].tolist()
+                # (minimum with a Python int gives longlong items, i.e. Python longs)
+                run_ends = minimum(nconcatenate((starts[change], [starts[-1]+step_size])),stop_val)
+                run_ends = run_ends.astype(int64).tolist()
+                run_scores = scores[first_idx].tolist()
+                if pending and pending[1] == run_starts[0] and pending[2] == run_scores[0]:
+                    pending = (pending[0],run_ends[0])+pending[2:]
+                    del run_starts[0], run_ends[0], run_scores[0]
+                if not run_starts: continue
+                if pending and pending[2] != 0: yield pending
+                last = (run_starts.pop(),run_ends.pop(),run_scores.pop())
+                pending = last + ((chrom,) if has_chr else ())
+                runs = itertools.izip(run_starts,run_ends,run_scores,*([itertools.repeat(chrom)] if has_chr else []))
+                for run in runs:
+                    if run[2] != 0: yield run
+            if pending and pending[2] != 0: yield pending
+            pending = None
+            # Skip the rest of a chromosome beyond stop_val
+            while nxt is not None and (nxt[3] if has_chr else None) == chrom:
+                nxt = track.next()
 
     denom = 1.0/window_size
     win_start = -window_size
@@ -362,19 +503,155 @@ def window_smoothing( trackList, window_size, step_size=1, stop_val=sys.maxint,
         call = _stepping_mean
     else:
         call = _running_mean
+    tl = trackList if isinstance(trackList,(list,tuple)) else [trackList]
+    if featurewise:
+        tl = [common.reorder(t,_f) for t in tl]
+    else:
+        flds = [_f+(['chr'] if 'chr' in t.fields else []) for t in tl]
+        tl = [FeatureStream(itertools.imap(common.getter([t.fields.index(f) for f in flds[n]]),t),
+                            fields=flds[n]) for n,t in enumerate(tl)]
+    res = [FeatureStream(call(t,win_start,denom),fields=t.fields) for t in tl]
     if isinstance(trackList,(list,tuple)):
-        return [FeatureStream(call(common.reorder(t,_f),win_start,denom),fields=_f)
-                for n,t in enumerate(trackList)]
+        return res
     else:
-        return FeatureStream(call(common.reorder(trackList,_f),win_start,denom),fields=_f)
+        return res[0]
 
 ###############################################################################
-def normalize(trackList,method='total',field='score'):
+_spool_dirs = set() # temporary directories of `normalize` not removed yet
+
+@atexit.register
+def _remove_spool_dirs():
+    for d in list(_spool_dirs):
+        shutil.rmtree(d, ignore_errors=True)
+
+class _SpoolDir(object):
+    """Temporary directory (in *tmpdir*) for the files spooled by `normalize`. It is removed
+    when the last stream referring to it is garbage collected, whether it has been read
+    or not, and at the latest when the interpreter exits."""
+    def __init__(self, tmpdir=None):
+        self.path = tempfile.mkdtemp(dir=tmpdir, prefix='normalize_')
+        _spool_dirs.add(self.path)
+
+    def __del__(self):
+        try:
+            shutil.rmtree(self.path, ignore_errors=True)
+            _spool_dirs.discard(self.path)
+        except (AttributeError, TypeError): # module already torn down at exit
+            pass
+
+def _spool(stream, idx, tmpdir=None, chunk=100000):
+    """First pass over *stream*: pickle its items by chunks into a temporary file, and write
+    the values of field number *idx* as raw float64 into another one.
+    Returns both file names and the number of items."""
+    rows = tempfile.NamedTemporaryFile(dir=tmpdir, suffix='.rows', delete=False)
+    vals = tempfile.NamedTemporaryFile(dir=tmpdir, suffix='.scores', delete=False)
+    nitems = 0
+    while 1:
+        buf = list(itertools.islice(stream,chunk))
+        if not buf: break
+        cPickle.dump(buf, rows, cPickle.HIGHEST_PROTOCOL)
+        asarray([x[idx] for x in buf], dtype=float64).tofile(vals)
+        nitems += len(buf)
+    rows.close()
+    vals.close()
+    return rows.name, vals.name, nitems
+
+def _scores_map(filename, nitems, mode='r'):
+    """Memory-map the float64 scores written by `_spool` (empty files cannot be mapped)."""
+    if nitems == 0: return zeros(0)
+    return memmap(filename, dtype=float64, mode=mode, shape=(nitems,))
+
+def _unspool(rowfile, scorefile, nitems, idx, transform, spooldir=None):
+    """Second pass: yield the items stored by `_spool` in *rowfile*, with field number *idx*
+    replaced by ``transform(scores)``, where *scores* are read from *scorefile* by chunks.
+    Temporary files are removed once the stream is exhausted; the generator also holds
+    the `_SpoolDir` *spooldir*, which removes them if it is dropped before."""
+    scores = _scores_map(scorefile, nitems)
+    k = 0
+    try:
+        with open(rowfile,'rb') as f:
+            while 1:
+                try:
+                    buf = cPickle.load(f)
+                except EOFError:
+                    break
+                newscores = transform(asarray(scores[k:k+len(buf)]))
+                k += len(buf)
+                for x,v in itertools.izip(buf,newscores):
+                    yield x[:idx]+(float(v),)+x[idx+1:]
+    finally:
+        del scores
+        for fname in (rowfile,scorefile):
+            if os.path.exists(fname): os.remove(fname)
+
+def _quantile_reference(scorefiles, nitems):
+    """Replace the scores in each of *scorefiles* by their quantile-normalized value,
+    holding at most one track in memory at a time."""
+    ref = zeros(nitems)
+    for fname in scorefiles:
+        ref += sort(_scores_map(fname,nitems))
+    ref = around(ref/len(scorefiles),2)
+    for fname in scorefiles:
+        x = _scores_map(fname,nitems,mode='r+')
+        x[argsort(x,kind='mergesort')] = ref
+        if nitems: x.flush()
+        del x
+
+def _deseq_size_factors(scorefiles, nitems, tmpdir=None, chunk=100000):
+    """DESeq size factors from the scores in *scorefiles*: the median over all items with
+    no zero count of the log-ratio to the items' geometric mean, for each track.
+    Log-ratios are spooled to disk, so that only one track is held in memory at a time."""
+    scores = [_scores_map(fname,nitems) for fname in scorefiles]
+    ratiofiles = [tempfile.NamedTemporaryFile(dir=tmpdir, suffix='.ratios', delete=False)
+                  for x in scorefiles]
+    size_factors = []
+    try:
+        for start in xrange(0,nitems,chunk):
+            block = vstack([asarray(x[start:start+chunk]) for x in scores])
+            logblock = nlog(block[:,nonzero(prod(block,axis=0))[0]])
+            logblock -= logblock.mean(axis=0)
+            for n,f in enumerate(ratiofiles):
+                logblock[n].tofile(f)
+        for f in ratiofiles:
+            f.close()
+            size_factors.append(exp(median(fromfile(f.name,dtype=float64))))
+    finally:
+        for f in ratiofiles:
+            f.close()
+            os.remove(f.name)
+    return size_factors
+
+def _total(scorefile, nitems, chunk=100000):
+    """Sum of the scores written by `_spool`, read by chunks. Summing from left to right
+    (as a cumulative sum) gives the same result as adding them one by one."""
+    scores = _scores_map(scorefile, nitems)
+    total = 0.0
+    for start in xrange(0,nitems,chunk):
+        total = cumsum(nconcatenate(([total],scores[start:start+chunk])))[-1]
+    del scores
+    return total
+
+def _rescale(stream, idx, factor):
+    """Yield the items of *stream* with field number *idx* divided by *factor*."""
+    for x in stream:
+        yield x[:idx]+(x[idx]/factor,)+x[idx+1:]
+
+def normalize(trackList,method='total',field='score',tmpdir=None,factors=None,out=None):
     """Normalizes the scores in every stream from *trackList* using the given *method*.
     It assumes that each of the streams represents the same features, i.e. the n-th element
     of one stream corresponds to the n-th element of another.
 
-    [!] This function will temporarily store everything in memory.
+    Methods 'total', 'quantile' and 'deseq' proceed in two passes: the first one copies
+    each stream to a temporary file (in a new directory inside *tmpdir*) and computes the
+    normalization factors on memory-mapped score vectors, holding at most one track in memory
+    at a time; the second pass streams the copies back with their new scores. The copy of a
+    stream is deleted once it is exhausted, and the directory when all returned streams have
+    been garbage collected (even if never read), or at the latest at exit.
+    If the *factors* are already known, e.g. the totals from
+    ``track.stats(t,out={})['score_stats'][1][0]``, the first pass is skipped and the
+    streams are scaled on the fly.
+
+    [!] With a custom function, this function will temporarily store everything in memory.
 
     :param trackList: FeatureStream, or list of FeatureStream objects.
     :param method: normalization method:
@@ -383,9 +660,46 @@ def normalize(trackList,method='total',field='score'):
             as belonging to a different group.
         * ``'quantile'`` applies quantile normalization.
     :param field: (str) name of the field containing the scores (must be the same for all streams).
+    :param tmpdir: (str) directory for temporary files. [system default]
+    :param factors: (list of float) if given, divide the scores of each stream by the respective
+        factor instead of computing them with *method*. [None]
+    :param out: (dict) if given, updated with the normalization factors used for each stream,
+        under the key 'factors' (None for 'quantile' and custom functions). [None]
     """
     if not isinstance(trackList,(list,tuple)):
         trackList = [trackList]
+    if out is None: out = {}
+    if factors is not None:
+        assert len(factors) == len(trackList), "Need one normalization factor per stream."
+        out['factors'] = list(factors)
+        res = [FeatureStream(_rescale(t,t.fields.index(field),float(factors[n])),fields=t.fields)
+               for n,t in enumerate(trackList)]
+        return res[0] if len(trackList) == 1 else res
+    if method in ['total','quantile','deseq']:
+        idxs = [t.fields.index(field) for t in trackList]
+        spooldir = _SpoolDir(tmpdir)
+        spooled = [_spool(t,idxs[n],spooldir.path) for n,t in enumerate(trackList)]
+        nlines = spooled[0][2]
+        scorefiles = [x[1] for x in spooled]
+        if method == 'total':
+            totals = [_total(x[1],x[2]) for x in spooled]
+            transforms = [(lambda tot: lambda v: v/tot)(tot) for tot in totals]
+            out['factors'] = totals
+        else:
+            assert all(x[2]==nlines for x in spooled), "All streams must have the same number of elements."
+            if method == 'quantile':
+                _quantile_reference(scorefiles,nlines)
+                transforms = [lambda v:v]*len(trackList)
+                out['factors'] = None
+            else:
+                size_factors = _deseq_size_factors(scorefiles,nlines,spooldir.path)
+                transforms = [(lambda sf: lambda v: around(v/sf,2))(sf) for sf in size_factors]
+                out['factors'] = list(size_factors)
+        res = [FeatureStream(_unspool(x[0],x[1],x[2],idxs[n],transforms[n],spooldir),
+                             fields=trackList[n].fields)
+               for n,x in enumerate(spooled)]
+        return res[0] if len(trackList) == 1 else res
+    out['factors'] = None
     allcontents = [list(t) for t in trackList]
     ncols = len(trackList)
     nlines = len(allcontents[0])
@@ -407,4 +721,3 @@ def normalize(trackList,method='total',field='score'):
         return res[0]
     else:
         return res
-
@@ -1,16 +1,23 @@
 # Built-in modules #
-import math
+import math, os, subprocess, shutil, gc, threading, sqlite3
+from distutils.spawn import find_executable
 
 # Internal modules #
 from bbcflib import genrep
-from bbcflib.track import track, FeatureStream as fstream
-from bbcflib.gfminer.common import sentinelize, copy, select, reorder, unroll, sorted_stream
-from bbcflib.gfminer.common import shuffled, fusion, cobble, ordered, apply, duplicate
-from bbcflib.gfminer.common import concat_fields, split_field, map_chromosomes, score_threshold
+from bbcflib.track import track, row_class, FeatureStream as fstream
+from bbcflib.gfminer.common import sentinelize, copy, select, reorder, unroll, unroll_array, sorted_stream
+from bbcflib.gfminer.common import shuffled, fusion, cobble, ordered, apply, duplicate, IntervalIndex
+from bbcflib.gfminer.common import concat_fields, split_field, map_chromosomes, score_threshold, getter
+from bbcflib.gfminer.common import LockstepReader, _read_ahead
 from bbcflib.gfminer.stream import getNearestFeature, concatenate, neighborhood, segment_features, intersect
 from bbcflib.gfminer.stream import selection, exclude, require, disjunction, intersection, union, combine
-from bbcflib.gfminer.stream import overlap, merge_scores, score_by_feature, window_smoothing, filter_scores, normalize
+from bbcflib.gfminer.stream import overlap, overlap_genome, merge_scores, score_by_feature, window_smoothing, filter_scores, normalize
+from bbcflib.gfminer.stream import intersectBed, mergeBed, closestBed, coverageBed, complementBed, slopBed, flankBed, mapBed
+from bbcflib.gfminer.bedtools import bedtools_stream, _output_fields, _feed, _bed_layout
 from bbcflib.gfminer.numeric import feature_matrix, summed_feature_matrix, vec_reduce, correlation
+from bbcflib.gfminer.numeric import correlation_matrix, Spectra, score_array, RleSignal, tile_matrix
+from bbcflib.gfminer import plan, run, parallel_run
+from bbcflib.gfminer.cache import ResultCache
 
 # Other modules #
 import numpy
@@ -26,6 +33,9 @@ from numpy.testing import assert_almost_equal
 # Nosetest flag #
 __test__ = True
 
+# Path to testing files
+path = "test_data/bedtools/"
+
 # Numpy print options #
 numpy.set_printoptions(precision=3,suppress=True)
 
@@ -91,12 +101,35 @@ class Test_Common(unittest.TestCase):
         expected = [('a',10,12),('a',14,15)]
         self.assertListEqual(res,expected)
 
+        # several filters, each item yielded once
+        stream = fstream([('a',10,12), ('a',14,15), ('b',16,19)], fields=['name','start','end'])
+        res = list(select(stream,None,{'name':('a','b'),'end':lambda x: x>12}))
+        expected = [('a',14,15),('b',16,19)]
+        self.assertListEqual(res,expected)
+
     def test_reorder(self):
         stream = fstream([(10,12,0.5), (14,15,1.2)], fields=['start','end','score'])
         expected = [(12,0.5,10), (15,1.2,14)]
         res = list(reorder(stream,['end','score','start']))
         self.assertListEqual(res,expected)
 
+        stream = fstream([(10,12,0.5), (14,15,1.2)], fields=['start','end','score'], typed=True)
+        res = reorder(stream,['score'])
+        self.assertListEqual(list(res),[(0.5,10,12), (1.2,14,15)])
+
+    def test_getter(self):
+        x = ('chr1',10,12,0.5)
+        self.assertEqual(getter([2,0])(x), (12,'chr1'))
+        self.assertEqual(getter([3])(x), (0.5,))
+        self.assertEqual(getter([])(x), ())
+
+    def test_typed(self):
+        stream = fstream([('chr1',10,12,0.5)], fields=['chr','start','end','score'], typed=True)
+        x = stream.next()
+        self.assertEqual((x.chr,x.start,x.end,x.score), ('chr1',10,12,0.5))
+        self.assertEqual(x, ('chr1',10,12,0.5))
+        self.assertIs(type(x), row_class(['chr','start','end','score']))
+
     def test_unroll(self):
         stream = fstream([(10,12,0.5,'a'), (14,15,1.2,'b')], fields=['start','end','score','name'])
         expected = [(0,),(0.5,'a'),(0.5,'a'),(0,),(0,),(1.2,'b'),(0,)]
@@ -108,6 +141,15 @@ class Test_Common(unittest.TestCase):
         res = list(unroll(stream,(0,3)))
         self.assertListEqual(res, expected)
 
+    def test_unroll_array(self):
+        stream = fstream([(10,12,0.5,'a'), (14,15,1.2,'b')], fields=['start','end','score','name'])
+        res = unroll_array(stream,(9,16))
+        assert_almost_equal(res, numpy.array([0,0.5,0.5,0,0,1.2,0]))
+
+        stream = fstream([('chr1',0,5,2.),('chr1',8,12,3.),('chr2',1,3,4.)], fields=['chr','start','end','score'])
+        res = unroll_array(stream,[('chr1',4,10),('chr2',0,3)])
+        assert_almost_equal(res, numpy.array([2,0,0,0,3,3, 0,4,4]))
+
     def test_sorted_stream(self):
         s = [(10,0.8),(15,2.8),(12,19.5),(12,1.4),(13,0.1)]
 
@@ -139,6 +181,47 @@ class Test_Common(unittest.TestCase):
             self.assertItemsEqual([x[2] for x in res],[0.5,1.2])
             self.assertItemsEqual([x[1]-x[0] for x in res],[2,1])
 
+        # reproducible with a seed, never overlapping excluded regions
+        feats = [('chr1',10,12,0.5), ('chr1',14,15,1.2), ('chr2',3,8,0.7)]
+        _f = ['chr','start','end','score']
+        excl = fstream([('chr1',0,20),('chr2',10,15)], fields=['chr','start','end'])
+        res = shuffled(fstream(feats,fields=_f), chrlen={'chr1':30,'chr2':20}, exclude=excl,
+                       seed=42, nshuffles=10)
+        self.assertEqual(len(res),10)
+        res = [list(r) for r in res]
+        for r in res:
+            self.assertItemsEqual([x[3] for x in r],[0.5,1.2,0.7])
+            for x in r:
+                if x[0] == 'chr1': self.assertTrue(x[1] >= 20 and x[2] <= 30)
+                else: self.assertTrue(x[2] <= 10 or x[1] >= 15)
+        excl = fstream([('chr1',0,20),('chr2',10,15)], fields=['chr','start','end'])
+        res2 = shuffled(fstream(feats,fields=_f), chrlen={'chr1':30,'chr2':20}, exclude=excl,
+                        seed=42, nshuffles=10)
+        self.assertListEqual(res,[list(r) for r in res2])
+
+    def test_interval_index(self):
+        feats = [('chr1',2,20,'A'),('chr1',4,8,'B'),('chr1',6,7,'C'),('chr1',15,30,'D'),('chr2',5,9,'E')]
+        index = IntervalIndex(fstream(feats, fields=['chr','start','end','name']))
+        self.assertListEqual(index.overlap(7,16,'chr1'), [feats[0],feats[1],feats[3]])
+        self.assertListEqual(index.overlap(7,16,'chr3'), [])
+        self.assertListEqual(index.contains(6,7,'chr1'), [feats[0],feats[1],feats[2]])
+        self.assertListEqual(index.within(3,9,'chr1'), [feats[1],feats[2]])
+        self.assertEqual(index.nearest(0,1,'chr2'), ([feats[4]],4))
+        self.assertEqual(index.nearest(11,14,'chr2'), ([feats[4]],2))
+        self.assertEqual(index.nearest(5,6,'chr1'), ([feats[0],feats[1]],0))
+        self.assertEqual(index.preceding(15,'chr1'), ([feats[1]],7))
+        self.assertEqual(index.preceding(5,'chr2'), ([],None))
+        self.assertEqual(index.following(8,'chr1'), ([feats[3]],7))
+        self.assertEqual(index.following(30,'chr1'), ([],None))
+        res = list(index.query(fstream([('chr2',0,6),('chr2',10,12)], fields=['chr','start','end'])))
+        self.assertListEqual(res, [(('chr2',0,6),[feats[4]]), (('chr2',10,12),[])])
+        # save/load
+        fname = 'interval_index_test.idx'
+        index.save(fname)
+        index2 = IntervalIndex.load(fname)
+        os.remove(fname)
+        self.assertListEqual(index2.overlap(7,16,'chr1'), [feats[0],feats[1],feats[3]])
+
     def test_fusion(self):
         stream = fstream([('chr1',10,15,'A',1),('chr1',13,18,'B',-1),('chr1',18,25,'C',-1)],
                          fields = ['chr','start','end','name','strand'])
@@ -249,6 +332,101 @@ class Test_Common(unittest.TestCase):
         self.assertListEqual(res,expected)
 
 
+class Test_Lockstep(unittest.TestCase):
+    def setUp(self):
+        self.X = [[('chr1',6,15,6.),('chr1',20,22,1.),('chr2',3,5,2.)],
+                  [('chr1',2,12,2.),('chr1',14,16,3.),('chr1',16,30,4.),('chr3',0,4,5.)],
+                  [('chr1',11,13,7.)]]
+        self.sql = ['test_lockstep%i.sql' % n for n in range(len(self.X))]
+
+    def tearDown(self):
+        for f in self.sql:
+            if os.path.exists(f): os.remove(f)
+
+    def _dense(self, batches):
+        """Rebuild per-base values from the batches, checking the grid on the way."""
+        dense = {}
+        for chrom,starts,ends,values,present in batches:
+            self.assertEqual(values.shape, (len(starts),len(self.X)))
+            self.assertListEqual(list(starts[1:]), list(ends[:-1]))
+            old = dense.get(chrom, numpy.zeros((0,len(self.X))))
+            self.assertEqual(len(old), starts[0])
+            new = numpy.repeat(values, ends-starts, axis=0)
+            assert_almost_equal(numpy.repeat(present, ends-starts, axis=0), new != 0)
+            dense[chrom] = numpy.vstack((old,new))
+        return dense
+
+    def _expected(self):
+        expected = {}
+        for i,X in enumerate(self.X):
+            for c,s,e,v in X:
+                expected.setdefault(c, numpy.zeros((30,len(self.X))))[s:e,i] = v
+        return expected
+
+    def test_streams(self):
+        expected = self._expected()
+        for chunk_size in [1,2,100]:
+            for readahead in [0,2]:
+                tracks = [fstream(X, fields=['chr','start','end','score']) for X in self.X]
+                reader = LockstepReader(tracks, chunk_size=chunk_size, readahead=readahead)
+                dense = self._dense(reader)
+                self.assertItemsEqual(dense.keys(), ['chr1','chr2','chr3'])
+                for c in dense:
+                    assert_almost_equal(dense[c], expected[c][:len(dense[c])])
+                    self.assertEqual(len(dense[c]), max(e for X in self.X for x,s,e,v in X if x == c))
+        # Values where a track has no item
+        tracks = [fstream(X, fields=['chr','start','end','score']) for X in self.X]
+        batches = list(LockstepReader(tracks, fill=numpy.nan))
+        self.assertTrue(numpy.isnan(batches[0][3][0]).all())
+
+    def test_tracks(self):
+        chrmeta = {'chr1':{'length':30},'chr2':{'length':30},'chr3':{'length':30}}
+        for X,f in zip(self.X,self.sql):
+            t = track(f, chrmeta=chrmeta, fields=['chr','start','end','score'])
+            t.write(fstream(X, fields=['chr','start','end','score']))
+            t.close()
+        expected = self._expected()
+        reader = LockstepReader(self.sql, chrnames=['chr3','chr1','chr2'], chunk_size=2)
+        self.assertListEqual(self.sql, reader.tracks)
+        chroms = [b[0] for b in reader]
+        self.assertListEqual(sorted(set(chroms),key=chroms.index), ['chr3','chr1','chr2'])
+        dense = self._dense(LockstepReader([track(f) for f in self.sql]))
+        for c in dense:
+            assert_almost_equal(dense[c], expected[c][:len(dense[c])])
+
+    def test_errors(self):
+        def _broken():
+            yield ('chr1',0,5,1.)
+            raise ValueError("broken stream")
+        tracks = [fstream(_broken(), fields=['chr','start','end','score']),
+                  fstream(self.X[0], fields=['chr','start','end','score'])]
+        self.assertRaises(ValueError, list, LockstepReader(tracks, chunk_size=1))
+
+    def test_stop(self):
+        # A consumer stopping early stops the reading thread, which closes its generator
+        closed = threading.Event()
+        def _generate():
+            try:
+                for k in xrange(1000): yield k
+            finally:
+                closed.set()
+        items = _read_ahead(_generate, 1)
+        self.assertEqual(items.next(), 0)
+        items.close()
+        closed.wait(5)
+        self.assertTrue(closed.is_set())
+
+    def test_extra(self):
+        fields = ['chr','start','end','score','name']
+        tracks = [fstream([('chr1',0,10,1.,'a'),('chr2',0,5,2.,'b')], fields=fields),
+                  fstream([('chr1',5,15,3.,'c')], fields=fields)]
+        res = []
+        for chrom,starts,ends,values,present,labels in LockstepReader(tracks, extra=['name'], chunk_size=1):
+            res.extend((chrom,s,labels[0][k,0],labels[1][k,0]) for k,s in enumerate(starts))
+        self.assertEqual(res, [('chr1',0,'a',None),('chr1',5,'a','c'),('chr1',10,None,'c'),
+                               ('chr2',0,'b',None)])
+
+
 ################### STREAM ######################
 
 
@@ -273,6 +451,25 @@ class Test_Intervals(unittest.TestCase):
     def setUp(self):
         pass
 
+    def test_getNearestFeature_local(self):
+        genes = [('chr1',1000,2000,'g1|A',1),('chr1',5000,6000,'g2|B',-1),('chr1',9000,9500,'g3|C',1),
+                 ('chr2',1000,2000,'g4|D',-1)]
+        peaks = [('chr1',10,100),('chr1',1500,1600),('chr1',2100,2200),('chr1',6500,6600),
+                 ('chr1',8950,9100),('chr1',40000,40100),('chr2',2100,2200)]
+        expected = [('chr1',10,100,'g1|A','Upstream',900),
+                    ('chr1',1500,1600,'g2|B_g1|A','Downstream_Included','3400_500'),
+                    ('chr1',2100,2200,'g1|A','3UTR',100), ('chr1',6500,6600,'g2|B','Promot',500),
+                    ('chr1',8950,9100,'g3|C','Promot',0), ('chr1',40000,40100,'','Intergenic',20000),
+                    ('chr2',2100,2200,'g4|D','Upstream',100)]
+        annotations = fstream(genes, fields=['chr','start','end','name','strand'])
+        res = list(getNearestFeature(fstream(peaks, fields=['chr','start','end']), annotations))
+        self.assertListEqual(res,expected)
+        # The index can be reused
+        index = IntervalIndex(fstream(genes, fields=['chr','start','end','name','strand']))
+        for n in range(2):
+            res = list(getNearestFeature(fstream(peaks, fields=['chr','start','end']), index))
+            self.assertListEqual(res,expected)
+
     def test_concatenate(self):
         s1 = [('chr',1,3,0.2,'n'), ('chr',5,9,0.5,'n'), ('chr',11,15,1.2,'n')]
         s2 = [('chr',1,4,0.6,'m'), ('chr',8,11,0.4,'m'), ('chr',11,12,0.1,'m')]
@@ -323,6 +520,12 @@ class Test_Intervals(unittest.TestCase):
         expected = [('chr1',1,3,0.2,'a'),('chr2',11,15,1.2,'c')]
         self.assertListEqual(list(res),expected)
 
+        # Open ranges
+        stream = fstream(s,fields=['chr','start','end','score','name'])
+        res = selection(stream,{'score':(0.5,None)})
+        expected = [('chr2',5,9,0.5,'b'),('chr2',11,15,1.2,'c')]
+        self.assertListEqual(list(res),expected)
+
     def test_overlap(self):
         s1 = [('chr',0,4,'n',1.), ('chr',7,12,'n',2.), ('chr',16,19,'n',3.), ('chr',22,27,'n',4.)]
         s2 = [('chr',2,9,'m'), ('chr',13,14,'m'), ('chr',22,23,'m'), ('chr',26,27,'m')]
@@ -341,6 +544,46 @@ class Test_Intervals(unittest.TestCase):
         expected = [('chr',0,3,'+'),('chr',7,12,'+')]
         self.assertListEqual(list(res),expected)
 
+    def test_overlap_genome(self):
+        _f = ['chr','start','end']
+        X = [('chr1',4,12,'a'),('chr1',21,34,'b'),('chr2',0,10,'c'),('chr3',5,8,'d')]
+        Y = [('chr1',10,16),('chr1',18,24),('chr1',30,32),('chr3',0,6),('chr4',1,2)]
+        res = list(overlap_genome(fstream(X,fields=_f+['name']), fstream(Y,fields=_f)))
+        expected = [('chr1',4,12,'a',2),('chr1',21,34,'b',5),('chr3',5,8,'d',1)]
+        self.assertListEqual(res,expected)
+
+        # fraction of the item covered, containment
+        res = list(overlap_genome(fstream(X,fields=_f+['name']), fstream(Y,fields=_f), fraction=0.3))
+        self.assertListEqual(res,[('chr1',21,34,'b',5),('chr3',5,8,'d',1)])
+        res = list(overlap_genome(fstream(X,fields=_f+['name']), fstream(Y,fields=_f), strict=True))
+        self.assertListEqual(res,[('chr1',21,34,'b',5)])
+
+        # strand-aware
+        X = [('chr1',4,12,1),('chr1',4,12,-1)]
+        Y = [('chr1',10,16,1)]
+        res = list(overlap_genome(fstream(X,fields=_f+['strand']), fstream(Y,fields=_f+['strand'])))
+        self.assertListEqual(res,[('chr1',4,12,1,2)])
+
+        # chromosomes present in only one stream, or in the order of chrnames
+        X = [('chr1',0,10,1.),('chr3',0,10,2.)]
+        Y = [('chr1',100,200),('chr2',0,5),('chr3',2,4)]
+        res = list(overlap_genome(fstream(X,fields=_f+['score']), fstream(Y,fields=_f)))
+        self.assertListEqual(res,[('chr3',0,10,2.,2)])
+        X = [('chr3',0,10,2.),('chr1',0,10,1.)]
+        Y = [('chr3',2,4),('chr2',0,5),('chr1',5,6)]
+        res = list(overlap_genome(fstream(X,fields=_f+['score']), fstream(Y,fields=_f),
+                                  chrnames=['chr3','chr2','chr1']))
+        self.assertListEqual(res,[('chr3',0,10,2.,2),('chr1',0,10,1.,1)])
+        res = overlap_genome(fstream(X,fields=_f+['score']), fstream(Y,fields=_f))
+        self.assertRaises(ValueError, list, res)
+
+        # features of skipped chromosomes are read through, not kept
+        Y = fstream((('chr2',n,n+1) for n in xrange(100000)), fields=_f)
+        X = [('chr1',0,10,1.),('chr3',0,10,2.)]
+        res = list(overlap_genome(fstream(X,fields=_f+['score']), Y))
+        self.assertListEqual(res,[])
+        self.assertIsNone(next(Y,None))
+
     def test_neighborhood(self):
         s = [(10,16,0.5,-1), (24,36,1.2,1)]
 
@@ -369,6 +612,13 @@ class Test_Intervals(unittest.TestCase):
         expected = [(6,14,0.5,-1),(13,17,0.5,-1), (23,27,1.2,1),(32,40,1.2,1)]
         self.assertListEqual(res,expected)
 
+        # Windows around the ends of nested features must come out sorted
+        s = [(0,100,'a'), (10,20,'b'), (15,60,'c')]
+        stream = fstream(s, fields=['start','end','name'])
+        res = list(neighborhood(stream, before_end=5,after_end=5))
+        expected = [(14,25,'b'), (54,65,'c'), (94,105,'a')]
+        self.assertListEqual(res,expected)
+
     def test_segment_features(self):
         stream = fstream([('X',10,16,'A'), ('X',18,30,'B'), ('I',10,16,'C')],
                          fields=['chr','start','end','name'])
@@ -385,6 +635,11 @@ class Test_Intervals(unittest.TestCase):
                     (22,24,1,0), (24,30,1,1),(30,36,1,2), (36,39,1,3)]
         self.assertListEqual(res,expected)
 
+        # A single bin is yielded only once
+        stream = fstream([(10,11,1)], fields=['start','end','strand'])
+        res = list(segment_features(stream,nbins=1))
+        self.assertListEqual(res,[(10,11,1,0)])
+
     def test_exclude(self):
         # combine( ... , fn=exclude)
         self.assertEqual(exclude([True,True,False,False,False],[2,3,4]), True)
@@ -441,6 +696,20 @@ class Test_Intervals(unittest.TestCase):
         expected = [('chr',20,40,'0','0','0')]
         self.assertListEqual(res,expected)
 
+        # Empty tracks keep their index and are never active
+        fields = ['chr','start','end','score']
+        res = list(combine([fstream([('chr1',0,10,1.)],fields=fields),fstream([],fields=fields)],
+                           fn=intersection))
+        self.assertListEqual(res,[])
+        tracks = [fstream([('chr1',0,10,1.)],fields=fields), fstream([],fields=fields),
+                  fstream([('chr1',5,20,2.)],fields=fields)]
+        res = list(combine(tracks, fn=lambda x: exclude(x,[2])))
+        self.assertListEqual(res,[('chr1',0,5,1.)])
+        tracks = [fstream([('chr1',0,10,1.)],fields=fields), fstream([],fields=fields),
+                  fstream([('chr1',5,20,2.)],fields=fields)]
+        res = list(combine(tracks, fn=lambda x: exclude(x,[1])))
+        self.assertListEqual(res,[('chr1',0,5,1.),('chr1',5,10,3.),('chr1',10,20,2.)])
+
 
 class Test_Scores(unittest.TestCase):
     def setUp(self):
@@ -465,6 +734,20 @@ class Test_Scores(unittest.TestCase):
         res = list(merge_scores([s1,s2], method='sum'))
         expected = [(5,10,2.),(10,15,8.),(15,20,6.)]
         self.assertListEqual(res,expected)
+        # Median, reading one item at a time
+        s1 = fstream([(10,20,6.),(20,22,1.)], fields=['start','end','score'])
+        s2 = fstream([(5,15,2.),(18,30,3.)], fields=['start','end','score'])
+        s3 = fstream([(12,25,4.)], fields=['start','end','score'])
+        res = list(merge_scores([s1,s2,s3], method='median', chunk_size=1))
+        expected = [(5,10,2.),(10,12,4.),(12,15,4.),(15,18,5.),(18,20,4.),(20,22,3.),(22,25,3.5),(25,30,3.)]
+        self.assertListEqual(res,expected)
+        # Several chromosomes are merged separately
+        s1 = fstream([('chr1',10,20,6.),('chr2',0,10,1.)], fields=['chr','start','end','score'])
+        s2 = fstream([('chr1',5,15,2.),('chr2',5,20,3.)], fields=['chr','start','end','score'])
+        res = list(merge_scores([s1,s2], method='sum', chunk_size=1))
+        expected = [('chr1',5,10,2.),('chr1',10,15,8.),('chr1',15,20,6.),
+                    ('chr2',0,5,1.),('chr2',5,10,4.),('chr2',10,20,3.)]
+        self.assertListEqual(res,expected)
 
     def test_filter_scores(self):
         features = fstream([(5,15,'gene1'),(30,40,'gene2')], fields=['start','end','name'])
@@ -511,12 +794,253 @@ class Test_Scores(unittest.TestCase):
         expected = [('chr',5,15,'gene1',30.,6.),('chr',30,40,'gene2',60.,9.)]
         self.assertListEqual(res,expected)
 
+        # Scores are weighted by the length of their intersection with the feature
+        features = [('chr',0,10,'gene1'),('chr',20,30,'gene2')]
+        scores = [('chr',0,6,1.),('chr',6,8,5.),('chr',8,10,2.),('chr',20,25,4.)]
+        for method,expected in [('sum',[20.,20.]), ('mean',[2.,2.]), ('median',[1.,4.]), ('min',[1.,4.]),
+                                ('max',[5.,4.]), ('coverage',[1.,.5]), ('q80',[2.,4.])]:
+            res = list(score_by_feature(fstream(scores, fields=['chr','start','end','score']),
+                                        fstream(features, fields=['chr','start','end','name']),
+                                        method=method))
+            self.assertListEqual([r[-1] for r in res], expected)
+        res = list(score_by_feature(fstream([('chr',50,60,1.)], fields=['chr','start','end','score']),
+                                    fstream([('chr',0,10,'gene1')], fields=['chr','start','end','name']),
+                                    method='median'))
+        self.assertListEqual(res, [('chr',0,10,'gene1',0)])
+
+        # Geometric mean over long features neither overflows nor underflows
+        features = fstream([('chr',0,5000,'gene1'),('chr',5000,9000,'gene2')], fields=['chr','start','end','name'])
+        scores = fstream([('chr',0,2000,2.),('chr',2000,5000,8.),('chr',5000,9000,1e-3)],
+                         fields=['chr','start','end','score'])
+        res = list(score_by_feature(scores, features, method='geometric'))
+        assert_almost_equal([r[-1] for r in res], [2**.4*8**.6, 1e-3])
+        # ... and is 0 on a feature without scores
+        res = list(score_by_feature(fstream([('chr',50,60,2.)], fields=['chr','start','end','score']),
+                                    fstream([('chr',0,10,'gene1')], fields=['chr','start','end','name']),
+                                    method='geometric'))
+        self.assertListEqual(res, [('chr',0,10,'gene1',0.)])
+
     def test_window_smoothing(self):
         stream = fstream([('chr1',4,5,10.)], fields=['chr','start','end','score'])
         res = list(window_smoothing(stream, window_size=2, step_size=1))
-        expected = [('chr1',4,5,5.),('chr1',5,6,5.)]
+        expected = [('chr1',4,6,5.)]
         self.assertListEqual(res,expected)
 
+        # Chunks do not change the result
+        s = [('chr1',4,5,10.),('chr1',10,14,3.),('chr1',30,32,1.5),('chr2',4,8,1.)]
+        res = list(window_smoothing(fstream(s, fields=['chr','start','end','score']), window_size=5))
+        expected = [('chr1',2,7,2.),('chr1',8,9,.6),('chr1',9,10,1.2),('chr1',10,11,1.8),('chr1',11,13,2.4),
+                    ('chr1',13,14,1.8),('chr1',14,15,1.2),('chr1',15,16,.6),
+                    ('chr1',28,29,.3),('chr1',29,33,.6),('chr1',33,34,.3),
+                    ('chr2',2,3,.2),('chr2',3,4,.4),('chr2',4,5,.6),('chr2',5,7,.8),('chr2',7,8,.6),
+                    ('chr2',8,9,.4),('chr2',9,10,.2)]
+        self.assertListEqual([x[:3] for x in res], [x[:3] for x in expected])
+        assert_almost_equal([x[3] for x in res], [x[3] for x in expected])
+        for kernel in ['box','triangular','gaussian']:
+            res = list(window_smoothing(fstream(s, fields=['chr','start','end','score']),
+                                        window_size=5, kernel=kernel))
+            res_chunks = list(window_smoothing(fstream(s, fields=['chr','start','end','score']),
+                                               window_size=5, kernel=kernel, chunk_size=3))
+            self.assertListEqual(res,res_chunks)
+
+        # Small scores are kept, coordinates are plain ints
+        s = [('chr1',4,5,1e-9),('chr1',10,14,3.)]
+        res = list(window_smoothing(fstream(s, fields=['chr','start','end','score']), window_size=2))
+        expected = [('chr1',4,6,5e-10),('chr1',10,11,1.5),('chr1',11,14,3.),('chr1',14,15,1.5)]
+        self.assertListEqual([x[:3] for x in res], [x[:3] for x in expected])
+        assert_almost_equal([x[3]/y[3] for x,y in zip(res,expected)], [1.]*4)
+        self.assertTrue(all(type(x[1]) is int and type(x[2]) is int for x in res))
+
+        # Other fields are not taken for the chromosome, and are dropped
+        s = [(20,22,1.5,'a'),(21,23,2.5,'b')]
+        res = window_smoothing(fstream(s, fields=['start','end','score','name']), window_size=1)
+        self.assertListEqual(res.fields, ['start','end','score'])
+        self.assertListEqual(list(res), [(20,21,1.5),(21,22,4.),(22,23,2.5)])
+        s = [('chr1',20,22,1.5,'a')]
+        res = window_smoothing(fstream(s, fields=['chr','start','end','score','name']), window_size=1)
+        self.assertListEqual(res.fields, ['chr','start','end','score'])
+        self.assertListEqual(list(res), [('chr1',20,22,1.5)])
+
+
+class Test_Bedtools(unittest.TestCase):
+    """In-process equivalents of bedtools commands, on the files in test_data/bedtools."""
+    def setUp(self):
+        self.a = path+'a.bed'
+        self.b = path+'b.bed'
+        self.g = path+'genome.txt'
+
+    def read(self, f):
+        return track(f).read()
+
+    def coords(self, stream):
+        return [x[:3] for x in stream]
+
+    def test_intersectBed(self):
+        res = self.coords(intersectBed(self.read(self.a), self.read(self.b)))
+        self.assertEqual(res, [('chr1',10,12),('chr1',18,20),('chr1',18,25),('chr1',20,30),
+                               ('chr1',150,160),('chr2',85,86)])
+        names = lambda s: [x[3] for x in s]
+        self.assertEqual(names(intersectBed(self.read(self.a), self.read(self.b), u=True)), ['a1','a2','a3','a6'])
+        self.assertEqual(names(intersectBed(self.read(self.a), self.read(self.b), v=True)), ['a4','a5'])
+        self.assertEqual(names(intersectBed(self.read(self.a), self.read(self.b), u=True, s=True)), ['a1','a2','a6'])
+        self.assertEqual(names(intersectBed(self.read(self.a), self.read(self.b), u=True, S=True)), ['a1','a2','a3'])
+        res = intersectBed(self.read(self.a), self.read(self.b), c=True)
+        self.assertEqual([x[-1] for x in res], [2,2,1,0,0,1])
+        res = intersectBed(self.read(self.a), self.read(self.b), c=True, f=0.3)
+        self.assertEqual([x[-1] for x in res], [0,1,0,0,0,0])
+        res = intersectBed(self.read(self.a), self.read(self.b), wo=True)
+        self.assertEqual(res.fields[6:], ['chr_b','start_b','end_b','name_b','score_b','strand_b','overlap'])
+        self.assertEqual([(x[3],x[9],x[12]) for x in res],
+                         [('a1','b1',2),('a1','b2',2),('a2','b2',7),('a2','b3',10),('a3','b4',10),('a6','b7',1)])
+
+    def test_mergeBed(self):
+        res = list(mergeBed(self.read(self.a), c='score', o='sum'))
+        self.assertEqual(res, [('chr1',10,40,3.),('chr1',100,200,3.),('chr1',300,310,4.),
+                               ('chr2',0,50,5.),('chr2',80,90,6.)])
+        res = list(mergeBed(self.read(self.a), d=60, c=['name','name'], o=['count','collapse']))
+        self.assertEqual(res, [('chr1',10,200,3,'a1,a2,a3'),('chr1',300,310,1,'a4'),('chr2',0,90,2,'a5,a6')])
+        res = self.coords(mergeBed(self.read(self.a), s=True))
+        self.assertEqual(res, [('chr1',10,20),('chr1',15,40),('chr1',100,200),('chr1',300,310),
+                               ('chr2',0,50),('chr2',80,90)])
+
+    def test_closestBed(self):
+        res = closestBed(self.read(self.a), self.read(self.b), d=True)
+        self.assertEqual([(x[3],x[9],x[-1]) for x in res],
+                         [('a1','b1',0),('a1','b2',0),('a2','b2',0),('a2','b3',0),('a3','b4',0),
+                          ('a4','b5',81),('a5','b6',1),('a6','b7',0)])
+        res = closestBed(self.read(self.a), self.read(self.b), d=True, io=True, t='first')
+        self.assertEqual([(x[3],x[9],x[-1]) for x in res][:2], [('a1','b3',1),('a2','b1',4)])
+        res = list(closestBed(fstream([('chr3',0,10)],fields=['chr','start','end']), self.read(self.b), d=True))
+        self.assertEqual(res, [('chr3',0,10,'.',-1,-1,'.','.','.',-1)])
+
+    def test_coverageBed(self):
+        res = coverageBed(self.read(self.a), self.read(self.b))
+        self.assertEqual([x[6:] for x in res], [(2,4,10,.4),(2,12,25,.48),(1,10,100,.1),
+                                                (0,0,10,0.),(0,0,50,0.),(1,1,10,.1)])
+
+    def test_complementBed(self):
+        res = list(complementBed(self.read(self.a), self.g))
+        self.assertEqual(res, [('chr1',0,10),('chr1',40,100),('chr1',200,300),('chr1',310,1000),
+                               ('chr2',50,80),('chr2',90,500),('chr3',0,200)])
+
+    def test_slopBed_flankBed(self):
+        res = self.coords(slopBed(self.read(self.a), self.g, b=5))
+        self.assertEqual(res[0], ('chr1',5,25))
+        self.assertEqual(res[4], ('chr2',0,55))
+        res = self.coords(slopBed(self.read(self.a), {'chr1':{'length':35},'chr2':{'length':500}}, l=10, r=0, s=True))
+        self.assertEqual(res[:2], [('chr1',0,20),('chr1',15,35)])
+        res = self.coords(flankBed(self.read(self.a), self.g, b=5))
+        self.assertEqual(res[:2], [('chr1',5,10),('chr1',20,25)])
+        self.assertEqual(res[8:10], [('chr2',50,55),('chr2',75,80)])
+
+    def test_mapBed(self):
+        res = mapBed(self.read(self.a), self.read(self.b), c='score', o='sum')
+        self.assertEqual(res.fields[-1], 'score_b')
+        self.assertEqual([x[-1] for x in res], [3.5,5.,4.,'.','.',7.])
+        res = mapBed(self.read(self.a), self.read(self.b), c=['name','name'], o=['count','distinct'])
+        self.assertEqual([x[-2:] for x in res][:2], [(2,'b1,b2'),(2,'b2,b3')])
+
+    def commands(self):
+        """(expected output file, bedtools command, in-process result) for each command."""
+        a,b,c,g = self.a,self.b,path+'c.bed',self.g
+        return [
+            ("intersect", "intersect -a %s -b %s" %(a,b), intersectBed(self.read(a),self.read(b))),
+            ("intersect_wa_wb", "intersect -a %s -b %s -wa -wb" %(a,b), intersectBed(self.read(a),self.read(b),wa=True,wb=True)),
+            ("intersect_wo", "intersect -a %s -b %s -wo" %(a,b), intersectBed(self.read(a),self.read(b),wo=True)),
+            ("intersect_u_s", "intersect -a %s -b %s -u -s" %(a,b), intersectBed(self.read(a),self.read(b),u=True,s=True)),
+            ("intersect_v_S", "intersect -a %s -b %s -v -S" %(a,b), intersectBed(self.read(a),self.read(b),v=True,S=True)),
+            ("intersect_c_f", "intersect -a %s -b %s -c -f 0.3" %(a,b), intersectBed(self.read(a),self.read(b),c=True,f=0.3)),
+            ("merge", "merge -i %s" %a, mergeBed(self.read(a))),
+            ("merge_d_c_o", "merge -i %s -d 60 -c 5,4 -o sum,collapse" %a, mergeBed(self.read(a),d=60,c=['score','name'],o=['sum','collapse'])),
+            ("merge_s", "merge -i %s -s" %a, mergeBed(self.read(a),s=True)),
+            ("closest_d", "closest -a %s -b %s -d" %(a,b), closestBed(self.read(a),self.read(b),d=True)),
+            ("closest_d_io_t", "closest -a %s -b %s -d -io -t first" %(a,b), closestBed(self.read(a),self.read(b),d=True,io=True,t='first')),
+            ("coverage", "coverage -a %s -b %s" %(a,b), coverageBed(self.read(a),self.read(b))),
+            ("complement", "complement -i %s -g %s" %(a,g), complementBed(self.read(a),g)),
+            ("complement_c", "complement -i %s -g %s" %(c,g), complementBed(self.read(c),g)),
+            ("slop_b", "slop -i %s -g %s -b 5" %(a,g), slopBed(self.read(a),g,b=5)),
+            ("slop_l_r_s", "slop -i %s -g %s -l 10 -r 0 -s" %(a,g), slopBed(self.read(a),g,l=10,r=0,s=True)),
+            ("flank_b", "flank -i %s -g %s -b 5" %(a,g), flankBed(self.read(a),g,b=5)),
+            ("map_sum", "map -a %s -b %s -c 5 -o sum" %(a,b), mapBed(self.read(a),self.read(b),c='score',o='sum')),
+            ("map_count", "map -a %s -b %s -c 4 -o count" %(a,b), mapBed(self.read(a),self.read(b),c='name',o='count'))]
+
+    def norm(self, lines):
+        """Compare rows as text: numbers rounded, strands as 1/-1."""
+        def _norm(v):
+            try: return round(float(v),4)
+            except ValueError: return {'+':1.,'-':-1.}.get(v,v)
+        return [[_norm(str(v)) for v in x] for x in lines]
+
+    def test_expected_outputs(self):
+        """Compare with the output of bedtools, stored in test_data/bedtools/expected."""
+        for name, cmd, res in self.commands():
+            with open(path+'expected/%s.bed' % name) as f:
+                expected = [line.rstrip("\n").split("\t") for line in f if line.strip()]
+            self.assertEqual(self.norm(res), self.norm(expected), cmd)
+
+    @unittest.skipUnless(find_executable('bedtools'), "bedtools is not installed")
+    def test_equivalence(self):
+        """Compare with the output of bedtools itself."""
+        for name, cmd, res in self.commands():
+            out = subprocess.Popen(["bedtools"]+cmd.split(), stdout=subprocess.PIPE).communicate()[0]
+            self.assertEqual(self.norm(res), self.norm(line.split("\t") for line in out.splitlines()), cmd)
+
+    def test_output_fields(self):
+        a = ['chr','start','end','name']
+        b = ['chr','start','end','score']
+        self.assertEqual(_output_fields('intersect', {'-u':[]}, {'-a':a,'-b':b}), a)
+        self.assertEqual(_output_fields('intersect', {'-wo':[]}, {'-a':a,'-b':b}),
+                         a+['chr_b','start_b','end_b','score','overlap'])
+        self.assertEqual(_output_fields('closest', {'-d':[]}, {'-a':a,'-b':b}),
+                         a+['chr_b','start_b','end_b','score','distance'])
+        self.assertEqual(_output_fields('merge', {'-c':'4'}, {'-i':a}), ['chr','start','end','name'])
+        self.assertEqual(_output_fields('map', {}, {'-a':a,'-b':['chr','start','end','id','x']}), a+['x'])
+        self.assertEqual(_output_fields('multiinter', {}, {'-i':a}), None)
+
+    def test_feed(self):
+        def _fed(source):
+            errors = []
+            out = 'test_feed.bed'
+            th = threading.Thread(target=_feed, args=(source,lambda: open(out,'w'),errors))
+            th.start()
+            th.join()
+            with open(out) as f: lines = [x.rstrip("\n").split("\t") for x in f]
+            os.remove(out)
+            return lines, errors
+        # BED6 columns come first, missing ones are filled, other fields follow
+        s = fstream([('chr1',10,20,2.,-1,'x')], fields=['chr','start','end','score','strand','id'])
+        self.assertEqual(_bed_layout(s.fields), ['chr','start','end','name','score','strand','id'])
+        self.assertEqual(_fed(s), ([['chr1','10','20','.','2.0','-','x']], []))
+        self.assertEqual(_fed(fstream([('chr1',10,20)], fields=['chr','start','end'])),
+                         ([['chr1','10','20']], []))
+        # An sqlite Track is reopened by the writing thread, its stream cannot be read there
+        sql = 'test_feed.sql'
+        t = track(sql, fields=['chr','start','end','name','score','strand'],
+                  chrmeta={'chr1':{'length':1000},'chr2':{'length':500}})
+        t.write(self.read(self.a))
+        t.close()
+        try:
+            t = track(sql)
+            lines, errors = _fed(t)
+            self.assertEqual(errors, [])
+            self.assertEqual(lines[0], ['chr1','10','20','a1','1.0','+'])
+            self.assertEqual(len(lines), 6)
+            lines, errors = _fed(t.read())
+            self.assertEqual(errors[0][0], sqlite3.ProgrammingError)
+            t.close()
+        finally:
+            os.remove(sql)
+
+    @unittest.skipUnless(find_executable('bedtools'), "bedtools is not installed")
+    def test_bedtools_stream(self):
+        # inputs from a file, from stdin and from a named pipe
+        for a,b in [(self.a,self.b),(self.read(self.a),self.b),(self.read(self.a),self.read(self.b)),
+                    (track(self.a),track(self.b))]:
+            res = bedtools_stream('intersect', {'a':a, 'b':b, 'wo':True})
+            expected = intersectBed(self.read(self.a), self.read(self.b), wo=True)
+            self.assertEqual(res.fields, expected.fields)
+            self.assertEqual(list(res), list(expected))
+
 
 ################### NUMERIC ######################
 
@@ -541,6 +1065,19 @@ class Test_Regions(unittest.TestCase):
         feat, res = feature_matrix([scores1,scores2],features, segment=True, nbins=3)
         assert_almost_equal(res, numpy.array([[[0,2],[2,2],[6,2]],
                                               [[6,0],[6,0],[6,0]]]))
+
+        # Several chromosomes, reverse strand, read by chunks into a memmap
+        features = fstream([('chr1',5,15,'gene1',-1),('chr2',5,15,'gene2',1)],
+                           fields=['chr','start','end','name','strand'])
+        scores = fstream([('chr1',10,15,6.),('chr2',5,10,3.)], fields=['chr','start','end','score'])
+        fname = 'test_feature_matrix.mmap'
+        feat, res = feature_matrix(scores,features, segment=True, nbins=2, method='sum',
+                                   memmap=fname, chunk_size=1)
+        self.assertListEqual(list(feat),['gene1','gene2'])
+        assert_almost_equal(res, numpy.array([[[30],[0]],[[15],[0]]]))
+        del res
+        os.remove(fname)
+
     def test_summed_feature_matrix(self):
         features = fstream([(5,15,'gene1'),(30,40,'gene2')], fields=['start','end','name'])
         scores1 = fstream([(10,15,6.),(30,40,6.)], fields=['start','end','score'])
@@ -549,11 +1086,58 @@ class Test_Regions(unittest.TestCase):
         res /= n*1.0
         assert_almost_equal(res, numpy.array([[3.,1.],[4.,1.],[6.,1.]]))
 
+    def test_tile_matrix(self):
+        chrmeta = {'chr1':{'length':18},'chr2':{'length':7}}
+        def _tracks():
+            X = fstream([('chr1',3,8,6.),('chr1',13,17,2.),('chr2',4,10,-1.)], fields=['chr','start','end','score'])
+            Y = fstream([('chr1',0,2),('chr1',8,12),('chr1',16,18),('chr3',0,5)], fields=['chr','start','end'])
+            return [X,Y]
+        tiles, res = tile_matrix(_tracks(), 5, chrmeta)
+        self.assertListEqual(tiles, [('chr1',0,4),('chr2',4,2)])
+        assert_almost_equal(res, [[12,2],[18,2],[4,2],[4,2],[-1,0],[-2,0]])
+        tiles, res = tile_matrix(_tracks(), 5, chrmeta, method='mean', chunk_size=2)
+        assert_almost_equal(res, [[2.4,.4],[3.6,.4],[.8,.4],[4/3.,2/3.],[-.2,0],[-1,0]])
+        tiles, res = tile_matrix(_tracks(), 5, chrmeta, method='coverage')
+        assert_almost_equal(res, [[.4,.4],[.6,.4],[.4,.4],[2/3.,2/3.],[.2,0],[1,0]])
+        tiles, res = tile_matrix(_tracks(), 5, chrmeta, method='max')
+        assert_almost_equal(res, [[6,1],[6,1],[2,1],[2,1],[-1,0],[-1,0]])
+        tiles, res = tile_matrix(_tracks(), 5, chrmeta, method='count')
+        assert_almost_equal(res, [[1,1],[0,1],[1,0],[0,1],[1,0],[0,0]])
+        self.assertRaises(ValueError, tile_matrix, _tracks(), 5, chrmeta, method='median')
+        # Memory-mapped output
+        fname = 'test_tiles.npy'
+        tiles, res = tile_matrix(_tracks(), 5, chrmeta, output=fname)
+        del res
+        assert_almost_equal(numpy.load(fname), [[12,2],[18,2],[4,2],[4,2],[-1,0],[-2,0]])
+        os.remove(fname)
+        # Track outputs, one per input; the chromosome lengths come from the input track
+        sqlin = 'test_tiles_in.sql'
+        t = track(sqlin, chrmeta=chrmeta, fields=['chr','start','end','score'])
+        t.write(_tracks()[0])
+        t.close()
+        fname = 'test_tiles.sql'
+        tile_matrix([track(sqlin),_tracks()[1]], 5, output=fname)
+        t = track('test_tiles._0.sql')
+        self.assertListEqual(list(t.read(selection='chr2')), [('chr2',0,5,-1.),('chr2',5,7,-2.)])
+        t.close()
+        tile_matrix(track(sqlin), 10, output='test_tiles.bedGraph')
+        t = track('test_tiles.bedGraph', chrmeta=chrmeta)
+        self.assertListEqual(list(t.read()), [('chr1',0,10,30.),('chr1',10,18,8.),('chr2',0,7,-3.)])
+        for f in [sqlin,'test_tiles._0.sql','test_tiles._1.sql','test_tiles.bedGraph']:
+            os.remove(f)
+
 
 class Test_Signal(unittest.TestCase):
     def setUp(self):
         pass
 
+    def test_score_array(self):
+        t1 = fstream([('a',1.,10),('b',2.,20),('c',3.,30)], fields=['name','score','count'])
+        t2 = fstream([('c',5.,50),('x',9.,90),('a',4.,40)], fields=['name','score','count'])
+        nums, labs = score_array([t1,t2], fields=['score','count'], chunk_size=2)
+        self.assertListEqual(list(labs), ['a','b','c'])
+        assert_almost_equal(nums, numpy.array([[1,10,4,40],[2,20,numpy.nan,numpy.nan],[3,30,5,50]]))
+
     def test_normalize(self):
         s1 = [('a',64.),('b',256.),('c',16.)]
         s2 = [('a',16.),('b',16.),('c',16.)]
@@ -561,9 +1145,11 @@ class Test_Signal(unittest.TestCase):
         # deseq
         scores1 = fstream(s1, fields=['name','score'])
         scores2 = fstream(s2, fields=['name','score'])
-        res = normalize([scores1,scores2], method='deseq')
+        out = {}
+        res = normalize([scores1,scores2], method='deseq', out=out)
         expected = [[('a',32.),('b',128.),('c',8.)],[('a',32.),('b',32.),('c',32.)]]
         self.assertListEqual([list(r) for r in res],expected)
+        assert_almost_equal(out['factors'],[2.,.5])
 
         # total
         scores1 = fstream(s1, fields=['name','score'])
@@ -580,6 +1166,16 @@ class Test_Signal(unittest.TestCase):
         expected = [0.19,0.76,0.05]
         self.assertListEqual(scores,expected)
 
+        # total, factors given or returned
+        out = {}
+        res = normalize([fstream(s1, fields=['name','score']),fstream(s2, fields=['name','score'])],
+                        method='total', out=out)
+        res = [list(r) for r in res]
+        self.assertListEqual(out['factors'],[336.,48.])
+        res2 = normalize([fstream(s1, fields=['name','score']),fstream(s2, fields=['name','score'])],
+                         factors=out['factors'])
+        self.assertListEqual([list(r) for r in res2],res)
+
         # quantiles
         scores1 = fstream(s1, fields=['name','score'])
         scores2 = fstream(s2, fields=['name','score'])
@@ -595,6 +1191,45 @@ class Test_Signal(unittest.TestCase):
         expected = [32.,128.,8.]
         self.assertListEqual(scores,expected)
 
+    def test_normalize_spooled(self):
+        from bbcflib.gfminer.common import normalize as normalize_matrix
+        from bbcflib.gfminer.stream.scores import _spool, _unspool, _quantile_reference, _deseq_size_factors
+        tmpdir = 'test_normalize_tmp'
+        os.mkdir(tmpdir)
+        try:
+            numpy.random.seed(0)
+            M = numpy.array([numpy.random.permutation(50)[:25]+1. for n in range(2)]) # no ties
+            streams = lambda: [fstream([('f%d'%k,s) for k,s in enumerate(m)], fields=['name','score'])
+                               for m in M]
+            # deseq, spooled by chunks smaller than the tracks
+            spooled = [_spool(t,1,tmpdir,chunk=7) for t in streams()]
+            self.assertEqual([x[2] for x in spooled],[25,25])
+            factors = _deseq_size_factors([x[1] for x in spooled],25,tmpdir,chunk=7)
+            logs = numpy.log(M)
+            assert_almost_equal(factors, numpy.exp(numpy.median(logs-logs.mean(axis=0),axis=1)))
+            res = [list(_unspool(x[0],x[1],x[2],1,lambda v:numpy.around(v/factors[n],2)))
+                   for n,x in enumerate(spooled)]
+            assert_almost_equal([[x[1] for x in r] for r in res], normalize_matrix(M,'deseq'))
+            self.assertListEqual(os.listdir(tmpdir),[])
+            # quantile
+            spooled = [_spool(t,1,tmpdir,chunk=7) for t in streams()]
+            _quantile_reference([x[1] for x in spooled],25)
+            res = [list(_unspool(x[0],x[1],x[2],1,lambda v:v)) for x in spooled]
+            assert_almost_equal([[x[1] for x in r] for r in res], normalize_matrix(M,'quantile'))
+            self.assertListEqual([x[0] for x in res[0]],['f%d'%k for k in range(25)])
+            self.assertListEqual(os.listdir(tmpdir),[])
+            # temporary files are removed with the streams, read or not
+            for method in ['deseq','quantile','total']:
+                res = normalize(streams(), method=method, tmpdir=tmpdir)
+                self.assertEqual(len(os.listdir(tmpdir)),1)
+                self.assertEqual(len(list(res[0])),25) # fully read
+                res[1].next() # partly read
+                del res
+                gc.collect()
+                self.assertListEqual(os.listdir(tmpdir),[])
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
     def test__normalize(self):
         x = [1,2,3,4,5] # mean=15/5=3, var=(1/5)*(4+1+0+1+4)=2
         assert_almost_equal(vec_reduce(x), numpy.array([-2,-1,0,1,2])*(1/math.sqrt(2)))
@@ -655,6 +1290,241 @@ class Test_Signal(unittest.TestCase):
         # Test if the lag between the two tracks is correcty detected
         self.assertEqual(numpy.argmax(corr)-(N-1), ypeak-xpeak)
 
+    def test_correlation_matrix(self):
+        N = 200
+        scores = [numpy.random.random(N) for k in range(3)]
+        def _tracks():
+            return [fstream([('chr',k,k+1,s) for k,s in enumerate(x)], fields=['chr','start','end','score'])
+                    for x in scores]
+        x = [vec_reduce(s) for s in scores]
+        limits = (-30,10)
+        C = correlation_matrix(_tracks(), regions=(0,N), limits=limits)
+        self.assertEqual(C.shape, (3,3,41))
+        expected = [numpy.dot(x[0][max(0,-k):N-max(0,k)], x[2][max(0,k):N-max(0,-k)])/N
+                    for k in range(limits[0],limits[1]+1)]
+        assert_almost_equal(C[0,2], expected, decimal=5)
+        # By blocks, with spectra written to and loaded from disk
+        fname = 'test_spectra.npy'
+        t = _tracks()
+        Spectra(t[0], (0,N), limits, block_size=50, path=fname)
+        C2 = correlation_matrix([Spectra.load(fname)]+t[1:], (0,N), limits, block_size=50)
+        os.remove(fname)
+        os.remove(fname+'.meta')
+        assert_almost_equal(C2, C, decimal=5)
+
+
+class Test_Rle(unittest.TestCase):
+    def setUp(self):
+        self.a = RleSignal.from_stream(fstream([('chr1',2,5,1.),('chr1',4,8,2.),('chr2',0,3,4.)],
+                                               fields=['chr','start','end','score']),
+                                       chrmeta={'chr1':{'length':10},'chr2':{'length':4}})
+        self.b = RleSignal.from_stream(fstream([('chr1',0,6,2.)], fields=['chr','start','end','score']),
+                                       chrmeta={'chr1':{'length':10}})
+        self.dense_a = numpy.array([0,0,1,1,3,2,2,2,0,0.])
+        self.dense_b = numpy.array([2,2,2,2,2,2,0,0,0,0.])
+
+    def test_conversions(self):
+        assert_almost_equal(self.a.to_array('chr1'), self.dense_a)
+        assert_almost_equal(self.a.to_array('chr1',3,6), self.dense_a[3:6])
+        self.assertEqual(self.a.length('chr2'), 4)
+        res = list(self.a.to_stream())
+        expected = [('chr1',2,4,1.),('chr1',4,5,3.),('chr1',5,8,2.),('chr2',0,3,4.)]
+        self.assertListEqual(res, expected)
+        self.assertEqual(len(list(self.a.to_stream('chr1',zeros=True))), 5)
+        fname = 'test_rle.sql'
+        self.a.to_track(fname)
+        t = track(fname)
+        self.assertEqual(t.chrmeta['chr1']['length'], 10)
+        c = RleSignal.from_track(t)
+        t.close()
+        os.remove(fname)
+        self.assertListEqual(list(c.to_stream()), expected)
+        self.assertEqual(c.length('chr1'), 10)
+
+    def test_arithmetic(self):
+        a, b, da, db = self.a, self.b, self.dense_a, self.dense_b
+        assert_almost_equal((a+b).to_array('chr1'), da+db)
+        assert_almost_equal((a-2*b).to_array('chr1'), da-2*db)
+        assert_almost_equal((a*b).to_array('chr1'), da*db)
+        assert_almost_equal(((a+1)/(b+1)).to_array('chr1'), (da+1)/(db+1))
+        assert_almost_equal((1-a).to_array('chr1'), 1-da)
+        assert_almost_equal(((a > 1.5)*a).to_array('chr1'), (da > 1.5)*da)
+        assert_almost_equal(a.maximum(b).to_array('chr1'), numpy.maximum(da,db))
+        assert_almost_equal((a+1).apply(numpy.log2).to_array('chr1'), numpy.log2(da+1))
+        # chr2 is missing in b: taken as zeros
+        assert_almost_equal((a+b).to_array('chr2'), [4,4,4,0])
+        # equal consecutive runs are merged
+        self.assertEqual(len((a > 0).runs['chr1'][0]), 3)
+
+    def test_reductions(self):
+        da = self.dense_a
+        starts, ends = [0,3,4,7,9], [4,6,5,12,10]
+        padded = numpy.concatenate((da,numpy.zeros(5)))
+        for method,fn in [('sum',numpy.sum),('mean',numpy.mean),('max',numpy.max),('min',numpy.min),
+                          ('coverage',numpy.count_nonzero)]:
+            res = self.a.window_reduce('chr1', starts, ends, method)
+            expected = [fn(padded[s:e]) for s,e in zip(starts,ends)]
+            assert_almost_equal(res, expected)
+        assert_almost_equal(self.a.bins('chr1', 4, 'sum'), [2,9,0])
+        assert_almost_equal(self.a.window_reduce('chrX', [0], [5]), [0])
+        self.assertRaises(ValueError, self.a.window_reduce, 'chr1', [0], [5], 'median')
+
+################### PLAN ######################
+
+
+class Test_Plan(unittest.TestCase):
+    def setUp(self):
+        self.bed = 'test_plan.bed'
+        self.sql = 'test_plan.sql'
+        self.X = [('chr1',0,10,'a',1.),('chr1',5,20,'b',3.),('chr2',2,8,'c',2.),('chr2',30,40,'d',5.)]
+        fields = ['chr','start','end','name','score']
+        for f in [self.bed,self.sql]:
+            t = track(f,fields=fields,chrmeta={'chr1':{'length':100},'chr2':{'length':100}})
+            t.write(fstream(self.X,fields=fields))
+            t.close()
+
+    def tearDown(self):
+        for f in [self.bed,self.sql,'test_plan_out.sql','test_plan_out.bed','test_plan_feats.sql']:
+            if os.path.exists(f): os.remove(f)
+
+    def test_optimize(self):
+        t = track(self.sql)
+        # Selections and fields pushed into the read, consecutive selections fused
+        p = plan.Select(plan.Select(plan.Read(t,'chr1'),selection={'score':(2,None)}),fields=['chr','start','end'])
+        p = plan.optimize(p)
+        self.assertIsInstance(p,plan.Read)
+        self.assertEqual(p.selection,[{'chr':'chr1','score':(2,None)}])
+        self.assertEqual(p.fields,['chr','start','end'])
+        self.assertEqual(list(p.execute()),[('chr1',5,20)])
+        # Two filters on the same field cannot be fused
+        p = plan.optimize(plan.Select(plan.Read(t,'chr1'),selection={'chr':'chr2'}))
+        self.assertIsInstance(p,plan.Select)
+        self.assertEqual(list(p.execute()),[])
+        # Sort steps are kept, selections are pushed below them
+        p = plan.optimize(plan.Sort(plan.Select(plan.Read(t,'chr2'),fields=['chr','start','end'])))
+        self.assertIsInstance(p,plan.Sort)
+        self.assertIsInstance(p.child,plan.Read)
+        self.assertEqual(list(p.execute()),[('chr2',2,8),('chr2',30,40)])
+
+    def test_explain(self):
+        t = track(self.bed)
+        p = plan.Apply(concatenate,{'trackList':[plan.Select(plan.Read(t,'chr1'),selection={'name':'b'})]})
+        p = plan.optimize(p)
+        self.assertEqual(p.explain().splitlines(),
+                         ["Apply(concatenate, trackList)",
+                          "  Read(%s, selection=[{'chr': 'chr1', 'name': 'b'}], fields=None)" % self.bed])
+        res = list(p.execute())
+        self.assertEqual(res,[('chr1',5,20,'b',3.)])
+
+    def test_run(self):
+        out = 'test_plan_out.sql'
+        run(operation='concatenate', output=out, trackList=self.sql, explain=True,
+            read_selection={'score':(2,None)}, read_fields=['chr','start','end','score'])
+        res = list(track(out,fields=['chr','start','end','score']).read())
+        self.assertEqual(res,[('chr1',5,20,3.),('chr2',2,8,2.),('chr2',30,40,5.)])
+
+    def test_run_genomewide(self):
+        out = 'test_plan_out.sql'
+        feats = 'test_plan_feats.sql'
+        chrmeta = {'chr1':{'length':100},'chr2':{'length':100}}
+        t = track(feats,fields=['chr','start','end'],chrmeta=chrmeta)
+        t.write(fstream([('chr1',8,9),('chr2',35,36)],fields=['chr','start','end']))
+        t.close()
+        run(operation='overlap_genome', output=out, trackList=self.sql, trackFeatures=feats)
+        res = list(track(out).read(fields=['chr','start','end','name']))
+        self.assertEqual(res,[('chr1',0,10,'a'),('chr1',5,20,'b'),('chr2',30,40,'d')])
+
+    def test_run_parallel(self):
+        out = 'test_plan_out.sql'
+        for output in [out,'test_plan_out.bed']:
+            files = run(operation='concatenate', output=output, trackList=self.sql, processes=2)
+            self.assertEqual(files,output)
+            res = list(track(output,fields=['chr','start','end','name','score']).read())
+            self.assertEqual(sorted(res),self.X)
+        # Jobs are dispatched largest first, results returned in the jobs' order
+        jobs = [{'operation':'concatenate','trackList':self.sql,'chromosome':c,'output':c+'_'+out}
+                for c in ['chr1','chr2']]
+        files = parallel_run(jobs, processes=2, sizes=[1,2])
+        self.assertEqual(files,['chr1_'+out,'chr2_'+out])
+        self.assertEqual(list(track(files[1]).read('chr2')),self.X[2:])
+        for f in files: os.remove(f)
+
+
+class Test_Cache(unittest.TestCase):
+    def setUp(self):
+        self.sql = 'test_cache.sql'
+        self.cachedir = 'test_cache_dir'
+        self.X = [('chr1',0,10,1.),('chr1',5,20,3.),('chr2',2,8,2.)]
+        t = track(self.sql,fields=['chr','start','end','score'],chrmeta={'chr1':{'length':100},'chr2':{'length':100}})
+        t.write(fstream(self.X,fields=['chr','start','end','score']))
+        t.close()
+
+    def tearDown(self):
+        import shutil
+        for f in [self.sql,'test_cache_out1.sql','test_cache_out2.sql','test_cache_out3.sql']:
+            if os.path.exists(f): os.remove(f)
+        shutil.rmtree(self.cachedir)
+
+    def test_run(self):
+        cache = ResultCache(self.cachedir)
+        kw = dict(operation='concatenate', trackList=self.sql, read_selection={'score':(2,None)})
+        out1 = run(output='test_cache_out1.sql', cache=cache, **kw)
+        out2 = run(output='test_cache_out2.sql', cache=self.cachedir, **kw)
+        self.assertEqual(cache.stats()['hits'],1)
+        self.assertEqual(cache.stats()['misses'],1)
+        self.assertEqual(cache.stats()['entries'],1)
+        self.assertEqual(sorted(track(out2).read()),[('chr1',5,20,3.),('chr2',2,8,2.)])
+        self.assertEqual(os.stat(out1).st_ino,os.stat(out2).st_ino) # hardlinked
+        # Other arguments: miss
+        run(output='test_cache_out2.sql', cache=cache, operation='concatenate', trackList=self.sql)
+        self.assertEqual(cache.stats()['misses'],2)
+        self.assertNotEqual(os.stat(out1).st_ino,os.stat(out2).st_ino)
+        self.assertEqual(len(list(track(out1).read())),2) # cached result unchanged
+        # Modified input: miss
+        os.utime(self.sql,(0,0))
+        run(output='test_cache_out3.sql', cache=cache, **kw)
+        self.assertEqual(cache.stats()['misses'],3)
+
+    def test_close_inputs(self):
+        import bbcflib.gfminer
+        opened = []
+        def _track(path, *args, **kw):
+            t = track(path, *args, **kw)
+            if path == self.sql:
+                opened.append(t)
+                _close = t.close
+                def close():
+                    opened.remove(t)
+                    _close()
+                t.close = close
+            return t
+        bbcflib.gfminer.track = _track
+        try:
+            kw = dict(operation='concatenate', trackList=self.sql, cache=self.cachedir)
+            run(output='test_cache_out1.sql', **kw) # miss
+            run(output='test_cache_out2.sql', **kw) # hit
+        finally:
+            bbcflib.gfminer.track = track
+        self.assertEqual(ResultCache(self.cachedir).stats()['hits'],1)
+        self.assertListEqual(opened,[])
+
+    def test_content_hash(self):
+        cache = ResultCache(self.cachedir, content_hash=True)
+        key = cache.key('concatenate', {}, {'trackList': [self.sql]})
+        os.utime(self.sql,(0,0))
+        self.assertEqual(cache.key('concatenate', {}, {'trackList': [self.sql]}), key)
+        self.assertNotEqual(cache.key('concatenate', {'a':(1,2)}, {'trackList': [self.sql]}),
+                            cache.key('concatenate', {'a':[1,2]}, {'trackList': [self.sql]}))
+
+    def test_evict(self):
+        cache = ResultCache(self.cachedir)
+        for n in range(3):
+            cache.put('key%i'%n, self.sql)
+            os.utime(os.path.join(self.cachedir,'key%i'%n,'entry'),(n,n))
+        cache.get('key0','test_cache_out1.sql','sql') # now the most recently used
+        cache.evict(max_size=cache.stats()['size']*2/3)
+        self.assertEqual(sorted(os.listdir(self.cachedir)),['key0','key2','stats'])
+
 
 ###########################################################################
 
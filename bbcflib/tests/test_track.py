@@ -2,7 +2,7 @@
 import os, shutil, time
 
 # Internal modules #
-from bbcflib.track import track, convert, FeatureStream, check
+from bbcflib.track import track, convert, FeatureStream, check, compile_selection
 from bbcflib.track.text import BedTrack, BedGraphTrack, WigTrack, SgaTrack, GffTrack
 from bbcflib.track.bin import BigWigTrack, BamTrack
 from bbcflib.track.sql import SqlTrack
@@ -114,6 +114,65 @@ class Test_Track(unittest.TestCase):
             test_file = os.path.join(path,test_file)+'.txt'
             if os.path.exists(test_file): os.remove(test_file)
 
+class Test_Selection(unittest.TestCase):
+    def setUp(self):
+        self.bed = os.path.join(path,"yeast_genes.bed")
+        self.sql = os.path.join(path,"test_selection.sql")
+
+    def test_compile_selection(self):
+        fields = ['chr','start','end','name','score','strand']
+        sel = [{'chr':'chrII','score':(6,None),'strand':'+'}, {'name':['YBL087C'],'length':(0,1000)}]
+        f = compile_selection(sel, fields)
+        self.assertTrue(f(('chrII',10,20,'n',7.,1)))
+        self.assertFalse(f(('chrII',10,20,'n',7.,-1)))
+        self.assertTrue(f(('chrV',10,20,'YBL087C',0.,-1)))
+        self.assertFalse(f(('chrV',10,2000,'YBL087C',0.,-1)))
+        f = compile_selection(sel, fields, cast=True)
+        self.assertTrue(f(('chrII','10','20','n','7','+')))
+        f = compile_selection({'start':(10,20)}, fields, closed=False)
+        self.assertFalse(f(('chrII',20,30,'n',7.,1)))
+        # Strand tuples and lists are sets of values
+        f = compile_selection({'strand':('+','-'),'score':[10,20]}, fields)
+        self.assertTrue(f(('chrII',10,20,'n',10.,-1)))
+        self.assertFalse(f(('chrII',10,20,'n',15.,1)))
+        self.assertFalse(f(('chrII',10,20,'n',20.,0)))
+
+    def test_read_selection_values(self):
+        # Text and sqlite tracks agree on strand tuples and lists of values
+        bed = 'test_selection_values.bed'
+        fields = ['chr','start','end','name','score','strand']
+        rows = [('chr1',0,10,'a',10.,1),('chr1',5,15,'b',15.,-1),('chr1',20,30,'c',20.,-1),
+                ('chr1',40,50,'d',20.,0)]
+        for f in [bed,self.sql]:
+            t = track(f, fields=fields, chrmeta={'chr1':{'length':100}})
+            t.write(FeatureStream(rows,fields=fields))
+            t.close()
+        try:
+            t = track(bed, chrmeta={'chr1':{'length':100}})
+            s = track(self.sql)
+            for sel,names in [({'strand':('+','-')}, ['a','b','c']),
+                              ({'score':[10,20]}, ['a','c','d']),
+                              ({'score':(10,20),'strand':['-']}, ['b','c'])]:
+                self.assertListEqual([x[3] for x in t.read(selection=sel)], names)
+                self.assertListEqual([x[3] for x in s.read(selection=sel)], names)
+            t.close()
+            s.close()
+        finally:
+            os.remove(bed)
+
+    def test_read_selection(self):
+        t = track(self.bed, chrmeta='sacCer2')
+        convert(self.bed, self.sql, chrmeta='sacCer2')
+        s = track(self.sql)
+        for sel in [{'chr':'chrII','score':(7,None)}, {'strand':'-','length':(500,2000)},
+                    {'chr':['chrII','chrIV'],'name':lambda x: x.endswith('W')}]:
+            res = sorted(t.read(selection=sel))
+            self.assertListEqual([tuple(x) for x in sorted(s.read(selection=sel))], res)
+            self.assertGreater(len(res),0)
+
+    def tearDown(self):
+        if os.path.exists(self.sql): os.remove(self.sql)
+
 class Test_Formats(unittest.TestCase):
     """Converting from bed to every other available format, using track.convert."""
     def setUp(self):
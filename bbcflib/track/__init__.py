@@ -2,11 +2,12 @@
 Documentation `here <http://bbcf.epfl.ch/bbcflib/tutorial_track.html>`_.
 """
 
-__all__ = ['Track','track','FeatureStream','convert',
+__all__ = ['Track','track','FeatureStream','row_class','convert',
            'strand_to_int','int_to_strand','format_float','format_int',
-           'ucsc_to_ensembl','ensembl_to_ucsc']
+           'ucsc_to_ensembl','ensembl_to_ucsc','compile_selection']
 
-import sys, os, re
+import sys, os, re, itertools
+from collections import namedtuple
 
 _track_map = {
     'sql': ('bbcflib.track.sql','SqlTrack'),
@@ -118,6 +119,79 @@ def format_int(i=int()):
     """Return a formatted string from an integer or a string representing an integer."""
     return '%i' % int(i)
 
+def compile_selection(selection, fields, closed=True, cast=False):
+    """
+    Compiles a *selection* into a single predicate function, built once and then
+    applied to each row (tuple) of a stream or a file.
+
+    A selection is a dictionary ``{field: value}``; all its filters must be satisfied
+    (AND operator). Alternatives (OR operator) are given as a list of such dictionaries.
+    Values can be:
+
+    * a tuple ``(min,max)``: range of values, where ``None`` leaves one side open,
+      e.g. ``{'score': (10,None)}``. For 'chr' and 'strand', a tuple is a list of values,
+      e.g. ``{'strand': ('+','-')}``;
+    * a list or set of possible values. Ranges must be given as tuples: ``{'score': [10,20]}``
+      selects the scores 10 and 20 only (text tracks used to read it as a range);
+    * a function returning True or False when applied to the field value;
+    * any other value, tested for equality.
+
+    The key 'length' selects on *end-start* when there is no such field, and 'strand'
+    values are compared in the 1/-1/0 notation (see `strand_to_int`).
+
+    :param selection: (dict, or list of dict) the filter described above.
+    :param fields: (list of str) field names of the rows the predicate will be applied to.
+    :param closed: (bool) whether ranges include their upper bound. [True]
+    :param cast: (bool) whether rows contain strings, as split from a text file,
+        which must be converted before comparison. [False]
+    :rtype: function
+    """
+    if isinstance(selection, dict): selection = [selection]
+    env = {'strand_to_int': strand_to_int}
+    def _const(val):
+        name = "_c%i" % len(env)
+        env[name] = val
+        return name
+    def _index(f):
+        if not f in fields:
+            raise ValueError("No such field '%s' in %s." % (f,fields))
+        return fields.index(f)
+    alternatives = []
+    for sel in selection:
+        tests = []
+        for k,v in sel.iteritems():
+            if k == 'length' and not(k in fields):
+                x = "x[%i]-x[%i]" % (_index('end'),_index('start'))
+                if cast: x = "int(x[%i])-int(x[%i])" % (_index('end'),_index('start'))
+                num = int
+            elif k == 'strand':
+                x = "strand_to_int(x[%i])" % _index(k)
+                num = strand_to_int
+            else:
+                x = "x[%i]" % _index(k)
+                num = float
+            if hasattr(v,'__call__'):
+                tests.append("%s(%s)" % (_const(v),x))
+            elif isinstance(v,tuple) and not(k in ['chr','strand']):
+                if cast and num is float: x = "float(%s)" % x
+                if not(v[0] is None):
+                    tests.append("%s >= %s" % (x,_const(num(v[0]) if cast else v[0])))
+                if not(v[1] is None):
+                    tests.append("%s %s %s" % (x, closed and "<=" or "<",
+                                               _const(num(v[1]) if cast else v[1])))
+            elif isinstance(v,(list,tuple,set,frozenset)):
+                if num is strand_to_int: vals = frozenset(num(y) for y in v)
+                elif cast: vals, x = frozenset(str(y) for y in v), "str(%s)" % x
+                else: vals = frozenset(v)
+                tests.append("%s in %s" % (x,_const(vals)))
+            else:
+                if num is strand_to_int: v = num(v)
+                elif cast and k == 'length': v = int(v)
+                elif cast: v, x = str(v), "str(%s)" % x
+                tests.append("%s == %s" % (x,_const(v)))
+        alternatives.append("(%s)" % (" and ".join(tests) or "True"))
+    return eval("lambda x: %s" % (" or ".join(alternatives) or "False"), env)
+
 def ucsc_to_ensembl(stream):
     """Shifts start coordinates 1 base to the right, to map UCSC to Ensembl annotation."""
     istart = stream.fields.index('start')
@@ -476,6 +550,17 @@ class Track(object):
 
 
 ################################################################################
+_row_classes = {}
+
+def row_class(fields):
+    """Return the namedtuple class representing items with the given *fields*.
+    Classes are generated once per field layout and cached. Field names that are not
+    valid identifiers (or duplicates) are renamed to their position, e.g. '_3'."""
+    key = tuple(str(f) for f in fields)
+    if not(key in _row_classes):
+        _row_classes[key] = namedtuple('Feature', key, rename=True)
+    return _row_classes[key]
+
 class FeatureStream(object):
     """
     Contains an iterator yielding features, and an extra fields attribute.
@@ -516,6 +601,12 @@ class FeatureStream(object):
 
         The list of field names.
 
+    .. attribute:: typed
+
+        If True, items are yielded as instances of a namedtuple class generated for this
+        field layout (see :func:`row_class`), so that one can write ``x.start`` instead of
+        ``x[stream.fields.index('start')]``. Rows remain tuples in every other respect.
+
     .. method:: __iter__()
 
         ``iter(self)`` returns self.data, which is an iterator itself.
@@ -526,15 +617,18 @@ class FeatureStream(object):
 
     """
 
-    def __init__(self, data, fields=None):
+    def __init__(self, data, fields=None, typed=False):
         if isinstance(data,(list,tuple)):
             data = iter(data)
         if not fields:
             if hasattr(data, 'description'):
                 fields = [x[0] for x in data.description]
             else: raise ValueError("Must specify a 'fields' attribute for %s." % self.__str__())
+        if typed:
+            data = itertools.imap(row_class(fields)._make, data)
         self.data = data
         self.fields = fields
+        self.typed = typed
 
     def __iter__(self):
         return self.data
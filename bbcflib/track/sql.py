@@ -37,6 +37,7 @@ class SqlTrack(Track):
         self.connection = sqlite3.connect(path)
 #        self.connection.row_factory = sqlite3.Row
         self.cursor = self.connection.cursor()
+        self._functions = {}
         kwargs['format'] = 'sql'
         Track.__init__(self,path,**kwargs)
         self.fields = self._get_fields(fields=self.fields)
@@ -188,7 +189,10 @@ class SqlTrack(Track):
                 if isinstance(x,basestring):
                     sel2.append( (str(x),{}) )
                 elif isinstance(x,dict):
-                    if 'chr' in x:
+                    if isinstance(x.get('chr'),(list,tuple,set,frozenset)):
+                        _x = dict((k,v) for k,v in x.iteritems() if not(k=='chr'))
+                        sel2.extend([(str(chrom),_x) for chrom in sorted(x['chr'])])
+                    elif 'chr' in x:
                         sel2.append( (x['chr'],dict((k,v) for k,v in x.iteritems()
                                                     if not(k=='chr')) ) )
                     else:
@@ -199,20 +203,43 @@ class SqlTrack(Track):
         return selection
 
     def _make_selection(self,selection):
+        """
+        Translates a selection dict into an SQL WHERE clause with '?' placeholders,
+        following the conventions of `bbcflib.track.compile_selection` (a 'strand' tuple
+        is a list of values).
+        Functions are registered as SQL functions so that the whole filter runs in sqlite.
+
+        :rtype: tuple (clause, list of arguments)
+        """
         query = []
+        args = []
         for k,v in selection.iteritems():
             if k == "length":
                 k = "end-start"
-            if isinstance(v,tuple):
-                query.append(str(k)+" >= "+str(v[0]))
-                query.append(str(k)+" <= "+str(v[1]))
+            elif k == "strand":
+                if hasattr(v,'__call__'): pass
+                elif isinstance(v,(list,tuple,set,frozenset)): v = [strand_to_int(y) for y in v]
+                else: v = strand_to_int(v)
+            if hasattr(v,'__call__'):
+                fname = "_sel%i" % id(v)
+                if not(self._functions.get(fname) is v):
+                    self.connection.create_function(fname,1,v)
+                    self._functions[fname] = v
+                query.append("%s(%s)" % (fname,k))
+            elif isinstance(v,tuple):
+                if not(v[0] is None):
+                    query.append(str(k)+" >= ?")
+                    args.append(v[0])
+                if not(v[1] is None):
+                    query.append(str(k)+" <= ?")
+                    args.append(v[1])
+            elif isinstance(v,(list,set,frozenset)):
+                query.append(str(k)+" IN (%s)" % ",".join("?"*len(v)))
+                args.extend(v)
             else:
-                if isinstance(v,basestring):
-                    str_val = "'%s'" % v
-                else:
-                    str_val = str(v)
-                query.append(str(k)+" = "+str_val)
-        return " AND ".join(query)
+                query.append(str(k)+" = ?")
+                args.append(v)
+        return " AND ".join(query), args
 
     def _read(self, fields, selection, order, add_chr):
         cursor = self.connection.cursor()
@@ -226,13 +253,15 @@ class SqlTrack(Track):
             if add_chr: qfields = "'"+chrom+"' as chr,"+fields
             else: qfields = fields
             sql_command = "SELECT %s FROM '%s'" % (qfields, chrom)
+            args = []
             if isinstance(selection,FeatureStream):
                 sql_command += " WHERE end>%s AND start<%s" % (sel[start_idx],sel[end_idx])
             elif sel[1]:
-                sql_command += " WHERE %s" % self._make_selection(sel[1])
+                where, args = self._make_selection(sel[1])
+                if where: sql_command += " WHERE %s" % where
             sql_command += " ORDER BY %s" % order
             try:
-                cursor.execute(sql_command)
+                cursor.execute(sql_command,args)
                 for x in cursor: yield x
             except sqlite3.OperationalError as err:
                 raise Exception("Sql error: %s\n on file %s, with\n%s" % (err,self.path,sql_command))
@@ -265,12 +294,14 @@ class SqlTrack(Track):
         for sel in selection:
             chrom = sel[chr_idx]
             sql_command = "SELECT %s FROM '%s'" % (','.join(_f), chrom)
+            args = []
             if isinstance(selection,FeatureStream):
                 sql_command += " WHERE end>%s AND start<%s" % (sel[start_idx],sel[end_idx])
             elif sel[1]:
-                sql_command += " WHERE %s" % self._make_selection(sel[1])
+                where, args = self._make_selection(sel[1])
+                if where: sql_command += " WHERE %s" % where
             try:
-                x = cursor.execute(sql_command).fetchone()
+                x = cursor.execute(sql_command,args).fetchone()
                 for n in range(len(_f)):
                     if rback[n] is None: rback[n] = x[n]
                     elif n%2 and rback[n] < x[n]: rback[n] = x[n]
@@ -285,7 +316,7 @@ class SqlTrack(Track):
         """
         :param selection: list of dict of the type
             `[{'chr':'chr1','start':(12,24)},{'chr':'chr3','end':(25,45)},...]`,
-            where tuples represent ranges, or a FeatureStream.
+            where tuples represent ranges, or a FeatureStream (see `compile_selection`).
         :param fields: (list of str) list of field names (columns) to read.
         :param order: (str, comma-separated) fields with respect to which the result must
             be sorted. ['start,end']
@@ -313,6 +344,25 @@ class SqlTrack(Track):
             self.cursor.execute(sql_command)
         self.connection.commit()
 
+    def _copy_tables(self, source, fields, chrom=None):
+        """Copy the table of chromosome *chrom* (all if None) of the sqlite track *source*
+        into this one with a single query per table, without going through Python rows."""
+        chroms = [chrom] if chrom else source.chrmeta.keys()
+        chroms = [c for c in chroms if c in source.tables]
+        fields = ','.join(['"%s"'%f for f in fields if f != 'chr' and f in source.fields])
+        sql_command = "ATTACH DATABASE ? AS 'source'"
+        try:
+            self.connection.commit()
+            self.cursor.execute(sql_command, (source.path,))
+            for c in chroms:
+                sql_command = "INSERT INTO '%s' (%s) SELECT %s FROM source.'%s'" %(c,fields,fields,c)
+                self.cursor.execute(sql_command)
+            self.connection.commit()
+            sql_command = "DETACH DATABASE 'source'"
+            self.cursor.execute(sql_command)
+        except sqlite3.OperationalError as err:
+            raise Exception("Sql error: %s\n on file %s, with\n%s"%(err,self.path,sql_command))
+
     def write(self, source, fields=None, chrom=None, **kw):
         if not(self._prepare_db()):
             raise IOError("Cannot write database %s, readonly is %s."%(self.path,self.readonly))
@@ -328,6 +378,10 @@ class SqlTrack(Track):
             fields = self.fields
         else:
             fields = [f for f in fields if f in self.fields]
+        if isinstance(source, SqlTrack):
+            self._copy_tables(source, fields, chrom)
+            if kw.get('clip'): self._clip()
+            return
 
         try:
             chr_idx = 0
@@ -174,36 +174,17 @@ class TextTrack(Track):
         else:
             return val
 
-    def _select_values(self,row,selection):
+    def _compile_selection(self,selection):
         """
-        Check whether all elements in a *row* pass through the *selection* filter.
+        Compile the list of dicts *selection* into a single predicate on splitted rows
+        (elements correspond to fields items), see `bbcflib.track.compile_selection`.
 
-        :row: (list) splitted row from file - elements correspond to fields items.
-        :param selection: dict of the form {field_name: value} or {field_name: (min,max)}.
-        :rtype: boolean
+        :param selection: list of dict of the form {field_name: value}, {field_name: (min,max)}
+            or {field_name: [value1,value2,...]}.
+        :rtype: function
         """
-        tests = []
-        for k,v in selection.iteritems():
-            if k == 'length':
-                fi1 = self.fields.index('start')
-                fi2 = self.fields.index('end')
-            else:
-                fi = self.fields.index(k)
-            if isinstance(v,(list,tuple)):
-                if k == 'chr':
-                    tests.append(str(row[fi]) in v)
-                elif k == 'length':
-                    tests.append(int(row[fi2])-int(row[fi1]) >= int(v[0]))
-                    tests.append(int(row[fi2])-int(row[fi1]) <= int(v[1]))
-                else:
-                    tests.append(float(row[fi]) >= float(v[0]))
-                    tests.append(float(row[fi]) <= float(v[1]))
-            else:
-                if k == 'length':
-                    tests.append(int(row[fi2])-int(row[fi1]) == int(v))
-                else:
-                    tests.append(str(row[fi]) == str(v))
-        return all(tests)
+        if not selection: return None
+        return compile_selection(selection, self.fields, cast=True)
 
     def _index_chr(self,start,end,splitrow):
         chr = splitrow[self.fields.index('chr')]
@@ -296,6 +277,7 @@ class TextTrack(Track):
 
     def _read(self, fields, index_list, selection, skip):
         self.open('read')
+        _pass = self._compile_selection(selection)
         if skip and selection:
             chr_toskip = self._init_skip(selection)
             next_toskip = chr_toskip.next()
@@ -314,7 +296,7 @@ class TextTrack(Track):
                     if skip:
                         fstart,fend,next_toskip = self._skip(fstart,next_toskip,chr_toskip)
                         self._index_chr(fstart,fend,splitrow)
-                    if not any(self._select_values(splitrow,s) for s in selection):
+                    if not _pass(splitrow):
                         continue
                 fstart = fend
                 yield tuple(self._check_type(splitrow[index_list[n]],f)
@@ -326,7 +308,7 @@ class TextTrack(Track):
         """
         :param selection: list of dict of the type
             `[{'chr':'chr1','start':(12,24)},{'chr':'chr3','end':(25,45)},...]`,
-            where tuples represent ranges, or a FeatureStream.
+            where tuples represent ranges, or a FeatureStream (see `compile_selection`).
         :param fields: (list of str) list of field names (columns) to read.
         :param skip: (bool) assuming that lines are grouped by chromosome name,
             increases reading speed when looping over selections of several/all chromosomes.
@@ -582,6 +564,7 @@ class SgaTrack(TextTrack):
 
     def _read(self, fields, index_list, selection, skip):
         self.open('read')
+        _pass = self._compile_selection(selection)
         if skip and selection:
             chr_toskip = self._init_skip(selection)
             next_toskip = chr_toskip.next()
@@ -603,7 +586,7 @@ class SgaTrack(TextTrack):
                 if skip:
                     fstart,fend,next_toskip = self._skip(fstart,next_toskip,chr_toskip)
                     self._index_chr(fstart,fend,rowdata)
-                if not any(self._select_values(rowdata,s) for s in selection):
+                if not _pass(rowdata):
                     continue
             fstart = fend
             yield tuple(rowdata[ind] for ind in index_list)
@@ -642,6 +625,7 @@ class WigTrack(TextTrack):
 
     def _read(self, fields, index_list, selection, skip):
         self.open('read')
+        _pass = self._compile_selection(selection)
         if skip and selection:
             chr_toskip = self._init_skip(selection)
             next_toskip = chr_toskip.next()
@@ -659,7 +643,7 @@ class WigTrack(TextTrack):
                 if row[0]=="#": continue
                 if row[:7]=="browser" or row[:5]=="track":
                     if rowdata[1] >= 0:
-                        if (not selection) or any(self._select_values(rowdata,s) for s in selection):
+                        if (not selection) or _pass(rowdata):
                             yield tuple(self._check_type(rowdata[index_list[n]],f)
                                         for n,f in enumerate(fields))
                     fixedStep = None
@@ -668,7 +652,7 @@ class WigTrack(TextTrack):
                     continue
                 if row[:9]=="fixedStep":
                     if rowdata[1] >= 0:
-                        if (not selection) or any(self._select_values(rowdata,s) for s in selection):
+                        if (not selection) or _pass(rowdata):
                             yield tuple(self._check_type(rowdata[index_list[n]],f)
                                         for n,f in enumerate(fields))
                     fixedStep = True
@@ -686,7 +670,7 @@ class WigTrack(TextTrack):
                     continue
                 if row[:12]=="variableStep":
                     if rowdata[1] >= 0:
-                        if (not selection) or any(self._select_values(rowdata,s) for s in selection):
+                        if (not selection) or _pass(rowdata):
                             yield tuple(self._check_type(rowdata[index_list[n]],f)
                                         for n,f in enumerate(fields))
                     fixedStep = False
@@ -722,7 +706,7 @@ class WigTrack(TextTrack):
                     if skip:
                         fstart,fend,next_toskip = self._skip(fstart,next_toskip,chr_toskip)
                         self._index_chr(fstart,fend,rowdata)
-                    if not any(self._select_values(rowdata,s) for s in selection):
+                    if not _pass(rowdata):
                         rowdata[1] = start
                         rowdata[2] = end
                         rowdata[3] = score
@@ -734,7 +718,7 @@ class WigTrack(TextTrack):
                 rowdata[2] = end
                 rowdata[3] = score
             if rowdata[1] >= 0:
-                if (not selection) or any(self._select_values(rowdata,s) for s in selection):
+                if (not selection) or _pass(rowdata):
                     yield tuple(self._check_type(rowdata[index_list[n]],f)
                                 for n,f in enumerate(fields))
         except ValueError as ve:
@@ -825,6 +809,7 @@ class SamTrack(TextTrack):
 
     def _read(self, fields, index_list, selection, skip):
         self.open('read')
+        _pass = self._compile_selection(selection)
         if skip and selection:
             chr_toskip = self._init_skip(selection)
             next_toskip = chr_toskip.next()
@@ -841,7 +826,7 @@ class SamTrack(TextTrack):
                     if skip:
                         fstart,fend,next_toskip = self._skip(fstart,next_toskip,chr_toskip)
                         self._index_chr(fstart,fend,splitrow)
-                    if not any(self._select_values(splitrow,s) for s in selection):
+                    if not _pass(splitrow):
                         continue
                 splitrow = splitrow[:4]+[int(splitrow[3])+len(splitrow[9])]+splitrow[4:] # end = start + read length
                 fstart = fend
@@ -866,6 +851,7 @@ class FpsTrack(TextTrack):
 
     def _read(self, fields, index_list, selection, skip):
         self.open('read')
+        _pass = self._compile_selection(selection)
         if skip and selection:
             chr_toskip = self._init_skip(selection)
             next_toskip = chr_toskip.next()
@@ -882,7 +868,7 @@ class FpsTrack(TextTrack):
                     if skip:
                         fstart,fend,next_toskip = self._skip(fstart,next_toskip,chr_toskip)
                         self._index_chr(fstart,fend,splitrow)
-                    if not any(self._select_values(splitrow,s) for s in selection):
+                    if not _pass(splitrow):
                         continue
                 fstart = fend
                 yield tuple(self._check_type(splitrow[index_list[n]],f) for n,f in enumerate(fields))